@@ -1,6 +1,8 @@
 import pandas
+import numpy
 import logging
 import datetime
+import calendar
 import re
 import copy
 import pytz
@@ -11,6 +13,7 @@ from django import forms
 from rvbd.common.timeutils import datetime_to_seconds, timedelta_total_seconds
 
 from rvbd_portal.apps.datasource.models import Job, Table, Column, TableField, BatchJobRunner
+from rvbd_portal.apps.datasource import timecache
 from rvbd_portal.apps.datasource.modules.analysis import AnalysisTable, AnalysisException
 from rvbd_portal.apps.datasource.forms import fields_add_time_selection
 
@@ -67,20 +70,31 @@ def fields_add_business_hour_fields(obj,
 def get_timestable(biztable):
     return biztable.options['tables']['times']
 
-def timestable(name):
-    table = AnalysisTable.create(name, tables={}, func=compute_times)
+def timestable(name, holidays=None):
+    table = AnalysisTable.create(name, tables={}, func=compute_times,
+                                 params={'holidays': holidays})
     Column.create(table, 'starttime', 'Start time', datatype='time', iskey=True, issortcol=True)
     Column.create(table, 'endtime',   'End time', datatype='time', iskey=True)
     Column.create(table, 'totalsecs', 'Total secs')
     fields_add_business_hour_fields(table)
     return table
 
-def create(name, basetable, aggregate, **kwargs):
+def create(name, basetable, aggregate, batchsize=None, holidays=None,
+           **kwargs):
+    """ Create a table summarizing `basetable` over business hours only.
+
+    `basetable` is run once for the business hours of each day, at most
+    `batchsize` days at once (APPS_DATASOURCE['batch_job_size'] if None).
+    `holidays` is a list of dates (or 'YYYY-MM-DD' strings) that are
+    skipped like weekends.
+    """
+    times = timestable(name + '-times', holidays=holidays)
     table = AnalysisTable.create(name,
-                                 tables={'times': timestable(name + '-times').id},
+                                 tables={'times': times.id},
                                  related_tables={'basetable': basetable.id},
                                  func=report_business_hours,
-                                 params={'aggregate': aggregate},
+                                 params={'aggregate': aggregate,
+                                         'batchsize': batchsize},
                                  **kwargs)
 
     table.copy_columns(basetable)
@@ -95,75 +109,103 @@ def parse_time(t_str):
     minutes = int(m.group(2))
     ampm = m.group(3)
     if ampm:
+        if hours == 12:
+            hours = 0
         if ampm.lower()[0] == 'p':
             hours = hours + 12
     return datetime.time(hours, minutes, 0)
 
 
-def replace_time(dt, t):
-    return dt.replace(hour=t.hour,
-                      minute=t.minute,
-                      second=0,
-                      microsecond=0)
-
-
 def compute_times(query, tables, criteria, params):
     tzname = criteria.business_hours_tzname
     logger.debug("%s: timezone: %s" % (query.job, tzname))
     tz = pytz.timezone(tzname)
 
-    # Convert to datetime objects in the requested timezone
-    st = criteria.starttime.astimezone(tz)
-    et = criteria.endtime.astimezone(tz)
-    logger.debug("%s: times: %s - %s" % (query.job, st, et))
-
     # Business hours start/end, as string "HH:MMam" like 8:00am
     sb = parse_time(criteria.business_hours_start)
     eb = parse_time(criteria.business_hours_end)
 
-    weekends = criteria.business_hours_weekends
-
-    # Iterate from st to et until
-    times = []
-    t = st
-    while t <= et:
-        # Set t0/t1 to date of t but time of sb/eb
-        t0 = replace_time(t, sb)
-        t1 = replace_time(t, eb)
+    holidays = (params or {}).get('holidays')
 
-        # Advance t by 1 day
-        t = t + datetime.timedelta(days=1)
+    times = business_intervals(criteria.starttime, criteria.endtime,
+                               sb, eb, tz,
+                               weekends=criteria.business_hours_weekends,
+                               holidays=holidays)
 
-        # Skip weekends
-        if not weekends and t0.weekday() >= 5:
-            continue
+    logger.debug("%s: %d business intervals from %s to %s" %
+                 (query.job, 0 if times is None else len(times),
+                  criteria.starttime, criteria.endtime))
+    return times
 
-        # Now see if we have any overlap of busines hours for today
-        if et < t0:
-            # Report end time is today before busines hours start, all done
-            break
 
-        if et < t1:
-            # Report end time is today in the middle of busines hours, adjust
-            t1 = et
+def business_intervals(starttime, endtime, business_start, business_end,
+                       tz, weekends=False, holidays=None):
+    """ Return the business hours between `starttime` and `endtime`.
 
-        if t1 < st:
-            # Report start time occurs today *after* business end, nothing today
-            continue
+    `business_start` and `business_end` are datetime.time values in
+    timezone `tz`.  Each day is localized separately, so business
+    hours stay at the same local time across DST changes.  Weekends
+    are skipped unless `weekends` is True, as are the dates listed in
+    `holidays`.  The first and last days are clipped to the report
+    times.
 
-        if t0 < st:
-            # Report start time occurs today in the middle of the business hours
-            # Adjust t0
-            t0 = st
+    Returns a DataFrame with a row for each day holding the UTC
+    'starttime' and 'endtime' and the 'totalsecs' between them, or
+    None if there are no business hours in the range.
+    """
+    st = starttime.astimezone(tz)
+    et = endtime.astimezone(tz)
+
+    days = pandas.date_range(st.date(), et.date(), freq='D')
+    if not weekends:
+        days = days[days.weekday < 5]
+    if holidays:
+        skip = pandas.to_datetime(list(holidays)).normalize()
+        days = days[~numpy.in1d(days.asi8, skip.asi8)]
+    if len(days) == 0:
+        return None
 
-        logger.debug("%s: start: %s, end: %s, duration: %s" %
-                     (query.job, str(t0), str(t1), str(timedelta_total_seconds(t1-t0))))
-        times.append((t0, t1, timedelta_total_seconds(t1-t0)))
+    t0 = _localize(days, business_start, tz)
+    t1 = _localize(days, business_end, tz)
 
-    if len(times) == 0:
+    t0 = numpy.maximum(t0, _epoch_ns(starttime))
+    t1 = numpy.minimum(t1, _epoch_ns(endtime))
+    keep = t1 > t0
+    if not keep.any():
         return None
-    else:
-        return pandas.DataFrame(times, columns=['starttime', 'endtime', 'totalsecs'])
+
+    t0 = t0[keep]
+    t1 = t1[keep]
+    return pandas.DataFrame({'starttime': t0.astype('datetime64[ns]'),
+                             'endtime': t1.astype('datetime64[ns]'),
+                             'totalsecs': (t1 - t0) / 1e9},
+                            columns=['starttime', 'endtime', 'totalsecs'])
+
+
+def _epoch_ns(dt):
+    return (calendar.timegm(dt.utctimetuple()) * 10**9 +
+            dt.microsecond * 1000)
+
+
+def _localize(days, t, tz):
+    """ Return UTC epoch ns of time of day `t` in `tz` on each of `days`. """
+    offset = numpy.timedelta64(t.hour * 3600 + t.minute * 60 + t.second, 's')
+    local = pandas.DatetimeIndex(days.values + offset)
+    try:
+        return local.tz_localize(tz).asi8
+    except pytz.InvalidTimeError:
+        # The time is skipped or repeated on a DST change day, let
+        # pytz pick an offset for each day instead
+        return numpy.array([_epoch_ns(tz.localize(d))
+                            for d in local.to_pydatetime()],
+                           dtype=numpy.int64)
+
+
+def as_utc(t):
+    """ Return datetime `t` in UTC, naive datetimes are taken as UTC. """
+    if t.tzinfo is None:
+        return pytz.utc.localize(t)
+    return t.astimezone(pytz.utc)
 
 
 def report_business_hours(query, tables, criteria, params):
@@ -174,67 +216,168 @@ def report_business_hours(query, tables, criteria, params):
 
     basetable = Table.objects.get(id=query.table.options['related_tables']['basetable'])
 
-    # Create all the jobs
-    batch = BatchJobRunner(query)
+    keynames = [key.name for key in basetable.get_columns(iskey=True)]
+    if 'aggregate' in params:
+        ops = params['aggregate']
+        for col in basetable.get_columns(iskey=False):
+            if col.name not in ops:
+                ops[col.name] = 'sum'
+
+    else:
+        ops = dict((col.name, 'sum')
+                   for col in basetable.get_columns(iskey=False))
+
+    accumulator = GroupbyAccumulator(keynames, ops, '__secs__')
+
+    # Results of complete days are kept so running the report again
+    # later only needs to query the days that are new
+    cache = timecache.cache
+    if criteria.ignore_cache:
+        cache = None
+
+    # Create jobs for the days that are not cached
+    batch = BatchJobRunner(query, batchsize=params.get('batchsize'))
+    days = {}
     for i, row in times.iterrows():
         (t0,t1) = (row['starttime'], row['endtime'])
         sub_criteria = copy.copy(criteria)
         sub_criteria.starttime = t0
         sub_criteria.endtime = t1
+        sub_criteria.duration = t1 - t0
+
+        if cache is not None:
+            subdf = cache.load_summary(basetable, sub_criteria,
+                                       as_utc(t0), as_utc(t1))
+            # Each row holds the seconds covered by the summary, so
+            # empty summaries are not stored and cannot be used
+            if subdf is not None and len(subdf) > 0:
+                logger.debug("%s: using cached result for %s - %s" %
+                             (query.job, t0, t1))
+                accumulator.add(subdf, subdf['__secs__'].iloc[0])
+                continue
 
         job = Job.create(table=basetable, criteria=sub_criteria)
         logger.debug("Created %s: %s - %s" % (job, t0, t1))
         batch.add_job(job)
+        days[job.id] = (t0, t1, sub_criteria)
 
-    if len(batch.jobs) == 0:
-        return None
-
-    # Run all the Jobs
-    batch.run()
+    # Aggregate the data of each job as soon as it is done
+    errors = []
 
-    # Now collect the data
-    total_secs = 0
-    df = None
-    idx = 0
-    for job in batch.jobs:
+    def collect(job):
         if job.status == Job.ERROR:
-            raise AnalysisException("%s for %s-%s failed: %s" %
-                                    (job, job.criteria.starttime,
-                                     job.criteria.endtime,
-                                     job.message))
+            errors.append(job)
+            return
+
         subdf = job.data()
         logger.debug("%s: returned %d rows" %
                      (job, len(subdf) if subdf is not None else 0))
         if subdf is None:
-            continue
+            return
 
         logger.debug("%s: actual_criteria %s" % (job, job.actual_criteria))
         t0 = job.actual_criteria.starttime
         t1 = job.actual_criteria.endtime
-        subdf['__secs__'] = timedelta_total_seconds(t1 - t0)
-        total_secs += timedelta_total_seconds(t1 - t0)
-        idx += 1
-        if df is None:
-            df = subdf
-        else:
-            df = df.append(subdf)
+        secs = timedelta_total_seconds(t1 - t0)
+        subdf['__secs__'] = secs
 
-    if df is None:
-        return None
+        if cache is not None:
+            (day_t0, day_t1, sub_criteria) = days[job.id]
+            cache.store_summary(basetable, sub_criteria,
+                                as_utc(day_t0), as_utc(day_t1), subdf)
 
-    keynames = [key.name for key in basetable.get_columns(iskey=True)]
-    if 'aggregate' in params:
-        ops = params['aggregate']
-        for col in basetable.get_columns(iskey=False):
-            if col.name not in ops:
-                ops[col.name] = 'sum'
+        accumulator.add(subdf, secs)
 
-    else:
-        ops = 'sum'
+    # Run all the Jobs
+    if len(batch.jobs) > 0:
+        batch.run(callback=collect)
+
+    if errors:
+        job = errors[0]
+        raise AnalysisException("%s for %s-%s failed: %s" %
+                                (job, job.criteria.starttime,
+                                 job.criteria.endtime,
+                                 job.message))
 
-    df = avg_groupby_aggregate(df, keynames, ops, '__secs__', total_secs)
+    return accumulator.result()
+
+
+class GroupbyAccumulator(object):
+    """ Incremental version of `avg_groupby_aggregate()`.
+
+    Frames are added one at a time with `add()`, each with the time
+    interval it covers.  When every operation in `ops` is one of those
+    in `combine` the groups of each frame are aggregated right away
+    and merged into a running result, so only one row per key is kept
+    between frames.  Otherwise the frames are collected and aggregated
+    together by `result()`.
+    """
+
+    # Operation used to merge partial results of each operation
+    combine = {'sum': 'sum',
+               'avg': 'sum',
+               'count': 'sum',
+               'min': 'min',
+               'max': 'max'}
+
+    def __init__(self, keys, ops, t_col):
+        self.keys = keys
+        self.ops = ops
+        self.t_col = t_col
+        self.total_t = 0
+
+        self.incremental = all(isinstance(op, basestring) and
+                               op in self.combine for op in ops.values())
+        self.partial = None
+        self.frames = []
+
+    def weighted_col(self, name):
+        return name + '__weighted__'
 
-    return df
+    def add(self, df, t):
+        """ Add the rows of `df`, which cover an interval of `t` seconds. """
+        self.total_t += t
+        if not self.incremental:
+            self.frames.append(df)
+            return
+
+        # Leave the caller's frame alone, it may be cached or stored
+        df = df.copy(deep=False)
+
+        newops = {}
+        mergeops = {}
+        for k, v in self.ops.iteritems():
+            if v == 'avg':
+                df[self.weighted_col(k)] = df[k] * df[self.t_col]
+                k = self.weighted_col(k)
+                v = 'sum'
+            newops[k] = v
+            mergeops[k] = self.combine[v]
+
+        partial = df.groupby(self.keys).aggregate(newops).reset_index()
+        if self.partial is not None:
+            partial = (pandas.concat([self.partial, partial],
+                                     ignore_index=True)
+                       .groupby(self.keys).aggregate(mergeops).reset_index())
+        self.partial = partial
+
+    def result(self):
+        """ Return the aggregated DataFrame, None if nothing was added. """
+        if not self.incremental:
+            if not self.frames:
+                return None
+            df = pandas.concat(self.frames, ignore_index=True)
+            return avg_groupby_aggregate(df, self.keys, self.ops,
+                                         self.t_col, self.total_t)
+
+        result = self.partial
+        if result is None:
+            return None
+        for k, v in self.ops.iteritems():
+            if v == 'avg':
+                result[k] = result[self.weighted_col(k)] / self.total_t
+                del result[self.weighted_col(k)]
+        return result
 
 
 def avg_groupby_aggregate(df, keys, ops, t_col, total_t):
@@ -7,7 +7,6 @@
 
 import time
 import logging
-import threading
 import datetime
 
 import rvbd.profiler
@@ -23,7 +22,6 @@ from rvbd_portal.apps.datasource.forms import (fields_add_time_selection,
 from rvbd_portal.libs.fields import Function
 
 logger = logging.getLogger(__name__)
-lock = threading.Lock()
 
 
 def fields_add_filterexpr(obj, keyword='profiler_filterexpr', initial=None):
@@ -171,6 +169,11 @@ class TableQuery:
         self.table = table
         self.job = job
 
+    @classmethod
+    def timeseries_cacheable(cls, table):
+        # Only time series can be pieced together from shorter queries
+        return table.options.groupby == 'time'
+
     def fake_run(self):
         import fake_data
         self.data = fake_data.make_data(self.table, self.job)
@@ -224,7 +227,7 @@ class TableQuery:
         logger.debug('Profiler report using resolution %s (%s)' %
                      (resolution, type(resolution)))
 
-        with lock:
+        with DeviceManager.slot(criteria.profiler_device):
             report.run(realm=self.table.options.realm,
                        groupby=profiler.groupbys[self.table.options.groupby],
                        centricity=self.table.options.centricity,
@@ -237,18 +240,16 @@ class TableQuery:
                        sync=False
                        )
 
-        done = False
-        logger.info("Waiting for report to complete")
-        while not done:
-            time.sleep(0.5)
-            with lock:
+            done = False
+            logger.info("Waiting for report to complete")
+            while not done:
+                time.sleep(0.5)
                 s = report.status()
 
-            self.job.safe_update(progress=int(s['percent']))
-            done = (s['status'] == 'completed')
+                self.job.safe_update(progress=int(s['percent']))
+                done = (s['status'] == 'completed')
 
-        # Retrieve the data
-        with lock:
+            # Retrieve the data
             query = report.get_query_by_index(0)
             self.data = query.get_data()
 
@@ -15,7 +15,6 @@ from rvbd.profiler.filters import TrafficFilter
 from rvbd_portal.apps.datasource.models import Table
 from rvbd_portal.apps.devices.devicemanager import DeviceManager
 from rvbd_portal.apps.devices.forms import fields_add_device_selection
-from rvbd_portal_profiler.datasources.profiler import lock
 from rvbd_portal.libs.fields import Function
 
 logger = logging.getLogger(__name__)
@@ -73,7 +72,7 @@ class TableQuery:
         # This returns an array of rows, one row per device
         # Each row is a dict containing elements such as:
         #      id, ipaddr, name, type, type_id, and version
-        with lock:
+        with DeviceManager.slot(criteria.profiler_device):
             devicedata = profiler.api.devices.get_all()
 
         # Convert to a DataFrame to make it easier to work with
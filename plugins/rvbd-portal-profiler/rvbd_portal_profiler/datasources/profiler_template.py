@@ -7,7 +7,6 @@
 
 import time
 import logging
-import threading
 import datetime
 import pandas
 
@@ -27,7 +26,6 @@ from rvbd_portal_profiler.datasources.profiler import (fields_add_filterexpr,
                                                        fields_add_filterexprs_field)
 
 logger = logging.getLogger(__name__)
-lock = threading.Lock()
 
 
 class TableOptions(JsonDict):
@@ -119,18 +117,17 @@ class TableQuery:
         logger.debug('Profiler report using resolution %s (%s)' %
                      (resolution, type(resolution)))
 
-        with lock:
+        with DeviceManager.slot(criteria.profiler_device):
             res = report.run(template_id=self.table.options.template_id,
                              timefilter=tf,
                              trafficexpr=trafficexpr,
                              resolution=resolution)
 
-        if res is True:
-            logger.info("Report template complete.")
-            self.job.safe_update(progress=100)
+            if res is True:
+                logger.info("Report template complete.")
+                self.job.safe_update(progress=100)
 
-        # Retrieve the data
-        with lock:
+            # Retrieve the data
             query = report.get_query_by_index(0)
             data = query.get_data()
             headers = report.get_legend()
@@ -96,6 +96,10 @@ class Table(object):
 # method taking the defined arguments
 class TableQuery(object):
 
+    # Results have one row per time bucket, so the portal may cache
+    # them and only ask for the part of the time range it is missing
+    timeseries_cacheable = True
+
     def __init__(self, table, job):
         self.table = table
         self.job = job
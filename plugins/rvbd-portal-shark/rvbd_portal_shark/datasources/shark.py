@@ -7,7 +7,6 @@
 
 import time
 import logging
-import threading
 
 from django import forms
 
@@ -29,7 +28,6 @@ from rvbd_portal.apps.datasource.forms import (fields_add_time_selection,
 from rvbd_portal.libs.fields import Function
 
 logger = logging.getLogger(__name__)
-lock = threading.Lock()
 
 
 class TableOptions(JsonDict):
@@ -167,6 +165,16 @@ class TableQuery:
         default_delta = 1000000000                      # one second
         self.delta = int(default_delta * resolution)    # sample size interval
 
+    @classmethod
+    def timeseries_cacheable(cls, table):
+        # Only views keyed by the sample time can be pieced together
+        # from shorter queries
+        if table.options.aggregated:
+            return False
+        return any(c.iskey and c.name == 'time' and
+                   c.options.extractor == 'sample_time'
+                   for c in table.get_columns(synthetic=False))
+
     def fake_run(self):
         import fake_data
         self.data = fake_data.make_data(self.table, self.job)
@@ -248,16 +256,6 @@ class TableQuery:
         logger.info("Setting shark table %d timeframe to %s" % (self.table.id,
                                                                 str(tf)))
 
-        # Get source type from options
-        try:
-            with lock:
-                source = path_to_class(shark,
-                                       self.job.criteria.shark_source_name)
-
-        except RvbdHTTPException, e:
-            source = None
-            raise e
-
         resolution = criteria.resolution
         if resolution.seconds == 1:
             sampling_time_msec = 1000
@@ -269,29 +267,36 @@ class TableQuery:
                 raise ValueError(msg)
         else:
             sampling_time_msec = 1000
- 
-        # Setup the view
-        if source is not None:
-            with lock:
+
+        with DeviceManager.slot(criteria.shark_device):
+            # Get source type from options
+            try:
+                source = path_to_class(shark,
+                                       self.job.criteria.shark_source_name)
+
+            except RvbdHTTPException, e:
+                source = None
+                raise e
+
+            # Setup the view
+            if source is not None:
                 view = shark.create_view(source, columns, filters=filters,
                                          sync=False,
                                          sampling_time_msec=sampling_time_msec)
-        else:
-            # XXX raise other exception
-            return None
-
-        done = False
-        logger.debug("Waiting for shark table %d to complete" % self.table.id)
-        while not done:
-            time.sleep(0.5)
-            with lock:
+            else:
+                # XXX raise other exception
+                return None
+
+            done = False
+            logger.debug("Waiting for shark table %d to complete" %
+                         self.table.id)
+            while not done:
+                time.sleep(0.5)
                 s = view.get_progress()
-                self.job.progress = s
-                self.job.save()
-            done = (s == 100)
+                self.job.safe_update(progress=s)
+                done = (s == 100)
 
-        # Retrieve the data
-        with lock:
+            # Retrieve the data
             if self.table.options.aggregated:
                 self.data = view.get_data(
                     aggregated=self.table.options.aggregated,
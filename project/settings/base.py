@@ -283,7 +283,73 @@ LOGGING = {
 APPS_DATASOURCE = {
     'job_age_old_seconds': 60*60*24,            # one day
     'job_age_ancient_seconds': 7*60*60*24,      # one week
-    'threading': True
+    'threading': True,
+
+    # Jobs are run by a fixed size pool of worker threads.  Set the pool
+    # size to 0 to start a new thread for every job instead.  When
+    # 'worker_queue_size' is non-zero, new jobs are rejected once that many
+    # jobs are waiting for a free worker, otherwise they are always queued.
+    'worker_pool_size': 20,
+    'worker_queue_size': 0,
+
+    # With the worker pool, analysis tables start the jobs of every table
+    # they depend on at once and run when those are done, rather than
+    # holding a pool thread while waiting on them.
+    'job_scheduler': True,
+
+    # Number of processes that run analysis functions of tables created
+    # with executor='process', so CPU heavy analysis does not hold the GIL
+    # needed to serve pages.  0 runs them on the job's thread instead.
+    # The processes are forked by every process that loads the models,
+    # management commands included, so only enable this when such
+    # tables are used.
+    'process_pool_size': 0,
+
+    # Seconds an analysis function may run in the process pool before its
+    # job fails, None for no limit.
+    'process_pool_timeout': 3600,
+
+    # Number of dependent jobs run at once by a BatchJobRunner, for
+    # example the per day jobs of a business hours report.
+    'batch_job_size': 4,
+
+    # How threads waiting on a job learn that it changed: 'local' only sees
+    # changes made in this process, 'file' also sees changes made by other
+    # server processes.  May also be the dotted path of a notifier class.
+    'job_notifier': 'local',
+
+    # Format of job data files in DATA_CACHE: 'columnar' stores each column
+    # as an array that is memory mapped when read, 'pickle' stores pickled
+    # DataFrames.  May also be the dotted path of a DataStore class.  Files
+    # in either format can be read regardless of this setting.
+    'datafile_format': 'columnar',
+
+    # Memory budget in bytes for caching loaded job data, 0 disables caching.
+    'data_cache_bytes': 256*1024*1024,
+
+    # How tables with 'resample' set are resampled: 'epoch' buckets rows by
+    # epoch time with numpy, 'pandas' uses DataFrame.resample().  May also be
+    # the dotted path of a resampler class.
+    'resample_engine': 'epoch',
+
+    # Cache the results of time series tables in segments of time, so a
+    # report run again only queries the newest data.  Data newer than
+    # 'timeseries_cache_delay' seconds is not cached as it may not be
+    # complete yet, segments are dropped after 'timeseries_cache_max_age'.
+    # Uncached parts are queried at most 'timeseries_cache_slice_buckets'
+    # resolution buckets at a time, showing the data so far in between.
+    'timeseries_cache': True,
+    'timeseries_cache_delay': 300,
+    'timeseries_cache_max_age': 7*60*60*24,         # one week
+    'timeseries_cache_slice_buckets': 360,
+}
+
+# Limit on the number of queries run at the same time against any one
+# device, by device module.  The 'default' entry applies to all other modules.
+APPS_DEVICES = {
+    'max_concurrent_calls': {
+        'default': 4,
+    },
 }
 
 TESTING = 'test' in sys.argv
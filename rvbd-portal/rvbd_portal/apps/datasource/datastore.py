@@ -0,0 +1,424 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import os
+import struct
+import logging
+import tempfile
+import importlib
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+
+import numpy
+import pandas
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _clamp_rows(rows, nrows):
+    """ Return slice `rows` limited to a frame of `nrows` rows.
+
+    DataFrame.iloc rejects slices that run past the end of the frame.
+    """
+    start, stop, step = rows.indices(nrows)
+    if stop < 0:
+        # Reversed slice running to the first row
+        stop = None
+    return slice(start, stop, step)
+
+
+class DataStore(object):
+    """ Base class for the on disk format of job data files.
+
+    Subclasses implement `_save()` and `load()`.  Formats that can be
+    recognized from the start of a file set `magic`, this is used to
+    pick the right format when loading files written with a format
+    other than the one currently configured.
+    """
+
+    name = None
+    magic = None
+
+    def save(self, df, path):
+        """ Save DataFrame `df` to `path`.
+
+        The data is written to a temporary file that is then renamed
+        over `path`, so readers never see a partially written file.
+        """
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path),
+                                       prefix=os.path.basename(path) + '.')
+        os.close(fd)
+        try:
+            self._save(df, tmppath)
+            os.rename(tmppath, path)
+        except:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise
+
+    def _save(self, df, path):
+        raise NotImplementedError()
+
+    def load(self, path, columns=None, rows=None):
+        """ Load a DataFrame from `path`.
+
+        `columns` is a list of the column names to load, names that are
+        not in the file are ignored.  `rows` is a slice selecting the
+        rows to load.  The default for both is to load everything.
+        """
+        raise NotImplementedError()
+
+
+class PickleStore(DataStore):
+    """ Data files as pickled DataFrames.
+
+    The whole file has to be read regardless of the columns and
+    rows requested.
+    """
+
+    name = 'pickle'
+
+    def _save(self, df, path):
+        df.save(path)
+
+    def load(self, path, columns=None, rows=None):
+        df = pandas.load(path)
+        if columns is not None:
+            df = df[[c for c in columns if c in df]]
+        if rows is not None:
+            df = df.iloc[_clamp_rows(rows, len(df))]
+        return df
+
+
+class ColumnarStore(DataStore):
+    """ Data files with each column stored as a contiguous array.
+
+    The file starts with `magic` followed by the length of a pickled
+    header describing the columns, then the header itself.  The column
+    data follows, each column aligned to `align` bytes.
+
+    Numeric, boolean and datetime columns are stored as raw arrays that
+    are memory mapped on load, so only the pages holding the requested
+    columns and rows are read from disk.  Other columns (strings,
+    mixed types) and a non-default index are stored pickled and are
+    always loaded in full.
+    """
+
+    name = 'columnar'
+    magic = 'RVBDCOL1'
+    align = 8
+
+    # numpy dtype kinds that are stored as raw arrays
+    array_kinds = 'biufcmM'
+
+    def _save(self, df, path):
+        index = df.index
+        if (isinstance(index, pandas.Int64Index) and index.name is None and
+                (index.values == numpy.arange(len(index))).all()):
+            index = None
+
+        header = {'nrows': len(df),
+                  'columns': [],
+                  'index': None}
+
+        blobs = []
+        offset = 0
+        if index is not None:
+            blob = pickle.dumps(index, pickle.HIGHEST_PROTOCOL)
+            header['index'] = {'kind': 'pickle',
+                               'offset': offset,
+                               'nbytes': len(blob)}
+            blobs.append(blob)
+            offset += self._padded(len(blob))
+
+        for name in df.columns:
+            values = df[name].values
+            if values.dtype.kind in self.array_kinds:
+                blob = numpy.ascontiguousarray(values).tostring()
+                spec = {'kind': 'array', 'dtype': values.dtype.str}
+            else:
+                blob = pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+                spec = {'kind': 'pickle'}
+            spec.update({'name': name,
+                         'offset': offset,
+                         'nbytes': len(blob)})
+            header['columns'].append(spec)
+            blobs.append(blob)
+            offset += self._padded(len(blob))
+
+        header = pickle.dumps(header, pickle.HIGHEST_PROTOCOL)
+        with open(path, 'wb') as f:
+            f.write(self.magic)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.write('\0' * (self._data_start(len(header)) - f.tell()))
+            for blob in blobs:
+                f.write(blob)
+                f.write('\0' * (self._padded(len(blob)) - len(blob)))
+
+    def load(self, path, columns=None, rows=None):
+        with open(path, 'rb') as f:
+            if f.read(len(self.magic)) != self.magic:
+                raise ValueError("%s is not a columnar data file" % path)
+            length, = struct.unpack('<Q', f.read(8))
+            header = pickle.loads(f.read(length))
+            start = self._data_start(length)
+
+            nrows = header['nrows']
+            if rows is None:
+                rows = slice(None)
+            first, last, step = rows.indices(nrows)
+
+            specs = header['columns']
+            if columns is not None:
+                byname = dict((spec['name'], spec) for spec in specs)
+                specs = [byname[c] for c in columns if c in byname]
+
+            data = {}
+            for spec in specs:
+                if spec['kind'] == 'array':
+                    data[spec['name']] = self._map(path, start, spec,
+                                                   first, last, step)
+                else:
+                    f.seek(start + spec['offset'])
+                    values = pickle.loads(f.read(spec['nbytes']))
+                    data[spec['name']] = values[rows]
+
+            if header['index'] is not None:
+                spec = header['index']
+                f.seek(start + spec['offset'])
+                index = pickle.loads(f.read(spec['nbytes']))
+                index = index[rows]
+            else:
+                index = pandas.Index(numpy.arange(nrows)[rows])
+
+        return pandas.DataFrame(data, index=index,
+                                columns=[spec['name'] for spec in specs])
+
+    def _map(self, path, start, spec, first, last, step):
+        # Map only the range of rows covered by the slice
+        dtype = numpy.dtype(spec['dtype'])
+        if len(xrange(first, last, step)) == 0:
+            return numpy.empty(0, dtype=dtype)
+
+        if step > 0:
+            lo, hi, begin = first, last, 0
+        else:
+            lo, hi, begin = last + 1, first + 1, first - last - 1
+
+        values = numpy.memmap(path, dtype=dtype, mode='r', shape=(hi - lo,),
+                              offset=(start + spec['offset'] +
+                                      lo * dtype.itemsize))
+        return values[begin::step]
+
+    def _padded(self, n):
+        return (n + self.align - 1) // self.align * self.align
+
+    def _data_start(self, header_length):
+        return self._padded(len(self.magic) + 8 + header_length)
+
+
+FORMATS = {'pickle': PickleStore,
+           'columnar': ColumnarStore}
+
+
+def create_datastore(name=None):
+    """ Create the data store named by APPS_DATASOURCE['datafile_format'].
+
+    `name` is either one of the names in FORMATS or the dotted path
+    of a DataStore subclass.
+    """
+    if name is None:
+        name = settings.APPS_DATASOURCE.get('datafile_format', 'pickle')
+
+    if name in FORMATS:
+        cls = FORMATS[name]
+    else:
+        module, clsname = name.rsplit('.', 1)
+        cls = getattr(importlib.import_module(module), clsname)
+
+    logger.debug("Using datafile format %s" % cls.__name__)
+    return cls()
+
+
+# Store used to write new data files
+datastore = create_datastore()
+
+
+def save(df, path):
+    """ Save DataFrame `df` to `path` in the configured format. """
+    datastore.save(df, path)
+
+
+def load(path, columns=None, rows=None):
+    """ Load a DataFrame from `path`, see DataStore.load().
+
+    The format of the file is recognized by its magic, so files written
+    before the configured format was changed can still be read.  Files
+    without a known magic are assumed to be pickled.
+    """
+    stores = [datastore] + [cls() for cls in FORMATS.values()
+                            if not isinstance(datastore, cls)]
+
+    with open(path, 'rb') as f:
+        head = f.read(max(len(s.magic or '') for s in stores))
+
+    for store in stores:
+        if store.magic and head.startswith(store.magic):
+            break
+    else:
+        store = PickleStore()
+
+    return store.load(path, columns=columns, rows=rows)
+
+
+def to_lists(df, columns, orient='rows'):
+    """ Convert `columns` of DataFrame `df` to lists of native values.
+
+    Straggling numpy data types may cause problems downstream (json
+    encoding, for example), so values are converted to native ints,
+    floats and bools and nulls to None.  Datetimes are returned as
+    Timestamps.  Columns not in `df` are all None.
+
+    Conversion is done a column at a time, returns a list of rows
+    when `orient` is 'rows' or a list of columns when 'columns'.
+    """
+    if orient not in ('rows', 'columns'):
+        raise ValueError("Invalid orient: %s" % orient)
+
+    lists = [column_to_list(df[name]) if name in df else [None] * len(df)
+             for name in columns]
+
+    if orient == 'columns':
+        return lists
+    return [list(row) for row in zip(*lists)]
+
+
+def column_to_list(series):
+    """ Convert a Series to a list of native values, see `to_lists()`. """
+    values = series.values
+    kind = values.dtype.kind
+
+    if kind in 'biu':
+        # Cannot hold nulls
+        return values.tolist()
+
+    if kind == 'M':
+        result = pandas.DatetimeIndex(values).tolist()
+    elif kind == 'O':
+        result = [v.item() if isinstance(v, numpy.generic) else v
+                  for v in values]
+    else:
+        result = values.tolist()
+
+    for i in numpy.flatnonzero(pandas.isnull(values)):
+        result[i] = None
+    return result
+
+
+class DataCache(object):
+    """ LRU cache of DataFrames loaded from data files.
+
+    Entries are keyed by job handle and hold the complete DataFrame of
+    a data file, up to a total of `max_bytes`.  The arrays of cached
+    DataFrames are made read-only and callers get a shallow copy, so
+    adding columns to the result is fine but modifying values in place
+    raises an error instead of corrupting the cache.
+
+    Each hit checks the modification time and size of the data file so
+    files rewritten or removed by another process are not served stale.
+    Files larger than `max_fraction` of the budget are not cached, they
+    are loaded with only the requested columns and rows instead.
+    """
+
+    max_fraction = 0.25
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def load(self, key, path, columns=None, rows=None):
+        """ Load a DataFrame from `path` via the cache, see `load()`. """
+        st = os.stat(path)
+        stamp = (st.st_mtime, st.st_size)
+
+        df = None
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[0] == stamp:
+                    # Reinsert as the most recently used
+                    self._entries[key] = entry
+                    df = entry[1]
+                    self.hits += 1
+                else:
+                    self.nbytes -= entry[2]
+            if df is None:
+                self.misses += 1
+
+        if df is None:
+            if (not self.max_bytes or
+                    st.st_size > self.max_bytes * self.max_fraction):
+                return load(path, columns=columns, rows=rows)
+
+            df = load(path)
+            self._add(key, stamp, df, max(st.st_size, self._nbytes(df)))
+
+        df = df.copy(deep=False)
+        if columns is not None:
+            df = df[[c for c in columns if c in df]]
+        if rows is not None:
+            df = df.iloc[_clamp_rows(rows, len(df))]
+        return df
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'nbytes': self.nbytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+    def _add(self, key, stamp, df, nbytes):
+        for block in df._data.blocks:
+            block.values.flags.writeable = False
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            self._entries[key] = (stamp, df, nbytes)
+            self.nbytes += nbytes
+
+            while self.nbytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def _nbytes(self, df):
+        return (sum(block.values.nbytes for block in df._data.blocks) +
+                df.index.nbytes)
+
+
+# Cache of recently loaded data files, shared by all jobs
+cache = DataCache(settings.APPS_DATASOURCE.get('data_cache_bytes', 0))
@@ -9,3 +9,8 @@
 class TableComputeSyntheticError(Exception):
     """ Exception raised if something goes wrong with Table.compute_synthetic. """
     pass
+
+
+class WorkerPoolFull(Exception):
+    """ Exception raised when the job worker pool cannot accept more work. """
+    pass
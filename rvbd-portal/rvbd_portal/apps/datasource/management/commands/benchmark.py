@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+
+import time
+import logging
+import datetime
+import optparse
+
+import pytz
+import numpy
+import pandas
+from django.core.management.base import BaseCommand
+
+from rvbd.common.utils import Formatter
+
+from rvbd_portal.apps.datasource import datastore
+from rvbd_portal.apps.datasource.resample import (PandasResampler,
+                                                  EpochResampler)
+
+# not pretty, but pandas insists on warning about
+# some deprecated behavior we really don't care about
+# for this script, so ignore them all
+import warnings
+warnings.filterwarnings("ignore")
+
+
+logger = logging.getLogger(__name__)
+
+
+def itertuples_values(df, columns):
+    """ Row at a time conversion, as Job.values() used to do it. """
+    df = df.where(pandas.notnull(df), None)
+    vals = []
+    for row in df.ix[:, columns].itertuples():
+        vals_row = []
+        for v in row[1:]:
+            if (isinstance(v, numpy.number) or
+                    isinstance(v, numpy.bool_)):
+                v = numpy.asscalar(v)
+            vals_row.append(v)
+        vals.append(vals_row)
+    return vals
+
+
+def daily_business_times(st, et, sb, eb, tz, weekends=False):
+    """ Day at a time business hours, as compute_times() used to do it.
+
+    Each day is localized on its own so DST changes are handled the
+    same way as the vectorized version.  Returns (start, end) pairs.
+    """
+    st = st.astimezone(tz)
+    et = et.astimezone(tz)
+    times = []
+    t = st
+    while t <= et:
+        day = t.replace(tzinfo=None, second=0, microsecond=0)
+        t0 = tz.localize(day.replace(hour=sb.hour, minute=sb.minute))
+        t1 = tz.localize(day.replace(hour=eb.hour, minute=eb.minute))
+        t = t + datetime.timedelta(days=1)
+        if not weekends and t0.weekday() >= 5:
+            continue
+        if et < t0:
+            break
+        t1 = min(t1, et)
+        if t1 < st:
+            continue
+        t0 = max(t0, st)
+        times.append((t0, t1))
+    return times
+
+
+class Command(BaseCommand):
+    args = None
+    help = 'Benchmark job data processing'
+
+    tests = ['values', 'resample', 'business_hours']
+
+    # Default table sizes for each test, years for business_hours
+    default_rows = {'values': '10000,100000',
+                    'resample': '100000,1000000',
+                    'business_hours': '1,2,3,4,5'}
+
+    def create_parser(self, prog_name, subcommand):
+        """ Override super version to include special option grouping
+        """
+        parser = super(Command, self).create_parser(prog_name, subcommand)
+        group = optparse.OptionGroup(parser, "Benchmark Help",
+                                     "Options for the data benchmark")
+        group.add_option('--test',
+                         action='store',
+                         dest='test',
+                         default='values',
+                         help='Benchmark to run: %s' % ', '.join(self.tests))
+        group.add_option('--rows',
+                         action='store',
+                         dest='rows',
+                         default=None,
+                         help='Comma separated list of table sizes to test')
+        group.add_option('--columns',
+                         action='store',
+                         dest='columns',
+                         type='int',
+                         default=20,
+                         help='Number of columns of each table')
+        group.add_option('--repeat',
+                         action='store',
+                         dest='repeat',
+                         type='int',
+                         default=3,
+                         help='Number of runs per test, the best is reported')
+        parser.add_option_group(group)
+
+        return parser
+
+    def make_frame(self, nrows, ncolumns):
+        """ Return a DataFrame with a time, a key and numeric columns. """
+        data = {'time': pandas.date_range('2013-01-01', periods=nrows,
+                                          freq='S'),
+                'key': ['host-%d' % (i % 1000) for i in xrange(nrows)]}
+        for i in range(ncolumns - 2):
+            if i % 2:
+                col = numpy.random.randint(0, 1000000, nrows)
+            else:
+                col = numpy.random.rand(nrows) * 1000
+                col[::10] = numpy.nan
+            data['metric%d' % i] = col
+
+        columns = ['time', 'key'] + ['metric%d' % i
+                                     for i in range(ncolumns - 2)]
+        return pandas.DataFrame(data, columns=columns), columns
+
+    def timeit(self, func, repeat):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            result = func()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best, result
+
+    def handle(self, *args, **options):
+        """ Main command handler. """
+        if options['test'] not in self.tests:
+            self.stderr.write("Unknown test '%s', choose from: %s\n" %
+                              (options['test'], ', '.join(self.tests)))
+            return
+
+        if options['rows'] is None:
+            options['rows'] = self.default_rows[options['test']]
+
+        getattr(self, 'test_%s' % options['test'])(options)
+
+    def test_values(self, options):
+        """ Compare row at a time and column at a time Job.values(). """
+        results = []
+        for nrows in [int(n) for n in options['rows'].split(',')]:
+            df, columns = self.make_frame(nrows, options['columns'])
+
+            old, expected = self.timeit(
+                lambda: itertuples_values(df, columns), options['repeat'])
+            new, actual = self.timeit(
+                lambda: datastore.to_lists(df, columns), options['repeat'])
+            bycol, _ = self.timeit(
+                lambda: datastore.to_lists(df, columns, orient='columns'),
+                options['repeat'])
+
+            if actual != expected:
+                self.stderr.write("Results differ for %d rows\n" % nrows)
+
+            results.append([nrows, len(columns), '%.3f' % old, '%.3f' % new,
+                            '%.3f' % bycol, '%.1fx' % (old / new)])
+
+        Formatter.print_table(results, ['Rows', 'Columns', 'itertuples (s)',
+                                        'rows (s)', 'columns (s)', 'Speedup'])
+
+    def test_resample(self, options):
+        """ Compare the pandas and epoch resample engines. """
+        results = []
+        for nrows in [int(n) for n in options['rows'].split(',')]:
+            df, columns = self.make_frame(nrows, options['columns'])
+            df = df.drop(['key'], axis=1)
+            how = dict((c, ['sum', 'mean', 'max', 'min'][i % 4])
+                       for i, c in enumerate(df.columns) if c != 'time')
+
+            old, expected = self.timeit(
+                lambda: PandasResampler().resample(df, 'time', 60, how),
+                options['repeat'])
+            new, actual = self.timeit(
+                lambda: EpochResampler().resample(df, 'time', 60, how),
+                options['repeat'])
+
+            expected = expected.ix[:, actual.columns].ix[:, 1:]
+            actual = actual.ix[:, 1:]
+            if not numpy.allclose(numpy.nan_to_num(expected.values),
+                                  numpy.nan_to_num(actual.values)):
+                self.stderr.write("Results differ for %d rows\n" % nrows)
+
+            results.append([nrows, len(df.columns), '%.3f' % old,
+                            '%.3f' % new, '%.1fx' % (old / new)])
+
+        Formatter.print_table(results, ['Rows', 'Columns', 'pandas (s)',
+                                        'epoch (s)', 'Speedup'])
+
+    def test_business_hours(self, options):
+        """ Compare day at a time and vectorized business hours. """
+        try:
+            from rvbd_portal_business_hours.libs.business_hours import \
+                business_intervals
+        except ImportError:
+            self.stderr.write("The business hours plugin is not installed\n")
+            return
+
+        tz = pytz.timezone('US/Eastern')
+        sb = datetime.time(8, 0)
+        eb = datetime.time(17, 0)
+        st = tz.localize(datetime.datetime(2013, 1, 1, 12, 30))
+
+        results = []
+        for years in [int(n) for n in options['rows'].split(',')]:
+            et = st + datetime.timedelta(days=365 * years)
+
+            old, expected = self.timeit(
+                lambda: daily_business_times(st, et, sb, eb, tz),
+                options['repeat'])
+            new, actual = self.timeit(
+                lambda: business_intervals(st, et, sb, eb, tz),
+                options['repeat'])
+
+            # The old version kept empty intervals at the range ends
+            expected = [(t0, t1) for t0, t1 in expected if t1 > t0]
+            if ([(t0.astimezone(pytz.utc).replace(tzinfo=None),
+                  t1.astimezone(pytz.utc).replace(tzinfo=None))
+                 for t0, t1 in expected] !=
+                    [(t0.to_pydatetime(), t1.to_pydatetime())
+                     for t0, t1 in zip(actual['starttime'],
+                                       actual['endtime'])]):
+                self.stderr.write("Results differ for %d years\n" % years)
+
+            results.append([years, len(actual), '%.4f' % old, '%.4f' % new,
+                            '%.1fx' % (old / new)])
+
+        Formatter.print_table(results, ['Years', 'Days', 'daily (s)',
+                                        'vectorized (s)', 'Speedup'])
@@ -7,6 +7,7 @@
 
 import os
 import sys
+import glob
 import logging
 import traceback
 import threading
@@ -20,19 +21,26 @@ import datetime
 import string
 import pytz
 import pandas
-import numpy
 import copy
 
 from django.db import models
 from django.db.models import Max
 from django.db import transaction
 from django.db.models import F
-from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_delete, post_save, post_delete
 from django.dispatch import receiver
 from rvbd.common.utils import DictObject
 from rvbd.common import timedelta_total_seconds
 
 from rvbd_portal.apps.datasource.exceptions import *
+from rvbd_portal.apps.datasource import datastore, timecache
+from rvbd_portal.apps.datasource.resample import resampler
+from rvbd_portal.apps.datasource.workerpool import WorkerPool
+from rvbd_portal.apps.datasource.notify import notifier, definitions_version
+# Forks the process pool, if any, before threads are started
+from rvbd_portal.apps.datasource.processpool import process_pool
+from rvbd_portal.apps.datasource.scheduler import (Deferred, JobScheduler,
+                                                   take_plan)
 from rvbd_portal.libs.fields import (PickledObjectField, FunctionField,
                                      SeparatedValuesField)
 from django.conf import settings
@@ -51,6 +59,28 @@ else:
 
 age_jobs_last_run = 0
 
+try:
+    import fcntl
+except ImportError:
+    # No file locking, HandleLock does nothing
+    fcntl = None
+
+# Ids of the parent jobs queued or running in this process by handle,
+# see Job._create()
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Columns of each table by table id as (version, columns), see
+# Table.get_columns() and _columns_version()
+_column_cache = {}
+
+# Names of the columns of each table by table id as (version, names),
+# see Table.column_signature()
+_column_signatures = {}
+
+# Number of changes to the columns of each table in this process
+_column_changes = {}
+
 
 class LocalLock(object):
     def __enter__(self):
@@ -63,6 +93,31 @@ class LocalLock(object):
         return False
 
 
+class HandleLock(object):
+    """ Exclusive lock on a job handle, shared by all processes.
+
+    Held while a job runs its query.  A job with the same handle
+    started in another process waits for the lock and then picks up
+    the result rather than running the same query again.
+    """
+    def __init__(self, handle):
+        self.path = os.path.join(settings.DATA_CACHE, "job-%s.lock" % handle)
+        self.f = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.f = open(self.path, 'a')
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.f is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+            self.f.close()
+            self.f = None
+        return False
+
+
 class TableField(models.Model):
     """
     Defines a single field associated with a table.
@@ -241,13 +296,31 @@ class Table(models.Model):
             True means only key columns, False means
             only non-key columns
 
+        The columns of each table are cached, the cache is updated
+        when columns are saved or deleted.
+
         """
 
+        version = _columns_version(self.id)
+        cached = _column_cache.get(self.id)
+        if cached is not None and cached[0] == version:
+            columns = cached[1]
+        else:
+            columns = list(Column.objects.filter(table=self)
+                           .order_by('position'))
+            # Columns changed while loading may be missing, leave
+            # those to the next caller
+            if _columns_version(self.id) == version:
+                _column_cache[self.id] = (version, columns)
+
+        # Compare ids to avoid loading the ephemeral job of each column
+        ephemeral_id = getattr(ephemeral, 'id', ephemeral)
+
         filtered = []
-        for c in Column.objects.filter(table=self).order_by('position'):
+        for c in columns:
             if synthetic is not None and c.synthetic != synthetic:
                 continue
-            if c.ephemeral is not None and c.ephemeral != ephemeral:
+            if c.ephemeral_id is not None and c.ephemeral_id != ephemeral_id:
                 continue
             if iskey is not None and c.iskey != iskey:
                 continue
@@ -255,6 +328,29 @@ class Table(models.Model):
 
         return filtered
 
+    def column_signature(self):
+        """ Return a string naming the (non-ephemeral) columns of this table.
+        """
+        version = _columns_version(self.id)
+        cached = _column_signatures.get(self.id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        signature = '.'.join([c.name for c in self.get_columns()])
+        if _columns_version(self.id) == version:
+            _column_signatures[self.id] = (version, signature)
+        return signature
+
+    @classmethod
+    def clear_column_cache(cls):
+        """ Drop cached columns of all tables in every process.
+
+        Needed when tables are recreated, since ids may be reused.
+        """
+        definitions_version.increment()
+        _column_cache.clear()
+        _column_signatures.clear()
+
     def copy_columns(self, table, columns=None, except_columns=None):
         """ Copy the columns from `table` into this table.
 
@@ -272,6 +368,8 @@ class Table(models.Model):
             if except_columns is not None and c.name in except_columns:
                 continue
             issortcol = (c == c.table.sortcol)
+            # Columns are shared via the column cache, save a copy
+            c = copy.copy(c)
             c.pk = None
             c.table = self
             c.position = pos
@@ -303,33 +401,13 @@ class Table(models.Model):
 
         def compute(df, syncols):
             #logger.debug("Compute: syncol = %s" % ([c.name for c in syncols]))
-            for syncol in syncols:
-                expr = syncol.compute_expression
-                g = tokenize.generate_tokens(StringIO(expr).readline)
-                newexpr = ""
-                getvalue = False
-                getclose = False
-                for ttype, tvalue, _, _, _ in g:
-                    if getvalue:
-                        if ttype != tokenize.NAME:
-                            msg = "Invalid syntax, expected {name}: %s" % tvalue
-                            raise ValueError(msg)
-                        elif tvalue not in all_col_names:
-                            raise ValueError("Invalid column name: %s" % tvalue)
-                        newexpr += "df['%s']" % tvalue
-                        getclose = True
-                        getvalue = False
-                    elif getclose:
-                        if ttype != tokenize.OP and tvalue != "}":
-                            msg = "Invalid syntax, expected {name}: %s" % tvalue
-                            raise ValueError(msg)
-                        getclose = False
-                    elif ttype == tokenize.OP and tvalue == "{":
-                        getvalue = True
-                    else:
-                        newexpr += tvalue
+            for syncol in synthetic_order(syncols):
+                code, names = compile_expression(syncol.compute_expression)
+                for name in names:
+                    if name not in all_col_names:
+                        raise ValueError("Invalid column name: %s" % name)
 
-                df[syncol.name] = eval(newexpr)
+                df[syncol.name] = eval(code, globals(), {'df': df})
 
         # 1. Compute synthetic columns where post_resample is False
         compute(df, [col for col in all_columns if (col.synthetic and
@@ -361,7 +439,6 @@ class Table(models.Model):
                     continue
                 how[k] = colmap[k].resample_operation
 
-            indexed = df.set_index(timecol)
             if 'resample_resolution' in job.criteria:
                 resolution = job.criteria.resample_resolution
             else:
@@ -374,10 +451,7 @@ class Table(models.Model):
                          "less than 1 second") % self))
 
             logger.debug('%s: resampling to %ss' % (self, int(resolution)))
-            indexed.save('/tmp/indexed.pd')
-            resampled = indexed.resample('%ss' % int(resolution), how,
-                                         convention='end').reset_index()
-            df = resampled
+            df = resampler.resample(df, timecol, resolution, how)
 
         # 3. Compute remaining synthetic columns (post_resample is True)
         compute(df, [c for c in all_columns
@@ -386,6 +460,94 @@ class Table(models.Model):
         return df
 
 
+# Compiled synthetic column expressions, by expression
+_compiled_expressions = {}
+
+# Order to compute sets of synthetic columns in, see synthetic_order()
+_synthetic_orders = {}
+
+
+def compile_expression(expr):
+    """ Compile a synthetic column `compute_expression`.
+
+    References to other columns are written as {name} and are replaced
+    by df['name'] in the compiled expression.  Returns a tuple of the
+    code object, to be evaluated with `df` in its locals, and the set of
+    referenced column names.  Results are cached by expression, so each
+    expression is only parsed once per process.
+
+    """
+    try:
+        return _compiled_expressions[expr]
+    except KeyError:
+        pass
+
+    g = tokenize.generate_tokens(StringIO(expr).readline)
+    newexpr = ""
+    names = set()
+    getvalue = False
+    getclose = False
+    for ttype, tvalue, _, _, _ in g:
+        if getvalue:
+            if ttype != tokenize.NAME:
+                msg = "Invalid syntax, expected {name}: %s" % tvalue
+                raise ValueError(msg)
+            newexpr += "df['%s']" % tvalue
+            names.add(tvalue)
+            getclose = True
+            getvalue = False
+        elif getclose:
+            if ttype != tokenize.OP and tvalue != "}":
+                msg = "Invalid syntax, expected {name}: %s" % tvalue
+                raise ValueError(msg)
+            getclose = False
+        elif ttype == tokenize.OP and tvalue == "{":
+            getvalue = True
+        else:
+            newexpr += tvalue
+
+    compiled = (compile(newexpr, '<compute_expression>', 'eval'),
+                frozenset(names))
+    _compiled_expressions[expr] = compiled
+    return compiled
+
+
+def synthetic_order(syncols):
+    """ Return `syncols` in an order such that columns are computed after
+    the other synthetic columns in `syncols` they reference.
+
+    Columns are otherwise kept in the given order.  The order is cached
+    by column names and expressions.
+
+    """
+    key = tuple((c.name, c.compute_expression) for c in syncols)
+    try:
+        order = _synthetic_orders[key]
+    except KeyError:
+        pending = [(i, c.name,
+                    compile_expression(c.compute_expression)[1] - set([c.name]))
+                   for i, c in enumerate(syncols)]
+        group = set(c.name for c in syncols)
+        done = set()
+        order = []
+        while pending:
+            for entry in pending:
+                i, name, deps = entry
+                if not (deps & group) - done:
+                    break
+            else:
+                raise ValueError("Circular dependency between synthetic "
+                                 "columns: %s" %
+                                 ', '.join(e[1] for e in pending))
+            pending.remove(entry)
+            order.append(i)
+            done.add(name)
+
+        _synthetic_orders[key] = order
+
+    return [syncols[i] for i in order]
+
+
 class Column(models.Model):
 
     table = models.ForeignKey(Table)
@@ -435,6 +597,10 @@ class Column(models.Model):
 
         c = Column(table=table, name=name, label=label, datatype=datatype,
                    units=units, iskey=iskey, options=options, **kwargs)
+        if c.synthetic:
+            # Catch errors in the expression now rather than at run time
+            compile_expression(c.compute_expression)
+
         posmax = Column.objects.filter(table=table).aggregate(Max('position'))
         c.position = (posmax['position__max'] or 0) + 1
         c.save()
@@ -536,6 +702,41 @@ class Criteria(DictObject):
         self.endtime = endtime
 
 
+def canonical_criteria(criteria):
+    """ Return a string representing `criteria` for computing handles.
+
+    Equivalent criteria give the same string: keys are sorted,
+    datetimes are converted to epoch seconds with
+    timecache.epoch_seconds() (naive datetimes are taken as local
+    time), timedeltas to seconds and integral floats to ints.
+    Private keys (starting with '_') are skipped.
+    """
+    return ','.join(['%s:%s' % (k, _canonical_value(criteria[k]))
+                     for k in sorted(criteria.keys())
+                     if not str(k).startswith('_')])
+
+
+def _canonical_value(value):
+    if isinstance(value, datetime.datetime):
+        value = timecache.epoch_seconds(value)
+    elif isinstance(value, datetime.timedelta):
+        value = timedelta_total_seconds(value)
+
+    if isinstance(value, bool):
+        return str(value)
+    elif isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+    elif isinstance(value, dict):
+        return '{%s}' % canonical_criteria(value)
+    elif isinstance(value, (list, tuple)):
+        return '[%s]' % ','.join([_canonical_value(v) for v in value])
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
 class Job(models.Model):
 
     # Timestamp when the job was created
@@ -587,6 +788,10 @@ class Job(models.Model):
     # While RUNNING, time remaining
     remaining = models.IntegerField(default=None, null=True)
 
+    # While RUNNING, the number of partial results published so far,
+    # see publish_partial()
+    partial = models.IntegerField(default=0)
+
     def __unicode__(self):
         return "<Job %s (%8.8s) - t%s>" % (self.id, self.handle, self.table.id)
 
@@ -597,10 +802,9 @@ class Job(models.Model):
         """ Refresh dynamic job parameters from the database. """
         job = Job.objects.get(pk=self.pk)
         for k in ['status', 'message', 'progress', 'remaining',
-                  'actual_criteria', 'touched', 'refcount']:
+                  'actual_criteria', 'touched', 'refcount', 'partial']:
             setattr(self, k, getattr(job, k))
 
-    @transaction.commit_on_success
     def safe_update(self, **kwargs):
         """ Update the job with the passed dictionary in a database safe way.
 
@@ -614,6 +818,14 @@ class Job(models.Model):
         if kwargs is None:
             return
 
+        self._safe_update(**kwargs)
+
+        # Wake up anyone waiting on this job or its children, only
+        # once the update is committed so they see the new values
+        notifier.notify(self.notify_key())
+
+    @transaction.commit_on_success
+    def _safe_update(self, **kwargs):
         with LocalLock():
             logger.debug("%s safe_update %s" % (self, kwargs))
             Job.objects.filter(pk=self.pk).update(**kwargs)
@@ -626,7 +838,7 @@ class Job(models.Model):
                 child_kwargs = {}
                 for k, v in kwargs.iteritems():
                     if k in ['status', 'message', 'progress', 'remaining',
-                             'actual_criteria']:
+                             'actual_criteria', 'partial']:
                         child_kwargs[k] = v
                 # There should be no recursion, so a direct update to the
                 # database is possible.  (If recursion, would need to call
@@ -635,78 +847,132 @@ class Job(models.Model):
 
     @classmethod
     def create(cls, table, criteria):
+        return cls.create_batch([(table, criteria)])[0]
+
+    @classmethod
+    def create_batch(cls, requests):
+        """ Create a job for each (table, criteria) pair in `requests`.
 
+        All jobs are created in a single transaction.  Requests that
+        resolve to the same handle share one job, the later ones are
+        linked to the first as children.  Returns the list of jobs in
+        the order of `requests`.
+        """
         with LocalLock():
             with transaction.commit_on_success():
-                # Grab a lock on the row associated with the table
-                table = Table.objects.select_for_update().get(id=table.id)
-
-                # Lockdown start/endtimes
-                try:
-                    criteria.compute_times()
-                except ValueError:
-                    # Ignore errors, this table may not have start/end times
-                    pass
-
-                # Compute the handle -- this will take into account
-                # cacheability
-                handle = Job._compute_handle(table, criteria)
-
-                # Look for another job by the same handle in any state
-                # except ERROR
-                if not criteria.ignore_cache:
-                    parents = (Job.objects
-                               .select_for_update()
-                               .filter(status__in=[Job.NEW,
-                                                   Job.COMPLETE,
-                                                   Job.RUNNING],
-                                       handle=handle,
-                                       ischild=False)
-                               .order_by('created'))
-                else:
-                    parents = None
-
-                if parents is not None and len(parents) > 0:
-                    parent = parents[0]
+                # Grab a lock on the rows associated with the tables,
+                # always in the same order
+                table_ids = sorted(set(table.id for table, _ in requests))
+                tables = dict((table.id, table) for table in
+                              Table.objects.select_for_update()
+                              .filter(id__in=table_ids).order_by('id'))
 
-                    job = Job(table=table,
-                              criteria=criteria,
-                              actual_criteria=parent.actual_criteria,
-                              status=parent.status,
-                              handle=handle,
-                              parent=parent,
-                              ischild=True,
-                              progress=parent.progress,
-                              remaining=parent.remaining,
-                              message='')
-                    job.save()
-
-                    parent.reference("Link from job %s" % job)
-                    now = datetime.datetime.now(tz=pytz.utc)
-                    parent.safe_update(touched=now)
-
-                    logger.info("%s: New job for table %s, linked to parent %s"
-                                % (job, table.name, parent))
-                else:
-                    job = Job(table=table,
-                              criteria=criteria,
-                              status=Job.NEW,
-                              handle=handle,
-                              parent=None,
-                              ischild=False,
-                              progress=0,
-                              remaining=-1,
-                              message='')
-                    job.save()
-                    logger.info("%s: New job for table %s" % (job, table.name))
-
-                logger.debug("%s: criteria = %s" % (job, criteria))
+                jobs = [cls._create(tables[table.id], criteria)
+                        for table, criteria in requests]
 
             # Flush old jobs
             Job.age_jobs()
 
+        return jobs
+
+    @classmethod
+    def _create(cls, table, criteria):
+        # Lockdown start/endtimes
+        try:
+            criteria.compute_times()
+        except ValueError:
+            # Ignore errors, this table may not have start/end times
+            pass
+
+        # Compute the handle -- this will take into account
+        # cacheability
+        handle = Job._compute_handle(table, criteria)
+
+        # Look for another job by the same handle in any state
+        # except ERROR, first among those running in this process
+        parent = None
+        if not criteria.ignore_cache:
+            parent = cls._inflight_parent(handle)
+            if parent is None:
+                parents = (Job.objects
+                           .select_for_update()
+                           .filter(status__in=[Job.NEW,
+                                               Job.COMPLETE,
+                                               Job.RUNNING],
+                                   handle=handle,
+                                   ischild=False)
+                           .order_by('created'))
+                if len(parents) > 0:
+                    parent = parents[0]
+
+        if parent is not None:
+            job = Job(table=table,
+                      criteria=criteria,
+                      actual_criteria=parent.actual_criteria,
+                      status=parent.status,
+                      handle=handle,
+                      parent=parent,
+                      ischild=True,
+                      progress=parent.progress,
+                      remaining=parent.remaining,
+                      message='')
+            job.save()
+
+            parent.reference("Link from job %s" % job)
+            now = datetime.datetime.now(tz=pytz.utc)
+            parent.safe_update(touched=now)
+
+            logger.info("%s: New job for table %s, linked to parent %s"
+                        % (job, table.name, parent))
+        else:
+            job = Job(table=table,
+                      criteria=criteria,
+                      status=Job.NEW,
+                      handle=handle,
+                      parent=None,
+                      ischild=False,
+                      progress=0,
+                      remaining=-1,
+                      message='')
+            job.save()
+            logger.info("%s: New job for table %s" % (job, table.name))
+
+            if table.cacheable and not criteria.ignore_cache:
+                with _inflight_lock:
+                    _inflight[handle] = job.id
+
+        logger.debug("%s: criteria = %s" % (job, criteria))
+
         return job
 
+    @classmethod
+    def _inflight_parent(cls, handle):
+        """ Return the job queued or running in this process for `handle`.
+
+        Returns None if there is none, or if that job has since failed
+        or been deleted.
+        """
+        with _inflight_lock:
+            job_id = _inflight.get(handle)
+        if job_id is None:
+            return None
+
+        try:
+            parent = Job.objects.get(id=job_id)
+        except Job.DoesNotExist:
+            parent = None
+
+        if parent is None or parent.status == Job.ERROR:
+            cls._inflight_done(handle, job_id)
+            return None
+        return parent
+
+    @classmethod
+    def _inflight_done(cls, handle, job_id):
+        with _inflight_lock:
+            if _inflight.get(handle) == job_id:
+                del _inflight[handle]
+
     @classmethod
     def _compute_handle(cls, table, criteria):
         h = hashlib.md5()
@@ -725,15 +991,12 @@ class Job(models.Model):
             #
             # May want to dig in to this further and make sure this doesn't
             # pick up cache files when we don't want it to
-            h.update('.'.join([c.name for c in
-                               table.get_columns()]))
+            h.update(table.column_signature())
 
             if table.criteria_handle_func:
                 criteria = table.criteria_handle_func.function(criteria)
 
-            for k, v in criteria.iteritems():
-                #logger.debug("Updating hash from %s -> %s" % (k,v))
-                h.update('%s:%s' % (k, v))
+            h.update(canonical_criteria(criteria))
         else:
             # Table is not cacheable, instead use current time plus a random
             # value just to get a unique hash
@@ -754,6 +1017,47 @@ class Job(models.Model):
         #logger.debug("%s: dereference(%s) @ %d" %
         #             (self, message, Job.objects.get(pk=pk).refcount))
 
+    def notify_key(self):
+        """ Return the id used to wait for changes to this job.
+
+        Child jobs only change when their parent changes, so they
+        share the parent's key.
+
+        """
+        return self.parent_id if self.ischild else self.id
+
+    def wait(self, timeout=None, progress=None, partial=None):
+        """ Block until this job is done or `timeout` seconds pass.
+
+        If `progress` is given, also return as soon as the progress
+        of the job differs from that value, likewise for the number
+        of partial results and `partial`.
+
+        Returns True if the job is done or its progress changed.
+
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        key = self.notify_key()
+        while True:
+            versions = notifier.versions([key])
+            if self.done():
+                return True
+            if progress is not None and self.progress != progress:
+                return True
+            if partial is not None and self.partial != partial:
+                return True
+
+            interval = notifier.fallback_interval
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                interval = min(interval, remaining)
+
+            notifier.wait(versions, interval)
+
     def get_columns(self, ephemeral=None, **kwargs):
         """ Return columns assocated with the table for the job.
 
@@ -762,7 +1066,7 @@ class Job(models.Model):
 
         """
         if ephemeral is None:
-            kwargs['ephemeral'] = self.parent or self
+            kwargs['ephemeral'] = self.parent_id or self.id
         return self.table.get_columns(**kwargs)
 
     def json(self, data=None):
@@ -773,6 +1077,7 @@ class Job(models.Model):
                 'remaining': self.remaining,
                 'status': self.status,
                 'message': self.message,
+                'partial': self.partial,
                 'data': data}
 
     def combine_filterexprs(self, joinstr="and", exprs=None):
@@ -818,7 +1123,11 @@ class Job(models.Model):
 
             # Create an worker to do the work
             worker = Worker(self, queryclass)
-            worker.start()
+            try:
+                worker.start()
+            except WorkerPoolFull as e:
+                Job._inflight_done(self.handle, self.id)
+                self.mark_error("Server is busy, try again later: %s" % e)
 
     def mark_error(self, message):
         logger.warning("%s failed: %s" % (self, message))
@@ -842,8 +1151,18 @@ class Job(models.Model):
         """ Return the data file for this job. """
         return os.path.join(settings.DATA_CACHE, "job-%s.data" % self.handle)
 
-    def data(self):
-        """ Returns a pandas.DataFrame of data, or None if not available. """
+    def data(self, columns=None, rows=None):
+        """ Returns a pandas.DataFrame of data, or None if not available.
+
+        Pass a list of column names as `columns` and/or a slice as `rows`
+        to load only part of the data.  Columns that are not in the data
+        are left out of the result.
+
+        The data may be shared with other callers through the data cache,
+        so its values are read-only.  Use `copy()` on the result before
+        modifying existing columns in place.
+
+        """
 
         with transaction.commit_on_success():
             self.refresh()
@@ -857,7 +1176,8 @@ class Job(models.Model):
                 logger.debug("%s looking for data file: %s" %
                              (str(self), self.datafile()))
                 if os.path.exists(self.datafile()):
-                    df = pandas.load(self.datafile())
+                    df = datastore.cache.load(self.handle, self.datafile(),
+                                              columns=columns, rows=rows)
                     logger.debug("%s data loaded %d rows from file: %s" %
                                  (str(self), len(df), self.datafile()))
                 else:
@@ -876,34 +1196,93 @@ class Job(models.Model):
 
             return df
 
-    def values(self):
-        """ Return data as a list of lists. """
+    def publish_partial(self, data, replace=False):
+        """ Make `data` available as part of the result while running.
 
-        df = self.data()
-        if df is not None:
-            # Replace NaN with None
-            df = df.where(pandas.notnull(df), None)
-
-            # Extract tha values in the right order
-            all_columns = self.get_columns()
-            all_col_names = [c.name for c in all_columns]
-
-            # Straggling numpy data types may cause problems
-            # downstream (json encoding, for example), so strip
-            # things down to just native ints and floats
-            vals = []
-            for row in df.ix[:, all_col_names].itertuples():
-                vals_row = []
-                for v in row[1:]:
-                    if (isinstance(v, numpy.number) or
-                            isinstance(v, numpy.bool_)):
-                        v = numpy.asscalar(v)
-                    vals_row.append(v)
-                vals.append(vals_row)
+        Called by queries with the rows they have so far, as a list or
+        DataFrame like TableQuery.data.  Each call adds `data` to the
+        partial result, or with `replace` replaces what was published
+        before, for example an updated top N.  The final result still
+        has to be set as TableQuery.data.
+        """
+        if isinstance(data, list):
+            columns = [col.name for col in self.get_columns(synthetic=False)]
+            data = pandas.DataFrame(data, columns=columns)
+        fix_dataframe(self, data)
+        data = self.table.compute_synthetic(self, data)
+
+        seq = self.partial + 1
+        path = os.path.join(settings.DATA_CACHE, "job-%s.part-%06d%s.data" %
+                            (self.handle, seq, 'r' if replace else ''))
+        datastore.save(data, path)
+        if replace:
+            self.clear_partial(before=path)
+
+        self.safe_update(partial=seq)
+
+    def _partial_paths(self):
+        return sorted(glob.glob(os.path.join(
+            settings.DATA_CACHE, "job-%s.part-*.data" % self.handle)))
+
+    def partial_files(self):
+        """ Return the data files of the current partial result. """
+        paths = self._partial_paths()
+
+        # Start from the last chunk that replaced the earlier ones
+        for i in range(len(paths) - 1, 0, -1):
+            if paths[i].endswith('r.data'):
+                return paths[i:]
+        return paths
+
+    def partial_data(self, columns=None, rows=None):
+        """ Return the partial result as a DataFrame, None if there is none.
+
+        `columns` and `rows` are as for data().
+        """
+        dfs = []
+        for path in self.partial_files():
+            try:
+                dfs.append(datastore.load(path, columns=columns))
+            except (IOError, OSError, EOFError):
+                # Replaced or completed in the meantime
+                continue
+        if not dfs:
+            return None
 
-        else:
-            vals = []
-        return vals
+        df = pandas.concat(dfs, ignore_index=True)
+        if rows is not None:
+            df = df[rows]
+        return df
+
+    def clear_partial(self, before=None):
+        """ Remove the partial result, or only the files before `before`. """
+        for path in self._partial_paths():
+            if before is not None and path >= before:
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def values(self, columns=None, rows=None, orient='rows'):
+        """ Return data as a list of lists.
+
+        `columns` is a list of column names to return, the default is
+        all columns of the table.  `rows` is an optional slice of rows.
+
+        With `orient` of 'rows' (default) each list is a row, with
+        'columns' each list is a column.
+
+        """
+
+        if columns is None:
+            columns = [c.name for c in self.get_columns()]
+
+        df = self.data(columns=columns, rows=rows)
+        if df is None:
+            return []
+
+        return datastore.to_lists(df, columns, orient=orient)
 
     @classmethod
     def age_jobs(cls, old=None, ancient=None, force=False):
@@ -966,20 +1345,101 @@ class Job(models.Model):
         return self.status == Job.COMPLETE or self.status == Job.ERROR
 
 
+class PartialJob(object):
+    """ Stand-in for a running job that reads its partial result.
+
+    Lets widgets process what a job has published so far with
+    Job.publish_partial() the same way as the full result.
+    """
+
+    def __init__(self, job):
+        self._job = job
+
+    def __getattr__(self, name):
+        return getattr(self._job, name)
+
+    def __unicode__(self):
+        return "<PartialJob %s>" % self._job.id
+
+    @property
+    def actual_criteria(self):
+        return self._job.actual_criteria or self._job.criteria
+
+    def data(self, columns=None, rows=None):
+        return self._job.partial_data(columns=columns, rows=rows)
+
+    def values(self, columns=None, rows=None, orient='rows'):
+        if columns is None:
+            columns = [c.name for c in self.get_columns()]
+
+        df = self.data(columns=columns, rows=rows)
+        if df is None:
+            return []
+
+        return datastore.to_lists(df, columns, orient=orient)
+
+
+@receiver(post_save, sender=Column)
+@receiver(post_delete, sender=Column)
+def _column_changed(sender, instance, **kwargs):
+    """ Drop cached columns of the table of a changed column. """
+    _column_changes[instance.table_id] = (
+        _column_changes.get(instance.table_id, 0) + 1)
+    _column_cache.pop(instance.table_id, None)
+    _column_signatures.pop(instance.table_id, None)
+
+
+def _columns_version(table_id):
+    """ Return the version of the cached columns of `table_id`.
+
+    Combines the definitions version shared by all processes, bumped
+    when tables are reloaded, and the changes to the table's columns
+    made in this process.
+    """
+    return (definitions_version.value(), _column_changes.get(table_id, 0))
+
+
 @receiver(pre_delete, sender=Job)
 def _my_job_delete(sender, instance, **kwargs):
     """ Clean up jobs when deleting. """
+    notifier.forget(instance.id)
+
+    if instance.parent is None and instance.partial:
+        # Deleted while still running
+        instance.clear_partial()
+
     # if a job has a parent, just deref, don't delete the datafile since
     # that will remove it from the parent as well
     if instance.parent is not None:
         instance.parent.dereference(str(instance))
-    elif instance.datafile() and os.path.exists(instance.datafile()):
+
+
+@receiver(post_delete, sender=Job)
+def _my_job_deleted(sender, instance, **kwargs):
+    """ Remove the files of a deleted job unless another job uses them.
+
+    Done after the delete, since pre_delete is sent for all jobs of a
+    queryset before any is deleted, so jobs with the same handle would
+    each see the other and keep the files.
+    """
+    if instance.parent_id is not None:
+        return
+
+    if Job.objects.filter(handle=instance.handle, ischild=False).exists():
+        # Another job with the same handle, maybe in a different process,
+        # still uses the files
+        return
+
+    datastore.cache.invalidate(instance.handle)
+    for path in (instance.datafile(), HandleLock(instance.handle).path):
+        if not os.path.exists(path):
+            continue
         try:
-            os.unlink(instance.datafile())
+            os.unlink(path)
         except OSError:
             # permissions issues, perhaps
             logger.error('OSError occurred when attempting to delete '
-                         'job datafile: %s' % instance.datafile())
+                         'job file: %s' % path)
 
 
 class AsyncWorker(threading.Thread):
@@ -1026,72 +1486,108 @@ class SyncWorker(object):
     def start(self):
         self.do_run()
 
+
+class PoolWorker(object):
+    """ Run the job on a thread from the shared bounded worker pool. """
+
+    # Jobs started from within another job (dependent jobs of an
+    # analysis table, for example) are run ahead of new top level jobs
+    # so that work already in progress completes first
+    PRIORITY_NESTED = 0
+    PRIORITY_DEFAULT = 10
+
+    def __init__(self, job, queryclass):
+        self.job = job
+        self.queryclass = queryclass
+
+        logger.info("%s created" % self)
+        job.reference("PoolWorker created")
+
+    def __unicode__(self):
+        return "<PoolWorker %s>" % (self.job)
+
+    def __str__(self):
+        return "<PoolWorker %s>" % (self.job)
+
+    def __repr__(self):
+        return unicode(self)
+
+    def start(self):
+        if worker_pool.in_worker():
+            priority = self.PRIORITY_NESTED
+        else:
+            priority = self.PRIORITY_DEFAULT
+
+        try:
+            worker_pool.submit(self.do_run, priority=priority)
+        except WorkerPoolFull:
+            self.job.dereference("PoolWorker rejected")
+            raise
+
+        logger.debug("%s queued: %s" % (self, worker_pool.stats()))
+
+
+# Shared pool used to run jobs when 'worker_pool_size' is non-zero.  Threads
+# are only started as jobs are submitted, so this costs nothing when unused.
+worker_pool = WorkerPool(
+    'jobs',
+    size=settings.APPS_DATASOURCE.get('worker_pool_size', 0),
+    max_queued=settings.APPS_DATASOURCE.get('worker_queue_size', 0)
+)
+
 if settings.APPS_DATASOURCE['threading'] and not settings.TESTING:
-    base_worker_class = AsyncWorker
+    if worker_pool.size > 0:
+        base_worker_class = PoolWorker
+    else:
+        base_worker_class = AsyncWorker
 else:
     base_worker_class = SyncWorker
 
+# Runs the rest of a job once the jobs it waits on are done, so queries
+# may return a Deferred rather than block.  Only available when jobs are
+# run by the worker pool, None otherwise.
+if (base_worker_class is PoolWorker and
+        settings.APPS_DATASOURCE.get('job_scheduler', False)):
+    scheduler = JobScheduler(worker_pool)
+else:
+    scheduler = None
+
 
 class Worker(base_worker_class):
 
     def __init__(self, job, queryclass):
         super(Worker, self).__init__(job, queryclass)
+        self.handle_lock = None
+        self.deferred = None
 
     def do_run(self):
-        job = self.job
-        try:
-            logger.info("%s running queryclass %s" % (self, self.queryclass))
-            query = self.queryclass(job.table, job)
-            if query.run():
-                logger.info("%s query finished" % self)
-                if isinstance(query.data, list) and len(query.data) > 0:
-                    # Convert the result to a dataframe
-                    columns = [col.name for col in
-                               job.get_columns(synthetic=False)]
-                    df = pandas.DataFrame(query.data, columns=columns)
-                elif ((query.data is None) or
-                      (isinstance(query.data, list) and len(query.data) == 0)):
-                    df = None
-                elif isinstance(query.data, pandas.DataFrame):
-                    df = query.data
-                else:
-                    raise ValueError("Unrecognized query result type: %s" %
-                                     type(query.data))
+        self.step(self.start_query)
 
-                if df is not None:
-                    self.fix_dataframe(df)
-                    df = job.table.compute_synthetic(job, df)
+    def resume(self):
+        deferred, self.deferred = self.deferred, None
+        self.step(lambda: self.finish_query(*deferred.resume()))
 
-                if df is not None:
-                    df.save(job.datafile())
-                    logger.debug("%s data saved to file: %s" % (str(self),
-                                                                job.datafile()))
-                else:
-                    logger.debug("%s no data saved, data is empty" %
-                                 (str(self)))
+    def fail(self, e):
+        """ Mark the job as failed with `e` while waiting on a Deferred. """
+        self.deferred = None
 
-                logger.info("%s finished as COMPLETE" % self)
-                job.refresh()
-                if job.actual_criteria is None:
-                    job.safe_update(actual_criteria=job.criteria)
+        def reraise():
+            raise e
+        self.step(reraise)
 
-                job.mark_complete()
-            else:
-                # If the query.run() function returns false, the run() may
-                # have set the job.status, check and update if not
-                vals = {}
-                job.refresh()
-                if not job.done():
-                    vals['status'] = job.ERROR
-                if job.message == "":
-                    vals['message'] = "Query returned an unknown error"
-                vals['progress'] = 100
-                job.safe_update(**vals)
-                logger.error("%s finished with an error: %s" % (self,
-                                                                job.message))
+    def step(self, func):
+        """ Run `func`, then either release the job or wait for more.
 
+        If `func` left a Deferred in self.deferred the job stays
+        referenced, and the handle locked, until resume() is called
+        once the jobs it waits on are done.
+        """
+        job = self.job
+        try:
+            func()
         except:
             logger.exception("%s raised an exception" % self)
+            self.deferred = None
             job.safe_update(
                 status=job.ERROR,
                 progress=100,
@@ -1099,52 +1595,200 @@ class Worker(base_worker_class):
                                                         sys.exc_info()[1])
             )
 
-        finally:
-            job.dereference("Worker exiting")
+        if self.deferred is not None:
+            scheduler.when_done(self.deferred, self.resume, self.fail)
+            return
 
-    def fix_dataframe(self, df):
+        if job.partial:
+            # The full result, or the error, replaces the partial result
+            job.clear_partial()
+        if self.handle_lock is not None:
+            self.handle_lock.__exit__(None, None, None)
+            self.handle_lock = None
+        Job._inflight_done(job.handle, job.id)
+        # Dependencies planned for the job are not needed if it never ran
+        # its query, say when it reused the result of another job
+        take_plan(job.id)
+        job.dereference("Worker exiting")
+
+    def start_query(self):
         job = self.job
-        for col in job.get_columns(synthetic=False):
-            s = df[col.name]
-            if col.datatype == 'time':
-                # The column is supposed to be time,
-                # make sure all values are datetime objects
-                if str(s.dtype).startswith(str(pandas.np.dtype('datetime64'))):
-                    # Already a datetime
-                    pass
-                elif str(s.dtype).startswith('int'):
-                    # Assume this is a numeric epoch, convert to datetime
-                    df[col.name] = s.astype('datetime64[s]')
-                elif str(s.dtype).startswith('float'):
-                    # This is a numeric epoch as a float, possibly
-                    # has subsecond resolution, convert to
-                    # datetime but preserve up to millisecond
-                    df[col.name] = (1000 * s).astype('datetime64[ms]')
-                else:
-                    # Possibly datetime object or a datetime string,
-                    # hopefully astype() can figure it out
-                    df[col.name] = s.astype('datetime64[ms]')
+        if job.table.cacheable and not job.criteria.ignore_cache:
+            # May wait on a job with the same handle, let the pool
+            # run other jobs meanwhile
+            with worker_pool.blocking():
+                self.handle_lock = HandleLock(job.handle).__enter__()
+            if self.reuse_result():
+                return
+        self.run_query()
+
+    def reuse_result(self):
+        """ Complete the job with the result of an identical job, if any.
+
+        Identical jobs started by different processes are not linked
+        to each other, but only one of them runs at a time (see
+        HandleLock).  Returns True if another job with the same handle
+        has already completed and its data is available.
+        """
+        job = self.job
+        others = (Job.objects
+                  .filter(handle=job.handle, ischild=False,
+                          status=Job.COMPLETE)
+                  .exclude(id=job.id)
+                  .order_by('-touched'))
+        if len(others) == 0 or not os.path.exists(job.datafile()):
+            return False
+
+        logger.info("%s reusing the result of %s" % (self, others[0]))
+        job.safe_update(actual_criteria=others[0].actual_criteria)
+        job.mark_complete()
+        return True
+
+    def run_query(self):
+        job = self.job
+        if timecache.cache is not None and timecache.cache.applies(
+                job, self.queryclass):
+            success, df = timecache.cache.run(job, self.query)
+        else:
+            success, df = self.query(job)
+        self.finish_query(success, df)
 
-            elif (col.isnumeric and
-                  s.dtype == pandas.np.dtype('object')):
-                # The column is supposed to be numeric but must have
-                # some strings.  Try replacing empty strings with NaN
-                # and see if it converts to float64
-                try:
-                    df[col.name] = (s.replace('', pandas.np.NaN)
-                                    .astype(pandas.np.float64))
-                except ValueError:
-                    # This may incorrectly be tagged as numeric
-                    pass
+    def finish_query(self, success, df):
+        job = self.job
+        if isinstance(success, Deferred):
+            if scheduler is None:
+                raise ValueError("%s: cannot defer without the job scheduler"
+                                 % self)
+            self.deferred = success
+            return
+
+        if success:
+            if df is not None:
+                df = job.table.compute_synthetic(job, df)
+
+            if df is not None:
+                datastore.save(df, job.datafile())
+                datastore.cache.invalidate(job.handle)
+                logger.debug("%s data saved to file: %s" % (str(self),
+                                                            job.datafile()))
+            else:
+                logger.debug("%s no data saved, data is empty" %
+                             (str(self)))
 
+            logger.info("%s finished as COMPLETE" % self)
+            job.refresh()
+            if job.actual_criteria is None:
+                job.safe_update(actual_criteria=job.criteria)
+
+            job.mark_complete()
+        else:
+            # If the query.run() function returns false, the run() may
+            # have set the job.status, check and update if not
+            vals = {}
+            job.refresh()
+            if not job.done():
+                vals['status'] = job.ERROR
+            if job.message == "":
+                vals['message'] = "Query returned an unknown error"
+            vals['progress'] = 100
+            job.safe_update(**vals)
+            logger.error("%s finished with an error: %s" % (self,
+                                                            job.message))
+
+    def query(self, job):
+        """ Run the query for `job`.
+
+        `job` is either this worker's job or a timecache.SegmentJob
+        standing in for it.  Returns a tuple of whether the query
+        succeeded and the resulting DataFrame, None if it is empty.
+        """
+        logger.info("%s running queryclass %s" % (self, self.queryclass))
+        query = self.queryclass(job.table, job)
+        return self.query_result(job, query, query.run())
+
+    def query_result(self, job, query, result):
+        """ Return the (success, DataFrame) for `result` of `query.run()`.
+
+        If the query returned a Deferred so is the success value, it
+        yields the tuple once the query is done.
+        """
+        if isinstance(result, Deferred):
+            return result.then(
+                lambda r: self.query_result(job, query, r)), None
+        if not result:
+            return False, None
+
+        logger.info("%s query finished" % self)
+        if isinstance(query.data, list) and len(query.data) > 0:
+            # Convert the result to a dataframe
+            columns = [col.name for col in
+                       job.get_columns(synthetic=False)]
+            df = pandas.DataFrame(query.data, columns=columns)
+        elif ((query.data is None) or
+              (isinstance(query.data, list) and len(query.data) == 0)):
+            df = None
+        elif isinstance(query.data, pandas.DataFrame):
+            df = query.data
+        else:
+            raise ValueError("Unrecognized query result type: %s" %
+                             type(query.data))
+
+        if df is not None:
+            fix_dataframe(job, df)
+        return True, df
+
+
+def fix_dataframe(job, df):
+    """ Convert the columns of query result `df` of `job` in place. """
+    for col in job.get_columns(synthetic=False):
+        s = df[col.name]
+        if col.datatype == 'time':
+            # The column is supposed to be time,
+            # make sure all values are datetime objects
+            if str(s.dtype).startswith(str(pandas.np.dtype('datetime64'))):
+                # Already a datetime
+                pass
+            elif str(s.dtype).startswith('int'):
+                # Assume this is a numeric epoch, convert to datetime
+                df[col.name] = s.astype('datetime64[s]')
+            elif str(s.dtype).startswith('float'):
+                # This is a numeric epoch as a float, possibly
+                # has subsecond resolution, convert to
+                # datetime but preserve up to millisecond
+                df[col.name] = (1000 * s).astype('datetime64[ms]')
+            else:
+                # Possibly datetime object or a datetime string,
+                # hopefully astype() can figure it out
+                df[col.name] = s.astype('datetime64[ms]')
+
+        elif (col.isnumeric and
+              s.dtype == pandas.np.dtype('object')):
+            # The column is supposed to be numeric but must have
+            # some strings.  Try replacing empty strings with NaN
+            # and see if it converts to float64
+            try:
+                df[col.name] = (s.replace('', pandas.np.NaN)
+                                .astype(pandas.np.float64))
+            except ValueError:
+                # This may incorrectly be tagged as numeric
+                pass
 
 
 class BatchJobRunner(object):
+    """ Run a list of jobs, at most `batchsize` of them at a time.
+
+    `batchsize` defaults to APPS_DATASOURCE['batch_job_size'].  Progress
+    of the jobs is reported to `basejob` scaled to the range from
+    `min_progress` to `max_progress`.
+    """
 
-    def __init__(self, basejob, batchsize=4, min_progress=0, max_progress=100):
+    def __init__(self, basejob, batchsize=None, min_progress=0,
+                 max_progress=100):
+        if batchsize is None:
+            batchsize = settings.APPS_DATASOURCE.get('batch_job_size', 4)
         self.basejob = basejob
         self.jobs = []
-        self.batchsize = batchsize
+        self.batchsize = max(1, batchsize)
         self.min_progress = min_progress
         self.max_progress = max_progress
 
@@ -1155,7 +1799,13 @@ class BatchJobRunner(object):
         self.jobs.append(job)
 
 
-    def run(self):
+    def run(self, callback=None):
+        """ Run all jobs and return once they are all done.
+
+        If `callback` is given it is called with each job as soon as it
+        is done, in the order they finish, so results can be processed
+        while the remaining jobs run.
+        """
         class JobList:
             def __init__(self, jobs):
                 self.jobs = jobs
@@ -1185,42 +1835,50 @@ class BatchJobRunner(object):
             logger.debug("%s: starting batch job #%d (%s)"
                          % (self, joblist.index, job))
 
-        # iterate until both jobs and batch are empty
-        while joblist or batch:
-            # check jobs in the batch
-            rebuild_batch = False
-            batch_progress = 0.0
-            something_done = False
-            for i,job in enumerate(batch):
-                job.refresh()
-                if job.done():
-                    something_done = True
-                    done_count = done_count + 1
-                    if joblist:
-                        batch[i] = joblist.next()
-                        batch[i].start()
-                        logger.debug("%s: starting batch job #%d (%s)"
-                                     % (self, joblist.index, batch[i]))
+        # iterate until both jobs and batch are empty, letting the worker
+        # pool know this thread is only waiting on other jobs
+        with worker_pool.blocking():
+            while joblist or batch:
+                # Note the job versions before checking status so that
+                # any change after this point ends the wait below
+                versions = notifier.versions([j.notify_key() for j in batch])
+
+                # check jobs in the batch
+                rebuild_batch = False
+                batch_progress = 0.0
+                something_done = False
+                for i,job in enumerate(batch):
+                    if job.done():
+                        something_done = True
+                        done_count = done_count + 1
+                        if joblist:
+                            batch[i] = joblist.next()
+                            batch[i].start()
+                            logger.debug("%s: starting batch job #%d (%s)"
+                                         % (self, joblist.index, batch[i]))
+                        else:
+                            batch[i] = None
+                            rebuild_batch = True
+
+                        if callback is not None:
+                            callback(job)
                     else:
-                        batch[i] = None
-                        rebuild_batch = True
-                else:
-                    batch_progress = batch_progress + float(job.progress)
-
-            total_progress = (float(done_count * 100) + batch_progress) / joblist.count
-            job_progress = (float(self.min_progress) +
-                            ((total_progress / 100.0) *
-                             (self.max_progress - self.min_progress)))
-            logger.debug("%s: progress %d%% (basejob %d%%) (%d/%d done, %d in batch)" %
-                         (self, int(total_progress), int(job_progress),
-                          done_count, joblist.count, len(batch)))
-            self.basejob.mark_progress(job_progress)
-
-            if not something_done:
-                time.sleep(0.2)
-
-            elif rebuild_batch:
-                batch = [j for j in batch if j is not None]
+                        batch_progress = batch_progress + float(job.progress)
+
+                total_progress = (float(done_count * 100) + batch_progress) / joblist.count
+                job_progress = (float(self.min_progress) +
+                                ((total_progress / 100.0) *
+                                 (self.max_progress - self.min_progress)))
+                logger.debug("%s: progress %d%% (basejob %d%%) (%d/%d done, %d in batch)" %
+                             (self, int(total_progress), int(job_progress),
+                              done_count, joblist.count, len(batch)))
+                self.basejob.mark_progress(job_progress)
+
+                if not something_done:
+                    notifier.wait(versions, notifier.fallback_interval)
+
+                elif rebuild_batch:
+                    batch = [j for j in batch if j is not None]
 
 
         return
@@ -5,20 +5,26 @@
 #   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
 # This software is distributed "AS IS" as set forth in the License.
 
+import os
 import logging
 import pandas
 
 from rvbd.common.jsondict import JsonDict
-from rvbd_portal.apps.datasource.models import Column, Job, Table, BatchJobRunner
+from rvbd_portal.apps.datasource.models import (Column, Job, Table,
+                                                BatchJobRunner,
+                                                canonical_criteria, scheduler)
+from rvbd_portal.apps.datasource.scheduler import (Deferred, plan,
+                                                   take_plan)
+from rvbd_portal.apps.datasource.processpool import process_pool
 
 logger = logging.getLogger(__name__)
 
-
 class TableOptions(JsonDict):
     _default = {'tables': None,
                 'related_tables': None,
                 'func': None,
-                'params': None}
+                'params': None,
+                'executor': None}
 
     _required = ['func']
 
@@ -44,6 +50,13 @@ class AnalysisTable(object):
 
     `params` is an optional dictionary of parameters to pass to `func`
 
+    `executor` is 'process' to run `func` in the analysis process pool
+        (APPS_DATASOURCE['process_pool_size'], disabled by default)
+        rather than the job's thread, for functions that are CPU heavy.
+        Without the pool it runs on the job's thread.  Such a function gets
+        a query with only `table` and `job` and must not use the
+        database, for example by running other jobs.
+
     For example, consider an input of two tables A and B, and an
     AnalysisTable that simply concatenates A and B:
 
@@ -81,12 +94,17 @@ class AnalysisTable(object):
 
     @classmethod
     def create(cls, name, tables, func, columns=None, params=None,
-               copy_fields=True, related_tables=None, **kwargs):
+               copy_fields=True, related_tables=None, executor=None,
+               **kwargs):
         """ Class method to create an AnalysisTable. """
+        if executor not in (None, 'thread', 'process'):
+            raise ValueError("Unknown executor: %s" % executor)
+
         options = TableOptions(tables=tables,
                                related_tables=related_tables,
                                func=func,
-                               params=params)
+                               params=params,
+                               executor=executor)
         table = Table(name=name, module=__name__,
                       options=options, **kwargs)
         table.save()
@@ -109,6 +127,25 @@ class AnalysisTable(object):
         return table
 
 
+def _call_in_process(dfs, func, query, criteria, params):
+    return func(query, dfs, criteria, params=params)
+
+
+class ProcessQuery(object):
+    """ The query passed to analysis functions run in the process pool. """
+
+    def __init__(self, table, job):
+        self.table = table
+        self.job = job
+
+    def __str__(self):
+        return "<AnalysisTable %s>" % self.job
+
+    def mark_progress(self, progress):
+        # Progress is not reported from other processes
+        pass
+
+
 class TableQuery(object):
     def __init__(self, table, job):
         self.table = table
@@ -125,56 +162,127 @@ class TableQuery(object):
         self.job.mark_progress(70 + (progress * 30)/100)
 
     def run(self):
-        # Collect all dependent tables
+        deptables = self.table.options.tables
+        if not deptables:
+            return self.analyze({})
+
+        logger.debug("%s: dependent tables: %s" % (self, deptables))
+        if scheduler is not None:
+            # Run the analysis function once the dependent jobs are done
+            # rather than holding this thread while they run
+            depjobs = self.start_graph()
+            return Deferred(depjobs.values(),
+                            lambda: self.analyze(depjobs),
+                            progress=lambda p: self.job.mark_progress(
+                                (p * 70) / 100))
+
+        depjobs = {}
+        batch = BatchJobRunner(self.job, max_progress=70)
+        for (name, id) in deptables.items():
+            id = int(id)
+            deptable = Table.objects.get(id=id)
+            job = Job.create(
+                table=deptable,
+                criteria=self.job.criteria.build_for_table(deptable)
+            )
+            batch.add_job(job)
+            logger.debug("%s: starting dependent job %s" % (self, job))
+            depjobs[name] = job
+
+        batch.run()
+        return self.analyze(depjobs)
+
+    def start_graph(self):
+        """ Create and start the jobs of all tables this one depends on.
+
+        Dependencies that are analysis tables are expanded in turn, so
+        the whole graph starts at once and each analysis job only waits
+        on its own dependencies.  Tables reached more than once with
+        the same criteria share a job.  Returns the jobs of the direct
+        dependencies by name.
+        """
+        depjobs = take_plan(self.job.id)
+        if depjobs is not None:
+            # Already started by the job that expanded the graph
+            return depjobs
+
+        created = []
+        depjobs = self._expand(self.table, self.job.criteria, {}, created)
+
+        # Leaves first, analysis jobs only defer until they are done
+        for job in reversed(created):
+            logger.debug("%s: starting dependent job %s" % (self, job))
+            job.start()
+        return depjobs
+
+    def _expand(self, table, criteria, nodes, created):
+        depjobs = {}
+        for (name, id) in table.options.tables.items():
+            deptable = Table.objects.get(id=int(id))
+            depcriteria = criteria.build_for_table(deptable)
+
+            key = (deptable.id, canonical_criteria(depcriteria))
+            if key not in nodes:
+                job = Job.create(table=deptable, criteria=depcriteria)
+                nodes[key] = job
+                created.append(job)
+
+                # A child job follows a parent that is already running
+                # and expanding its own dependencies
+                if (deptable.module == __name__ and not job.ischild and
+                        deptable.options.tables):
+                    planned = self._expand(deptable, depcriteria,
+                                           nodes, created)
+                    plan(job.id, planned)
+
+            depjobs[name] = nodes[key]
+        return depjobs
+
+    def analyze(self, depjobs):
+        """ Call the analysis function with the data of `depjobs`. """
         options = self.table.options
-
-        # Create dataframes for all tables
+        in_process = options.executor == 'process' and process_pool.size > 0
         dfs = {}
 
-        deptables = options.tables
-        if deptables and (len(deptables) > 0):
-            logger.debug("%s: dependent tables: %s" % (self, deptables))
-            depjobids = {}
-            batch = BatchJobRunner(self.job, max_progress=70)
-            for (name, id) in deptables.items():
-                id = int(id)
-                deptable = Table.objects.get(id=id)
-                job = Job.create(
-                    table=deptable,
-                    criteria=self.job.criteria.build_for_table(deptable)
-                )
-                batch.add_job(job)
-                logger.debug("%s: starting dependent job %s" % (self, job))
-                depjobids[name] = job.id
-
-            batch.run()
-
+        if depjobs:
             logger.debug("%s: All dependent jobs complete, collecting data"
                          % str(self))
 
-            failed = False
-            for (name, id) in depjobids.items():
-                job = Job.objects.get(id=id)
+            for (name, job) in depjobs.items():
+                job = Job.objects.get(id=job.id)
 
                 if job.status == job.ERROR:
                     self.job.mark_error("Dependent Job failed: %s" % job.message)
-                    failed = True
-                    break
+                    return False
+
+                if in_process:
+                    # The pool process loads the data file itself
+                    path = job.datafile()
+                    dfs[name] = path if os.path.exists(path) else None
+                    continue
 
+                # Analysis functions are free to modify their inputs, so
+                # hand them a copy of the (possibly shared) data
                 f = job.data()
+                if f is not None:
+                    f = f.copy()
                 dfs[name] = f
                 logger.debug("%s: Table[%s] - %d rows" %
                              (self, name, len(f) if f is not None else 0))
 
-            if failed:
-                return False
-
-        logger.debug("%s: Calling analysis function %s"
-                     % (self, str(options.func)))
+        logger.debug("%s: Calling analysis function %s%s"
+                     % (self, str(options.func),
+                        " in the process pool" if in_process else ""))
 
         try:
-            df = options.func(self, dfs, self.job.criteria,
-                              params=options.params)
+            if in_process:
+                df = process_pool.call(
+                    _call_in_process, dfs,
+                    args=(options.func, ProcessQuery(self.table, self.job),
+                          self.job.criteria, options.params))
+            else:
+                df = options.func(self, dfs, self.job.criteria,
+                                  params=options.params)
         except AnalysisException as e:
             self.job.mark_error("Analysis function %s failed: %s" %
                                 (options.func, e.message))
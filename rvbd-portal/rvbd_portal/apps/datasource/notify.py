@@ -0,0 +1,193 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import os
+import time
+import errno
+import logging
+import importlib
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LocalNotifier(object):
+    """ Notify waiting threads of job state changes within this process.
+
+    Each job id has a version number that is bumped by `notify()`.
+    A waiter records the versions of the jobs it is interested in,
+    checks the job state, then calls `wait()` which returns as soon
+    as any of those versions change.  Recording the version before
+    checking the state ensures no change is missed in between.
+
+    Changes made by other processes are not seen, so waiters should
+    never wait longer than `fallback_interval` before checking the
+    job state in the database again.
+    """
+
+    fallback_interval = 1.0
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._versions = {}
+
+    def version(self, job_id):
+        with self._cond:
+            return self._versions.get(job_id, 0)
+
+    def versions(self, job_ids):
+        return dict((job_id, self.version(job_id)) for job_id in job_ids)
+
+    def notify(self, job_id):
+        with self._cond:
+            self._versions[job_id] = self._versions.get(job_id, 0) + 1
+            self._cond.notify_all()
+
+    def forget(self, job_id):
+        with self._cond:
+            self._versions.pop(job_id, None)
+
+    def changed(self, versions):
+        """ Return True if any job in `versions` has changed. """
+        for job_id, version in versions.iteritems():
+            if self.version(job_id) != version:
+                return True
+        return False
+
+    def wait(self, versions, timeout):
+        """ Wait up to `timeout` seconds for a job in `versions` to change.
+
+        `versions` is a dict of job id to the version last seen, as
+        returned by `versions()`.  Returns True if a change was seen.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                if self.changed(versions):
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+
+
+class FileNotifier(LocalNotifier):
+    """ Notify job state changes across processes via the data cache.
+
+    Each notification appends a byte to a per-job file in the
+    'notify' directory under DATA_CACHE, the file size is the job
+    version.  Waiters in the same process are woken immediately,
+    waiters in other processes see the change within `poll_interval`
+    by checking the file size, which is far cheaper than refreshing
+    the job from the database.
+    """
+
+    fallback_interval = 5.0
+    poll_interval = 0.05
+
+    def __init__(self, path=None):
+        super(FileNotifier, self).__init__()
+        self.path = path or os.path.join(settings.DATA_CACHE, 'notify')
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _filename(self, job_id):
+        return os.path.join(self.path, 'job-%s' % job_id)
+
+    def version(self, job_id):
+        try:
+            return os.stat(self._filename(job_id)).st_size
+        except OSError:
+            return 0
+
+    def notify(self, job_id):
+        with open(self._filename(job_id), 'ab') as f:
+            f.write('.')
+        with self._cond:
+            self._cond.notify_all()
+
+    def forget(self, job_id):
+        try:
+            os.unlink(self._filename(job_id))
+        except OSError:
+            pass
+
+    def wait(self, versions, timeout):
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                if self.changed(versions):
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, self.poll_interval))
+
+
+class SharedCounter(object):
+    """ Counter shared by all server processes through a file.
+
+    The value is the size of a file in the 'counters' directory under
+    DATA_CACHE, so reading it is a single stat.  In-memory caches use
+    it to learn that another process changed what they hold.
+    """
+
+    def __init__(self, name, path=None):
+        self.dir = path or os.path.join(settings.DATA_CACHE, 'counters')
+        self.path = os.path.join(self.dir, name)
+
+    def value(self):
+        try:
+            return os.stat(self.path).st_size
+        except OSError:
+            return 0
+
+    def increment(self):
+        if not os.path.exists(self.dir):
+            try:
+                os.makedirs(self.dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        with open(self.path, 'ab') as f:
+            f.write('.')
+
+
+# Bumped whenever table or report definitions are reloaded
+definitions_version = SharedCounter('definitions')
+
+
+NOTIFIERS = {'local': LocalNotifier,
+             'file': FileNotifier}
+
+
+def create_notifier(backend=None):
+    """ Create the notifier named by APPS_DATASOURCE['job_notifier'].
+
+    `backend` is either one of the names in NOTIFIERS or the dotted
+    path of a class implementing the same interface as LocalNotifier.
+    """
+    if backend is None:
+        backend = settings.APPS_DATASOURCE.get('job_notifier', 'local')
+
+    if backend in NOTIFIERS:
+        cls = NOTIFIERS[backend]
+    else:
+        module, name = backend.rsplit('.', 1)
+        cls = getattr(importlib.import_module(module), name)
+
+    logger.debug("Using job notifier %s" % cls.__name__)
+    return cls()
+
+
+notifier = create_notifier()
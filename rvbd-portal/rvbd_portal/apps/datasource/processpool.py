@@ -0,0 +1,99 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import os
+import logging
+import tempfile
+import multiprocessing
+
+from django.conf import settings
+
+from rvbd_portal.apps.datasource import datastore
+
+logger = logging.getLogger(__name__)
+
+
+def _call(func, paths, outpath, args, kwargs):
+    # Runs in a pool process
+    dfs = {}
+    for name, path in paths.iteritems():
+        if path is None:
+            dfs[name] = None
+        else:
+            # Loaded data may be memory mapped read-only, and functions
+            # are free to modify their inputs
+            dfs[name] = datastore.load(path).copy()
+
+    df = func(dfs, *args, **kwargs)
+    if df is None:
+        return False
+    datastore.save(df, outpath)
+    return True
+
+
+class ProcessPool(object):
+    """ Pool of processes for running CPU heavy functions off the GIL.
+
+    DataFrames are passed to and from the processes as data files in
+    DATA_CACHE rather than pickled through the pool's pipes.  Job data
+    files are used as they are, and with the columnar format the
+    processes only map the pages they read.
+
+    The processes are forked when the pool is created, so they have the
+    same modules loaded, but must not use the database connections they
+    inherit.  This module is imported by the datasource models so that
+    happens before the server starts any threads, since a thread holding
+    a lock at the fork, say the logging lock, leaves it locked for good
+    in the new process.  A pool of `size` 0 is disabled.
+    """
+
+    def __init__(self, name, size, timeout=None):
+        self.name = name
+        self.size = size
+        self.timeout = timeout
+        self._pool = None
+        if size > 0:
+            logger.info("%s: starting %d processes" % (self, size))
+            self._pool = multiprocessing.Pool(size)
+
+    def __str__(self):
+        return "<ProcessPool %s>" % self.name
+
+    def call(self, func, paths, args=(), kwargs=None):
+        """ Return `func(dfs, *args, **kwargs)` run in a pool process.
+
+        `paths` maps names to data files, or None, and `dfs` maps the
+        same names to the DataFrames loaded from them.  `func` and
+        the arguments must be picklable, so `func` has to be defined
+        at module level.  Exceptions raised by `func` are raised here,
+        and multiprocessing.TimeoutError if it does not return within
+        `timeout` seconds.
+        """
+        # Imported here, models imports this module
+        from rvbd_portal.apps.datasource.models import worker_pool
+
+        fd, outpath = tempfile.mkstemp(dir=settings.DATA_CACHE,
+                                       prefix='process-', suffix='.data')
+        os.close(fd)
+        try:
+            result = self._pool.apply_async(
+                _call, (func, paths, outpath, args, kwargs or {}))
+            with worker_pool.blocking():
+                found = result.get(self.timeout)
+            if not found:
+                return None
+            return datastore.load(outpath)
+        finally:
+            # Memory mapped data stays readable after the unlink
+            os.unlink(outpath)
+
+
+# Shared pool for analysis tables created with executor='process'
+process_pool = ProcessPool(
+    'analysis',
+    size=settings.APPS_DATASOURCE.get('process_pool_size', 0),
+    timeout=settings.APPS_DATASOURCE.get('process_pool_timeout', None))
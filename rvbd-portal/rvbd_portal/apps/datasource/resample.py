@@ -0,0 +1,194 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import logging
+import importlib
+
+import numpy
+import pandas
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PandasResampler(object):
+    """ Resample using DataFrame.resample(). """
+
+    name = 'pandas'
+
+    def resample(self, df, timecol, resolution, how):
+        """ Resample `df` into `resolution` second buckets of `timecol`.
+
+        `how` maps each other column to a resample operation name
+        ('sum', 'mean', 'min', 'max', ...).  Each row of the result is
+        labeled with the start of its bucket, buckets between the first
+        and last that have no rows are included with null values.
+        """
+        indexed = df.set_index(timecol)
+        return indexed.resample('%ss' % int(resolution), how,
+                                convention='end').reset_index()
+
+
+def _sum(values, valid, starts, counts):
+    return numpy.add.reduceat(numpy.where(valid, values, 0), starts)
+
+
+def _mean(values, valid, starts, counts):
+    return _sum(values, valid, starts, counts) / numpy.maximum(counts, 1)
+
+
+def _min(values, valid, starts, counts):
+    return numpy.fmin.reduceat(values, starts)
+
+
+def _max(values, valid, starts, counts):
+    return numpy.fmax.reduceat(values, starts)
+
+
+def _count(values, valid, starts, counts):
+    return counts
+
+
+def _first(values, valid, starts, counts):
+    # Index of the first valid value at or after each row
+    idx = numpy.where(valid, numpy.arange(len(values)), len(values) - 1)
+    idx = numpy.minimum.accumulate(idx[::-1])[::-1]
+    return values[idx[starts]]
+
+
+def _last(values, valid, starts, counts):
+    # Index of the last valid value at or before each row
+    idx = numpy.where(valid, numpy.arange(len(values)), 0)
+    idx = numpy.maximum.accumulate(idx)
+    ends = numpy.concatenate((starts[1:], [len(values)])) - 1
+    return values[idx[ends]]
+
+
+class EpochResampler(PandasResampler):
+    """ Resample by integer division of the epoch time of each row.
+
+    The operations in `reductions` on numeric columns are computed with
+    numpy reductions over the rows of each bucket.  Other operations,
+    or columns that are not numeric, are handed to pandas groupby on
+    the bucket numbers.  No index is set on the DataFrame.
+
+    Buckets are aligned to multiples of `resolution` since the epoch.
+    This matches pandas for any resolution that evenly divides a day,
+    pandas aligns other resolutions to the first row.  As with pandas,
+    rows without a time are dropped, and integer columns stay integer
+    unless there are empty buckets to fill with NaN.  Means are always
+    float, where pandas turns them back into integers when they all
+    happen to be integral.
+    """
+
+    name = 'epoch'
+
+    reductions = {'sum': _sum,
+                  'mean': _mean,
+                  'min': _min,
+                  'max': _max,
+                  'count': _count,
+                  'first': _first,
+                  'last': _last}
+
+    # Operations that keep integer columns integer
+    integer_ops = ('sum', 'count', 'min', 'max', 'first', 'last')
+
+    def resample(self, df, timecol, resolution, how):
+        times = df[timecol].values.astype('datetime64[ns]').view(numpy.int64)
+        valid = times != numpy.iinfo(numpy.int64).min
+        if not valid.all():
+            # NaT
+            df = df[valid]
+            times = times[valid]
+
+        if len(df) == 0:
+            return super(EpochResampler, self).resample(df, timecol,
+                                                        resolution, how)
+
+        step = int(resolution) * 10**9
+        buckets = times // step
+
+        order = None
+        if (numpy.diff(buckets) < 0).any():
+            order = numpy.argsort(buckets, kind='mergesort')
+            buckets = buckets[order]
+
+        # Row at which each occupied bucket starts, and the position
+        # of that bucket in the result
+        starts = numpy.concatenate(
+            ([0], numpy.flatnonzero(numpy.diff(buckets)) + 1))
+        slots = buckets[starts] - buckets[0]
+        nbuckets = buckets[-1] - buckets[0] + 1
+
+        bucket_times = (numpy.arange(nbuckets) + buckets[0]) * step
+        result = pandas.DataFrame(
+            {timecol: bucket_times.astype('datetime64[ns]')})
+
+        for col in df.columns:
+            if col == timecol:
+                continue
+            values = df[col].values
+            if order is not None:
+                values = values[order]
+            result[col] = self._reduce(values, buckets, starts, slots,
+                                       nbuckets, how[col])
+        return result
+
+    def _reduce(self, values, buckets, starts, slots, nbuckets, op):
+        if values.dtype.kind not in 'biuf' or op not in self.reductions:
+            reduced = pandas.Series(values).groupby(buckets).agg(op)
+            full = pandas.Series(reduced.values, index=slots)
+            return full.reindex(numpy.arange(nbuckets)).values
+
+        dtype = values.dtype
+        values = values.astype(float)
+        valid = ~numpy.isnan(values)
+        counts = numpy.add.reduceat(valid.astype(int), starts)
+
+        reduced = self.reductions[op](values, valid, starts, counts)
+        if op == 'count':
+            full = numpy.zeros(nbuckets)
+        else:
+            reduced = numpy.where(counts > 0, reduced, numpy.nan)
+            full = numpy.empty(nbuckets)
+            full.fill(numpy.nan)
+        full[slots] = reduced
+
+        if len(slots) == nbuckets:
+            # No gaps, so no NaN that would need a float column
+            if op == 'count':
+                return full.astype(numpy.int64)
+            if dtype.kind in 'iu' and op in self.integer_ops:
+                return full.astype(dtype)
+        return full
+
+
+ENGINES = {'pandas': PandasResampler,
+           'epoch': EpochResampler}
+
+
+def create_resampler(name=None):
+    """ Create the resampler named by APPS_DATASOURCE['resample_engine'].
+
+    `name` is either one of the names in ENGINES or the dotted path
+    of a class implementing the same interface as PandasResampler.
+    """
+    if name is None:
+        name = settings.APPS_DATASOURCE.get('resample_engine', 'pandas')
+
+    if name in ENGINES:
+        cls = ENGINES[name]
+    else:
+        module, clsname = name.rsplit('.', 1)
+        cls = getattr(importlib.import_module(module), clsname)
+
+    logger.debug("Using resample engine %s" % cls.__name__)
+    return cls()
+
+
+resampler = create_resampler()
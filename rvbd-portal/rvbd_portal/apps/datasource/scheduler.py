@@ -0,0 +1,161 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import os
+import logging
+import threading
+
+from rvbd_portal.apps.datasource.exceptions import WorkerPoolFull
+from rvbd_portal.apps.datasource.notify import notifier
+
+logger = logging.getLogger(__name__)
+
+# Dependent jobs of jobs started by another job expanding the table graph,
+# by job id, see analysis.TableQuery.start_graph()
+_planned = {}
+_planned_lock = threading.Lock()
+
+
+def plan(job_id, depjobs):
+    """ Record `depjobs` as already started for the job `job_id`. """
+    with _planned_lock:
+        _planned[job_id] = depjobs
+
+
+def take_plan(job_id):
+    """ Return and forget the planned dependent jobs of `job_id`, if any. """
+    with _planned_lock:
+        return _planned.pop(job_id, None)
+
+
+class Deferred(object):
+    """ Result of a TableQuery.run() that has to wait on other jobs.
+
+    Rather than blocking a worker thread until `jobs` are done, run()
+    returns a Deferred and the worker calls `func()` once they are,
+    which returns what run() would have: True, False or another
+    Deferred.  `progress`, if given, is called with the average
+    progress of the jobs as they run.
+    """
+
+    def __init__(self, jobs, func, progress=None):
+        self.jobs = list(jobs)
+        self.func = func
+        self.progress = progress
+        self.last_progress = None
+
+    def __str__(self):
+        return "<Deferred on jobs %s>" % [job.id for job in self.jobs]
+
+    def then(self, func):
+        """ Return a Deferred that passes the result of this one to `func`. """
+        return Deferred(self.jobs, lambda: func(self.func()), self.progress)
+
+    def resume(self):
+        return self.func()
+
+
+class JobScheduler(object):
+    """ Run continuations on a worker pool once jobs are done.
+
+    A single watcher thread waits on the notifier for changes to all
+    jobs that continuations are registered on.  When all the jobs of a
+    continuation are COMPLETE or ERROR it is submitted to `pool`, ahead
+    of new top level jobs.  So a chain of analysis tables holds no
+    threads while its dependencies run and finishes as soon as the
+    last one does.
+
+    The job states are read from the database at least every
+    `notifier.fallback_interval` seconds, which catches changes made
+    by other processes and any missed notification.
+    """
+
+    # Same as PoolWorker.PRIORITY_NESTED
+    priority = 0
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._pending = []
+        self._thread = None
+        self._wakeup = 'scheduler-%d' % os.getpid()
+
+    def __str__(self):
+        return "<JobScheduler %s>" % self.pool.name
+
+    def when_done(self, deferred, func, fail):
+        """ Call `func()` on the pool once the jobs of `deferred` are done.
+
+        If checking the jobs or submitting `func` fails for any reason
+        but a full pool, `fail(e)` is called with the exception instead.
+        """
+        logger.debug("%s: waiting on %s" % (self, deferred))
+        with self._lock:
+            self._pending.append((deferred, func, fail))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='job-scheduler')
+                self._thread.daemon = True
+                self._thread.start()
+        notifier.notify(self._wakeup)
+
+    def _run(self):
+        notifier.forget(self._wakeup)
+        while True:
+            versions = self._poll()
+            notifier.wait(versions, notifier.fallback_interval)
+
+    def _poll(self):
+        """ Submit the continuations whose jobs are done.
+
+        Returns the notifier versions of the jobs still waited on, as
+        seen before checking them, to wait on for the next round.
+        """
+        with self._lock:
+            pending = list(self._pending)
+
+        keys = set([self._wakeup])
+        for deferred, _, _ in pending:
+            keys.update(job.notify_key() for job in deferred.jobs)
+        versions = notifier.versions(keys)
+
+        for entry in pending:
+            try:
+                if self._ready(entry[0]):
+                    self.pool.submit(entry[1], priority=self.priority)
+                    with self._lock:
+                        self._pending.remove(entry)
+            except WorkerPoolFull:
+                # Try again on the next round
+                logger.warning("%s: pool full, delaying %s" %
+                               (self, entry[0]))
+            except Exception as e:
+                logger.exception("%s: failed to check %s" %
+                                 (self, entry[0]))
+                with self._lock:
+                    self._pending.remove(entry)
+                try:
+                    entry[2](e)
+                except:
+                    logger.exception("%s: failed to report error of %s"
+                                     % (self, entry[0]))
+
+        return versions
+
+    def _ready(self, deferred):
+        # Imported here, models imports this module
+        from rvbd_portal.apps.datasource.models import Job
+
+        jobs = Job.objects.filter(id__in=[job.id for job in deferred.jobs])
+        running = [job for job in jobs
+                   if job.status not in (Job.COMPLETE, Job.ERROR)]
+        if running and deferred.progress is not None:
+            progress = sum(max(job.progress, 0) for job in jobs) / len(jobs)
+            if progress != deferred.last_progress:
+                deferred.last_progress = progress
+                deferred.progress(progress)
+        return not running
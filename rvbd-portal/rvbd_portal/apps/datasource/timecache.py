@@ -0,0 +1,340 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import os
+import glob
+import time
+import hashlib
+import logging
+import calendar
+import datetime
+
+import numpy
+import pandas
+from django.conf import settings
+
+from rvbd.common import timedelta_total_seconds
+
+from rvbd_portal.apps.datasource import datastore
+
+logger = logging.getLogger(__name__)
+
+
+def epoch_seconds(dt):
+    """ Return datetime `dt` as seconds since the epoch.
+
+    Naive datetimes are taken to be local time, like datetime.now().
+    Job handles use the same rule, see models.canonical_criteria().
+    """
+    if dt.tzinfo is None:
+        return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def from_epoch_seconds(t, tzinfo):
+    """ Inverse of `epoch_seconds()`, in timezone `tzinfo` if not None. """
+    if tzinfo is None:
+        return datetime.datetime.fromtimestamp(t)
+    return datetime.datetime.fromtimestamp(t, tzinfo)
+
+
+class SegmentJob(object):
+    """ Stand-in for a job while its query runs over part of the time range.
+
+    The query sees `criteria` instead of the criteria of the job.
+    Progress is scaled to the range `min_progress` to `max_progress`
+    of the job and updates of the actual criteria are dropped, those
+    are set once all parts are stitched together.  Everything else is
+    passed on to the job.
+    """
+
+    def __init__(self, job, criteria, min_progress, max_progress):
+        self._job = job
+        self.criteria = criteria
+        self.min_progress = min_progress
+        self.max_progress = max_progress
+
+    def __getattr__(self, name):
+        return getattr(self._job, name)
+
+    def _scale(self, progress):
+        return int(self.min_progress + (self.max_progress - self.min_progress) *
+                   float(progress) / 100)
+
+    def safe_update(self, **kwargs):
+        kwargs.pop('actual_criteria', None)
+        if 'progress' in kwargs:
+            kwargs['progress'] = self._scale(kwargs['progress'])
+        if kwargs:
+            self._job.safe_update(**kwargs)
+
+    def mark_progress(self, progress, remaining=None):
+        self._job.mark_progress(self._scale(progress), remaining)
+
+
+class TimeSeriesCache(object):
+    """ Cache of time series query results in segments of time.
+
+    Tables whose TableQuery class has a true `timeseries_cacheable`
+    attribute (or a `timeseries_cacheable(table)` classmethod that
+    returns True) return one row per time bucket for any time range,
+    so results over adjacent ranges can be stitched together.
+
+    Segments are stored in DATA_CACHE by a key computed from the table
+    and all criteria except the times, the resolution included.  A job
+    loads the segments that overlap its time range and only queries the
+    appliance for the parts not covered, typically just the last few
+    minutes of a report that was run recently.
+
+    Times are aligned to multiples of the resolution.  Data newer than
+    `delay` seconds is never cached since the appliance may not have
+    all of it yet.  Segments not updated for `max_age` seconds are
+    removed.
+
+    Missing parts longer than `slice_buckets` resolution buckets are
+    queried in slices of that many, and the data found so far is
+    published as the partial result of the job before each query.
+
+    Results that cannot be sliced by time, like totals over a range,
+    may be kept as summaries of an exact time range instead, see
+    `load_summary()` and `store_summary()`.
+    """
+
+    def __init__(self, path, delay, max_age, slice_buckets=360):
+        self.path = path
+        self.delay = delay
+        self.max_age = max_age
+        self.slice_buckets = slice_buckets
+
+    def applies(self, job, queryclass):
+        """ Return True if the result of `job` can be built from segments. """
+        cacheable = getattr(queryclass, 'timeseries_cacheable', False)
+        if callable(cacheable):
+            cacheable = cacheable(job.table)
+        if not cacheable or job.table.rows > 0:
+            return False
+
+        criteria = job.criteria
+        if criteria.get('ignore_cache'):
+            return False
+        if (criteria.get('starttime') is None or
+                criteria.get('endtime') is None or
+                not isinstance(criteria.get('resolution'),
+                               datetime.timedelta)):
+            return False
+
+        return self.timecol(job) is not None
+
+    def timecol(self, job):
+        for col in job.get_columns(synthetic=False):
+            if col.datatype == 'time':
+                return col.name
+        return None
+
+    def key(self, table, criteria, kind='timeseries'):
+        """ Return the key of results of `table` for `criteria`.
+
+        The times are left out so any time range maps to the same key.
+        """
+        # Imported here, models imports this module
+        from rvbd_portal.apps.datasource.models import canonical_criteria
+
+        criteria = dict((k, v) for k, v in criteria.iteritems()
+                        if k not in ('starttime', 'endtime', 'duration'))
+        h = hashlib.md5()
+        h.update(kind)
+        h.update(str(table.id))
+        h.update(table.column_signature())
+        h.update(canonical_criteria(criteria))
+        return h.hexdigest()
+
+    def segments(self, key):
+        """ Return the (t0, t1, path) of the segments of `key` by t0. """
+        now = time.time()
+        segments = []
+        for path in glob.glob(os.path.join(self.path, 'ts-%s-*.data' % key)):
+            name = os.path.basename(path)[:-len('.data')]
+            try:
+                _, _, t0, t1 = name.split('-')
+                if now - os.path.getmtime(path) > self.max_age:
+                    os.unlink(path)
+                    continue
+            except (ValueError, OSError):
+                continue
+            segments.append((int(t0), int(t1), path))
+        return sorted(segments)
+
+    def run(self, job, query):
+        """ Return the result of `job` as (success, DataFrame or None).
+
+        `query(job)` runs the query of a job and returns the same, it
+        is called with a SegmentJob for each part of the time range that
+        is not cached.
+        """
+        criteria = job.criteria
+        timecol = self.timecol(job)
+        resolution = int(timedelta_total_seconds(criteria.resolution))
+        if resolution <= 0:
+            return query(job)
+
+        tzinfo = criteria.starttime.tzinfo
+        t0 = int(epoch_seconds(criteria.starttime)) // resolution * resolution
+        t1 = int(epoch_seconds(criteria.endtime)) // resolution * resolution
+        if t1 <= t0:
+            return query(job)
+
+        # Only data up to here is complete
+        limit = int(time.time() - self.delay) // resolution * resolution
+
+        key = self.key(job.table, criteria)
+        pieces = []
+        missing = []
+        cursor = t0
+        for s0, s1, path in self.segments(key):
+            if s1 <= cursor or s0 >= t1:
+                continue
+            try:
+                df = datastore.load(path)
+            except (IOError, OSError, EOFError):
+                # Replaced by another process in the meantime
+                continue
+            if s0 > cursor:
+                missing.append((cursor, s0))
+            pieces.append(self._slice(df, timecol, max(s0, cursor),
+                                      min(s1, t1)))
+            cursor = min(s1, t1)
+            if cursor >= t1:
+                break
+        if cursor < t1:
+            missing.append((cursor, t1))
+
+        logger.debug("%s: %d cached segments, querying %s" %
+                     (job, len(pieces), missing))
+
+        slices = []
+        step = resolution * max(1, self.slice_buckets)
+        for m0, m1 in missing:
+            slices.extend((s0, min(s0 + step, m1))
+                          for s0 in xrange(m0, m1, step))
+
+        total = sum(m1 - m0 for m0, m1 in missing)
+        done = 0
+        published = 0
+        for m0, m1 in slices:
+            if len(pieces) > published:
+                # Show what is there so far while the rest is queried
+                df = self._combine(pieces, timecol)
+                if df is not None:
+                    job.publish_partial(df, replace=True)
+                published = len(pieces)
+
+            part = type(criteria)(**criteria)
+            part.starttime = from_epoch_seconds(m0, tzinfo)
+            part.endtime = from_epoch_seconds(m1, tzinfo)
+            part.duration = datetime.timedelta(seconds=m1 - m0)
+
+            segjob = SegmentJob(job, part,
+                                100 * done / total,
+                                100 * (done + m1 - m0) / total)
+            success, df = query(segjob)
+            if not success:
+                return False, None
+            if df is not None:
+                pieces.append(self._slice(df, timecol, m0, m1))
+            done += m1 - m0
+
+        df = self._combine(pieces, timecol)
+        if missing and df is not None and min(t1, limit) > t0:
+            self._store(key, df, timecol, t0, min(t1, limit))
+
+        actual = type(criteria)(**criteria)
+        actual.starttime = from_epoch_seconds(t0, tzinfo)
+        actual.endtime = from_epoch_seconds(t1, tzinfo)
+        actual.duration = datetime.timedelta(seconds=t1 - t0)
+        job.safe_update(actual_criteria=actual)
+
+        return True, df
+
+    def load_summary(self, table, criteria, starttime, endtime):
+        """ Return the cached summary of `table` over a time range.
+
+        Summaries are results over exactly the range from `starttime`
+        to `endtime`, rather than time series that can be sliced.
+        Returns None if there is none.
+        """
+        path = self._summary_path(table, criteria, starttime, endtime)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                os.unlink(path)
+                return None
+            return datastore.load(path)
+        except (IOError, OSError, EOFError):
+            return None
+
+    def store_summary(self, table, criteria, starttime, endtime, df):
+        """ Save `df` as the summary of `table` over a time range.
+
+        Nothing is saved if the range includes data newer than the
+        caching delay, or if `df` has no rows, since callers may keep
+        values that apply to the whole summary in its rows.  Returns
+        True if the summary was saved.
+        """
+        if (df is None or len(df) == 0 or
+                epoch_seconds(endtime) > time.time() - self.delay):
+            return False
+        datastore.save(df, self._summary_path(table, criteria,
+                                              starttime, endtime))
+        return True
+
+    def _summary_path(self, table, criteria, starttime, endtime):
+        key = self.key(table, criteria, kind='summary')
+        return os.path.join(self.path, 'ts-%s-%d-%d.data' %
+                            (key, epoch_seconds(starttime),
+                             epoch_seconds(endtime)))
+
+    def _combine(self, pieces, timecol):
+        """ Return `pieces` concatenated in time order, None if empty. """
+        pieces = [df for df in pieces if len(df) > 0]
+        if not pieces:
+            return None
+        df = pandas.concat(pieces, ignore_index=True)
+        order = numpy.argsort(df[timecol].values, kind='mergesort')
+        return df.take(order).reset_index(drop=True)
+
+    def _slice(self, df, timecol, t0, t1):
+        """ Return the rows of `df` from epoch `t0` up to `t1`. """
+        times = df[timecol].values.astype('datetime64[ns]').view(numpy.int64)
+        mask = (times >= t0 * 10**9) & (times < t1 * 10**9)
+        return df[mask]
+
+    def _store(self, key, df, timecol, t0, t1):
+        """ Save the rows of `df` from `t0` up to `t1` as one segment.
+
+        Segments covered by the new one are removed.
+        """
+        path = os.path.join(self.path, 'ts-%s-%d-%d.data' % (key, t0, t1))
+        datastore.save(self._slice(df, timecol, t0, t1), path)
+
+        for s0, s1, other in self.segments(key):
+            if other != path and s0 >= t0 and s1 <= t1:
+                try:
+                    os.unlink(other)
+                except OSError:
+                    pass
+
+
+# Shared time series cache, None when disabled
+if settings.APPS_DATASOURCE.get('timeseries_cache', False):
+    cache = TimeSeriesCache(
+        settings.DATA_CACHE,
+        delay=settings.APPS_DATASOURCE.get('timeseries_cache_delay', 300),
+        max_age=settings.APPS_DATASOURCE.get('timeseries_cache_max_age',
+                                             7*60*60*24),
+        slice_buckets=settings.APPS_DATASOURCE.get(
+            'timeseries_cache_slice_buckets', 360))
+else:
+    cache = None
@@ -12,6 +12,7 @@ from rvbd_portal.apps.datasource.views import TableList, TableDetail
 from rvbd_portal.apps.datasource.views import TableColumnList, TableJobList
 from rvbd_portal.apps.datasource.views import ColumnList, ColumnDetail
 from rvbd_portal.apps.datasource.views import JobList, JobDetail, JobDetailData
+from rvbd_portal.apps.datasource.views import JobPoolDetail
 
 
 urlpatterns = patterns(
@@ -45,6 +46,10 @@ urlpatterns = patterns(
         JobList.as_view(),
         name='job-list'),
 
+    url(r'^jobs/pool/$',
+        JobPoolDetail.as_view(),
+        name='job-pool-detail'),
+
     url(r'^jobs/(?P<pk>[0-9]+)/$',
         JobDetail.as_view(),
         name='job-detail'),
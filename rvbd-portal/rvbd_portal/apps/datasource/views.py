@@ -9,14 +9,16 @@ import json
 import logging
 
 from rest_framework.reverse import reverse
-from rest_framework import generics
+from rest_framework.response import Response
+from rest_framework import generics, views
 
 from rvbd_portal.apps.datasource.serializers import (TableSerializer,
                                                      ColumnSerializer,
                                                      JobSerializer,
                                                      JobDataSerializer,
                                                      JobListSerializer)
-from rvbd_portal.apps.datasource.models import Table, Column, Job, Criteria
+from rvbd_portal.apps.datasource.models import (Table, Column, Job, Criteria,
+                                                worker_pool)
 
 
 logger = logging.getLogger(__name__)
@@ -121,3 +123,10 @@ class JobDetail(generics.RetrieveAPIView):
 class JobDetailData(generics.RetrieveAPIView):
     model = Job
     serializer_class = JobDataSerializer
+
+
+class JobPoolDetail(views.APIView):
+    """ Return queue depth and worker counts for the job worker pool. """
+
+    def get(self, request, format=None):
+        return Response(worker_pool.stats())
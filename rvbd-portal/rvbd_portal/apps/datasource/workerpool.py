@@ -0,0 +1,166 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import Queue
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+
+from rvbd_portal.apps.datasource.exceptions import WorkerPoolFull
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool(object):
+    """ Fixed size pool of threads servicing a priority queue of work.
+
+    Work is submitted as a callable with a priority, lower values are
+    run first and work of equal priority is run in submission order.
+    Threads are started on demand up to `size`, so an idle process
+    does not carry any pool threads.
+
+    `max_queued` bounds the number of items waiting for a free thread.
+    When 0 (default) the queue is unbounded, otherwise `submit` raises
+    WorkerPoolFull once the limit is reached.
+
+    A pool thread that has to wait on other work submitted to the same
+    pool (for example an analysis table waiting on its dependent jobs)
+    should do so inside a `blocking()` block.  The pool then allows
+    one additional thread to run for the duration of the wait, so a
+    pool full of waiting threads cannot deadlock.
+    """
+
+    # Seconds an idle thread waits for work before checking if it
+    # is surplus to requirements
+    idle_timeout = 5
+
+    def __init__(self, name, size, max_queued=0):
+        self.name = name
+        self.size = size
+        self.max_queued = max_queued
+
+        self._queue = Queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._threads = []
+        self._active = 0
+        self._blocked = 0
+
+        # Items submitted and not yet taken by a thread.  Unlike the
+        # queue size this only drops once the taking thread counts as
+        # active, so the two are always consistent under self._lock.
+        self._waiting = 0
+
+    def __str__(self):
+        return "<WorkerPool %s>" % self.name
+
+    def __repr__(self):
+        return str(self)
+
+    def submit(self, func, args=None, priority=0):
+        """ Queue `func(*args)` to be run by a pool thread. """
+        with self._lock:
+            queued = self._queue.qsize()
+            if self.max_queued and queued >= self.max_queued:
+                raise WorkerPoolFull("%s: %d jobs already waiting to run" %
+                                     (self, queued))
+
+            self._queue.put((priority, self._seq.next(), func, args or ()))
+            self._waiting += 1
+
+            idle = len(self._threads) - self._active
+            if self._waiting > idle and len(self._threads) < self._target():
+                self._start_thread()
+
+    def stats(self):
+        """ Return a dict describing the current load on the pool. """
+        with self._lock:
+            return {'name': self.name,
+                    'size': self.size,
+                    'threads': len(self._threads),
+                    'active': self._active,
+                    'blocked': self._blocked,
+                    'queued': self._queue.qsize(),
+                    'max_queued': self.max_queued}
+
+    def in_worker(self):
+        """ Return True if the calling thread is a thread of this pool. """
+        return getattr(self._local, 'worker', False)
+
+    @contextmanager
+    def blocking(self):
+        """ Mark the calling pool thread as waiting on other pool work.
+
+        This is a no-op when not called from one of the pool threads.
+        """
+        if not self.in_worker():
+            yield
+            return
+
+        with self._lock:
+            self._blocked += 1
+            if (self._waiting > 0 and
+                    len(self._threads) < self._target()):
+                self._start_thread()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._blocked -= 1
+
+    def _target(self):
+        return self.size + self._blocked
+
+    def _start_thread(self):
+        # Must be called with self._lock held
+        t = threading.Thread(target=self._run,
+                             name="%s-%d" % (self.name, self._seq.next()))
+        t.daemon = True
+        self._threads.append(t)
+        t.start()
+        logger.debug("%s: started thread %s (%d threads)" %
+                     (self, t.name, len(self._threads)))
+
+    def _retire(self):
+        # Must be called with self._lock held
+        if len(self._threads) > self._target():
+            self._threads.remove(threading.current_thread())
+            logger.debug("%s: retired thread %s (%d threads)" %
+                         (self, threading.current_thread().name,
+                          len(self._threads)))
+            return True
+        return False
+
+    def _run(self):
+        self._local.worker = True
+        while True:
+            try:
+                _, _, func, args = self._queue.get(timeout=self.idle_timeout)
+            except Queue.Empty:
+                with self._lock:
+                    if self._retire():
+                        return
+                continue
+
+            with self._lock:
+                self._active += 1
+                self._waiting -= 1
+            try:
+                func(*args)
+            except:
+                logger.exception("%s: unhandled exception in %s" %
+                                 (self, func))
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    retired = self._retire()
+                self._queue.task_done()
+
+            if retired:
+                return
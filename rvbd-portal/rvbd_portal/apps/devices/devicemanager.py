@@ -11,30 +11,129 @@ import importlib
 import threading
 
 from rvbd.common import UserAuth
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
 from rvbd_portal.apps.devices.models import Device
 from rvbd_portal.apps.devices.exceptions import DeviceModuleNotFound
 from rvbd_portal.apps.plugins import plugins
+from rvbd_portal.apps.datasource.notify import SharedCounter
 
 logger = logging.getLogger(__name__)
 
 lock = threading.Lock()
 
+# Bumped whenever a device is saved or deleted in any process
+devices_version = SharedCounter('devices')
+
+
+def _connection(ds):
+    # Settings an active device instance was created with
+    return (ds.module, ds.host, ds.port, ds.username, ds.password)
+
 
 class DeviceManager(object):
     # map of active devices by datasource_id
     devices = {}
 
+    # map of semaphores limiting concurrent calls by datasource_id
+    slots = {}
+
+    # map of Device records by id, loaded on first use
+    records = None
+
+    # devices_version the records were loaded at
+    version = None
+
+    # ids of enabled devices still configured with placeholder values
+    invalid = None
+
     @classmethod
     def clear(cls, device_id=None):
-        if device_id and device_id in cls.devices:
-            del cls.devices[device_id]
-        else:
-            cls.devices = {}
+        """ Forget cached state of `device_id`, or of all devices if None. """
+        with lock:
+            cls.records = None
+            cls.invalid = None
+            if device_id is not None:
+                cls.devices.pop(device_id, None)
+                cls.slots.pop(device_id, None)
+            else:
+                cls.devices = {}
+                cls.slots = {}
+
+    @classmethod
+    def _load_records(cls):
+        version = devices_version.value()
+        with lock:
+            if cls.records is None or cls.version != version:
+                records = dict((ds.id, ds) for ds in Device.objects.all())
+                if cls.records is not None:
+                    # Changed by another process, drop the instances
+                    # connected with old settings
+                    for device_id, old in cls.records.iteritems():
+                        new = records.get(device_id)
+                        if new is None or _connection(new) != _connection(old):
+                            cls.devices.pop(device_id, None)
+                            cls.slots.pop(device_id, None)
+                cls.invalid = set(ds.id for ds in records.itervalues()
+                                  if ds.enabled and not ds.is_configured())
+                cls.records = records
+                cls.version = version
+            return cls.records, cls.invalid
+
+    @classmethod
+    def get_record(cls, device_id):
+        """ Return the Device record for `device_id`.
+
+        Records are cached in memory and reloaded after any device is
+        saved or deleted, in this or any other process.  Raises
+        Device.DoesNotExist for unknown ids.
+        """
+        records, _ = cls._load_records()
+        try:
+            return records[int(device_id)]
+        except KeyError:
+            raise Device.DoesNotExist('Device %s does not exist' % device_id)
+
+    @classmethod
+    def has_invalid_devices(cls):
+        """ Return True if any enabled device still needs to be set up. """
+        _, invalid = cls._load_records()
+        return len(invalid) > 0
+
+    @classmethod
+    def max_concurrent_calls(cls, module):
+        """ Return the number of calls allowed at once to a device. """
+        limits = getattr(settings, 'APPS_DEVICES', {}).get(
+            'max_concurrent_calls', {})
+        return limits.get(module, limits.get('default', 4))
+
+    @classmethod
+    def slot(cls, device_id):
+        """ Return a semaphore guarding calls to the given device.
+
+        Each device allows up to `max_concurrent_calls` holders at once,
+        so queries against different devices never wait on each other.
+        Use it as a context manager around all calls for one query:
+
+            with DeviceManager.slot(criteria.profiler_device):
+                report.run(...)
+
+        """
+        ds = cls.get_record(device_id)
+        device_id = ds.id
+        with lock:
+            if device_id not in cls.slots:
+                n = cls.max_concurrent_calls(ds.module)
+                logger.debug("Allowing %d concurrent calls to device %s" %
+                             (n, ds.name))
+                cls.slots[device_id] = threading.BoundedSemaphore(n)
+            return cls.slots[device_id]
 
     @classmethod
     def get_device(cls, device_id):
-        ds = Device.objects.get(id=device_id)
+        ds = cls.get_record(device_id)
 
         with lock:
             if ds.id not in cls.devices:
@@ -61,3 +160,12 @@ class DeviceManager(object):
     def get_modules(cls):
         """ Returns list of device modules. """
         return [module for module, pkg in plugins.devices()]
+
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def _device_changed(sender, instance, **kwargs):
+    # Drop the records and any instance connected with the old settings,
+    # other processes reload theirs on next use
+    devices_version.increment()
+    DeviceManager.clear(instance.id)
@@ -58,6 +58,13 @@ class Device(models.Model):
     def __unicode__(self):
         return '%s (%s:%s)' % (self.name, self.host, self.port)
 
+    def is_configured(self):
+        """ Return False if any setting still holds a placeholder value. """
+        return not ('host.or.ip' in self.host or
+                    self.username == '<username>' or
+                    self.password == '<password>' or
+                    self.password == '')
+
     def save(self, *args, **kwargs):
         super(Device, self).save(*args, **kwargs)
         create_device_fixture()
@@ -136,5 +136,9 @@ class Command(BaseCommand):
 
             report.delete()
 
+        if options['applications'] or options['report_id']:
+            # Table ids may be reused, drop cached columns in all processes
+            Table.clear_column_cache()
+
         # rotate the logs once
         management.call_command('rotate_logs')
@@ -12,7 +12,8 @@ from django.core.management.base import BaseCommand
 from django.core import management
 from django.core.exceptions import ObjectDoesNotExist
 
-from rvbd_portal.apps.report.models import Report
+from rvbd_portal.apps.report.models import Report, clear_fields_cache
+from rvbd_portal.apps.datasource.models import Table
 from rvbd_portal.apps.devices.devicemanager import DeviceManager
 
 from django.conf import settings
@@ -84,6 +85,11 @@ class Command(BaseCommand):
         management.call_command('clean_pyc', path=settings.PROJECT_ROOT)
         management.call_command('syncdb', interactive=False)
 
+        # Tables and reports are recreated, drop anything cached about
+        # the old ones
+        Table.clear_column_cache()
+        clear_fields_cache()
+
         self.importer = Importer(buf=self.stdout)
 
         if options['report_id']:
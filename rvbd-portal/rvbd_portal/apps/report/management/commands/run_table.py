@@ -7,7 +7,6 @@
 # This software is distributed "AS IS" as set forth in the License.
 
 
-import time
 import datetime
 import optparse
 import sys
@@ -202,10 +201,7 @@ class Command(BaseCommand):
             self.console('Job running . . ', ending='')
 
             # wait for results
-            while not job.done():
-                #self.console('. ', ending='')
-                #self.stdout.flush()
-                time.sleep(1)
+            job.wait()
 
             end_time = datetime.datetime.now()
             delta = end_time - start_time
@@ -15,18 +15,36 @@ from django.db import models
 from django.db.models import Max, Sum
 from django.template.defaultfilters import slugify
 from django.db import transaction
-from django.db.models.signals import pre_delete
+from django.db.models.signals import (pre_delete, post_save, post_delete,
+                                      m2m_changed)
 from django.dispatch import receiver
 from django.utils.datastructures import SortedDict
 from django.core.exceptions import ObjectDoesNotExist
 
 from model_utils.managers import InheritanceManager
 from rvbd_portal.apps.datasource.models import Table, Job, TableField
+from rvbd_portal.apps.datasource.notify import definitions_version
 
 from rvbd_portal.libs.fields import PickledObjectField, SeparatedValuesField
 
 logger = logging.getLogger(__name__)
 
+# Field maps of reports and widgets by id, each with the definitions version
+# it was collected at, see Report.collect_fields_by_section and
+# Widget.collect_fields
+_fields_cache = {}
+
+
+def _cached_fields(key, collect):
+    # Reloading reports may reuse ids, so entries collected before the
+    # last reload in any process are stale
+    version = definitions_version.value()
+    entry = _fields_cache.get(key)
+    if entry is None or entry[0] != version:
+        entry = (version, collect())
+        _fields_cache[key] = entry
+    return entry[1]
+
 
 class WidgetOptions(JsonDict):
     _default = {'key': None,
@@ -96,8 +114,19 @@ class Report(models.Model):
 
     def collect_fields_by_section(self):
         """ Return a dict of all fields related to this report by section id.
+
+        The result is cached per process.  The cache is cleared when any
+        part of a report definition is changed in this process, and when
+        definitions are reloaded in any process.
         """
+        fields_by_section = _cached_fields(('report', self.id),
+                                           self._collect_fields_by_section)
+
+        # Callers are free to modify the field dicts they get
+        return dict((i, fields.copy())
+                    for i, fields in fields_by_section.iteritems())
 
+    def _collect_fields_by_section(self):
         # map of section id to field dict
         fields_by_section = {}
 
@@ -368,6 +397,13 @@ class Widget(models.Model):
         return fields
 
     def collect_fields(self):
+        """ Return all fields related to this widget by keyword.
+
+        Cached like Report.collect_fields_by_section().
+        """
+        return _cached_fields(('widget', self.id), self._collect_fields).copy()
+
+    def _collect_fields(self):
         # Gather up all fields
         fields = SortedDict()
 
@@ -405,6 +441,36 @@ class WidgetJob(models.Model):
             super(WidgetJob, self).save(*args, **kwargs)
 
 
+def clear_fields_cache():
+    """ Forget the cached field maps of all reports and widgets.
+
+    Also drops them in other processes, on their next lookup.
+    """
+    definitions_version.increment()
+    _fields_cache.clear()
+
+
+@receiver(post_save, sender=Report)
+@receiver(post_delete, sender=Report)
+@receiver(post_save, sender=Section)
+@receiver(post_delete, sender=Section)
+@receiver(post_save, sender=SectionFieldMode)
+@receiver(post_delete, sender=SectionFieldMode)
+@receiver(post_save, sender=Widget)
+@receiver(post_delete, sender=Widget)
+@receiver(post_save, sender=Table)
+@receiver(post_delete, sender=Table)
+@receiver(post_save, sender=TableField)
+@receiver(post_delete, sender=TableField)
+@receiver(m2m_changed, sender=Report.fields.through)
+@receiver(m2m_changed, sender=Section.fields.through)
+@receiver(m2m_changed, sender=Widget.tables.through)
+@receiver(m2m_changed, sender=Table.fields.through)
+def _definition_changed(sender, **kwargs):
+    """ Clear the fields cache of this process when a report changes. """
+    _fields_cache.clear()
+
+
 @receiver(pre_delete, sender=WidgetJob)
 def _widgetjob_delete(sender, instance, **kwargs):
     try:
@@ -10,10 +10,14 @@ import math
 import datetime
 import logging
 
+import numpy
+
 from rvbd.common import timeutils
 from rvbd.common.jsondict import JsonDict
 
 from rvbd_portal.libs.nicescale import NiceScale
+from rvbd_portal.libs.downsample import minmax_indices
+from rvbd_portal.apps.datasource import datastore
 from rvbd_portal.apps.report.models import Axes, Widget
 
 logger = logging.getLogger(__name__)
@@ -23,12 +27,41 @@ def cleankey(s):
     return re.sub('[:. ]', '_', s)
 
 
+def time_ms(t):
+    """ Convert a datetime or epoch seconds to epoch milliseconds. """
+    try:
+        return timeutils.datetime_to_microseconds(t) / 1000
+    except AttributeError:
+        return t * 1000
+
+
+def wire_data(widget, columns, length):
+    """ Return widget data given as a dict of key to column values.
+
+    yui3 expects a list of dicts, one per row.  If the 'wire_format'
+    widget option is 'columns' (default) the column lists are sent
+    as is and turned into rows by the browser, this is far smaller
+    and quicker to encode than repeating every key in every row.
+    Set 'wire_format' to 'rows' to build the list of dicts here.
+    """
+    options = widget.options or {}
+    if options.get('wire_format', 'columns') == 'columns':
+        return {'wireFormat': 'columns',
+                'length': length,
+                'columns': columns}
+
+    keys = columns.keys()
+    return [dict(zip(keys, row)) for row in zip(*[columns[k] for k in keys])]
+
+
 class TableWidget(object):
     @classmethod
-    def create(cls, section, table, title, width=6, rows=1000, height=300):
+    def create(cls, section, table, title, width=6, rows=1000, height=300,
+               wire_format='columns'):
         w = Widget(section=section, title=title, rows=rows, width=width,
                    height=height, module=__name__, uiwidget=cls.__name__)
         w.compute_row_col()
+        w.options = JsonDict(wire_format=wire_format)
         w.save()
         w.tables.add(table)
 
@@ -62,29 +95,19 @@ class TableWidget(object):
                 w_column['allowHTML'] = True
             w_columns.append(w_column)
 
-        rows = []
-
-        for rawrow in data:
-            row = {}
-
-            for i, key in enumerate(w_keys):
-                if colinfo[key].istime:
-                    t = rawrow[i]
-                    try:
-                        val = timeutils.datetime_to_microseconds(t) / 1000
-                    except AttributeError:
-                        val = t * 1000
-                else:
-                    val = rawrow[i]
+        w_data = {}
+        rawcolumns = zip(*data) or [()] * len(w_keys)
 
-                row[key] = val
-
-            rows.append(row)
+        for key, rawcolumn in zip(w_keys, rawcolumns):
+            if colinfo[key].istime:
+                w_data[key] = [time_ms(t) for t in rawcolumn]
+            else:
+                w_data[key] = list(rawcolumn)
 
         data = {
             "chartTitle": widget.title.format(**job.actual_criteria),
             "columns": w_columns,
-            "data": rows
+            "data": wire_data(widget, w_data, len(data))
         }
 
         return data
@@ -151,9 +174,14 @@ class PieWidget(object):
 
 
 class TimeSeriesWidget(object):
+    # process() is passed the job data as a DataFrame, see
+    # report.views.widget_table_data()
+    uses_dataframe = True
+
     @classmethod
     def create(cls, section, table, title, width=6, height=300,
-               stacked=False, cols=None, altaxis=None):
+               stacked=False, cols=None, altaxis=None, wire_format='columns',
+               max_points=None):
         w = Widget(section=section, title=title, width=width, height=height,
                    module=__name__, uiwidget=cls.__name__)
         w.compute_row_col()
@@ -175,7 +203,9 @@ class TimeSeriesWidget(object):
                           'columns': cols}}
         w.options = JsonDict(axes=axes,
                              columns=cols,
-                             stacked=stacked)
+                             stacked=stacked,
+                             wire_format=wire_format,
+                             max_points=max_points)
         w.save()
         w.tables.add(table)
 
@@ -183,10 +213,9 @@ class TimeSeriesWidget(object):
     def process(cls, widget, job, data):
 
         class ColInfo:
-            def __init__(self, col, dataindex, axis, istime=False):
+            def __init__(self, col, axis, istime=False):
                 self.col = col
                 self.key = cleankey(col.name)
-                self.dataindex = dataindex
                 self.axis = axis
                 self.istime = istime
 
@@ -205,15 +234,25 @@ class TimeSeriesWidget(object):
         w_keys = [cleankey(n) for n in valuecolnames]
 
         # Retrieve the desired value columns
-        # ...and the indices for the value values
-        # (as the 'data' has *all* columns)
-        for i, c in enumerate(t_cols):
+        for c in t_cols:
             if c.datatype == 'time':
-                ci = ColInfo(c, i, -1, istime=True)
+                ci = ColInfo(c, -1, istime=True)
             elif c.name in valuecolnames:
-                ci = ColInfo(c, i, -1, istime=False)
+                ci = ColInfo(c, -1, istime=False)
+            else:
+                continue
             colinfo[ci.key] = ci
 
+        t_name = colinfo['time'].col.name
+        df = data[[t_name] + valuecolnames]
+        df = df.convert_objects(convert_numeric=True)
+
+        # Reduce the number of points plotted if requested, keeping
+        # the rows with the min/max of each series over the time range
+        max_points = widget.options.get('max_points', None)
+        if max_points and len(df) > max_points:
+            df = df.iloc[minmax_indices(df[valuecolnames].values, max_points)]
+
         w_series = []
         axes = Axes(widget.options.axes)
 
@@ -224,18 +263,22 @@ class TimeSeriesWidget(object):
                            "styles": {"label": {"fontSize": "8pt",
                                                 "rotation": "-45"}}}}
 
-        # Create a better time format depending on t0/t1
-        t_dataindex = colinfo['time'].dataindex
+        # Times as epoch milliseconds
+        times = df[t_name].values
+        if times.dtype.kind == 'M':
+            times = times.astype('datetime64[ms]').astype(numpy.int64)
+        else:
+            times = times * 1000
 
-        t0 = data[0][t_dataindex]
-        t1 = data[-1][t_dataindex]
-        if not hasattr(t0, 'utcfromtimestamp'):
-            t0 = datetime.datetime.fromtimestamp(t0)
-            t1 = datetime.datetime.fromtimestamp(t1)
+        # Create a better time format depending on t0/t1
+        if len(times) > 0:
+            span = datetime.timedelta(milliseconds=int(times[-1] - times[0]))
+        else:
+            span = datetime.timedelta(0)
 
-        if (t1 - t0).seconds < 2:
+        if span.seconds < 2:
             w_axes['time']['formatter'] = 'formatTimeMs'
-        elif (t1 - t0).seconds < 120:
+        elif span.seconds < 120:
             w_axes['time']['labelFormat'] = '%k:%M:%S'
         else:
             w_axes['time']['labelFormat'] = '%k:%M'
@@ -263,70 +306,41 @@ class TimeSeriesWidget(object):
 
             w_axes[axis_name]['keys'].append(ci.key)
 
-        # Output row data
-        rows = []
-
-        # min/max values by axis 0/1
-        minval = {}
-        maxval = {}
+        # Output data by column
+        valuecols = [colinfo[k] for k in w_keys]
+        values = datastore.to_lists(df, [ci.col.name for ci in valuecols],
+                                    orient='columns')
+        w_data = dict(zip(w_keys, values))
+        w_data['time'] = times.tolist()
 
         stacked = widget.options.stacked
-        # Iterate through all rows if input data
-        for rawrow in data:
-            t = rawrow[t_dataindex]
-            try:
-                t = timeutils.datetime_to_microseconds(t) / 1000
-            except AttributeError:
-                t = t * 1000
-
-            row = {'time': t}
-            rowmin = {}
-            rowmax = {}
-            for ci in colinfo.values():
-                if ci.istime:
-                    continue
-                a = ci.axis
-                val = rawrow[ci.dataindex]
-                row[ci.key] = val if val != '' else None
-
-                if a not in rowmin:
-                    rowmin[a] = val if val != '' else 0
-                    rowmax[a] = val if val != '' else 0
-                else:
-                    rowmin[a] = (rowmin[a] + val) if stacked else min(rowmin[a],
-                                                                      val)
-                    rowmax[a] = (rowmax[a] + val) if stacked else max(rowmax[a],
-                                                                      val)
-
-            for a in rowmin.keys():
-                minval[a] = rowmin[a] if (a not in minval) else min(minval[a],
-                                                                    rowmin[a])
-                maxval[a] = rowmax[a] if (a not in maxval) else max(maxval[a],
-                                                                    rowmax[a])
-
-            rows.append(row)
 
-        # Setup the scale values for the axes
-        for ci in colinfo.values():
-            if ci.istime:
-                continue
-
-            axis_name = 'axis' + str(ci.axis)
+        # Setup the scale values for the axes, stacked series are
+        # scaled to the range of the per row sum of the axis columns
+        for axis in set(ci.axis for ci in valuecols):
+            axis_name = 'axis' + str(axis)
+            names = [ci.col.name for ci in valuecols if ci.axis == axis]
+            values = df[names].values.astype(float)
+            if stacked:
+                values = numpy.where(numpy.isnan(values), 0, values).sum(axis=1)
+            values = values[~numpy.isnan(values)]
 
-            if minval and maxval:
-                n = NiceScale(minval[ci.axis], maxval[ci.axis])
+            if len(values) > 0:
+                n = NiceScale(values.min(), values.max())
 
                 w_axes[axis_name]['minimum'] = "%.10f" % n.niceMin
                 w_axes[axis_name]['maximum'] = "%.10f" % n.niceMax
                 w_axes[axis_name]['tickExponent'] = math.log10(n.tickSpacing)
                 w_axes[axis_name]['styles'] = {'majorUnit': {'count': n.numTicks}}
             else:
-                # empty data which would result in keyError above
+                # empty data, no scale to compute
                 w_axes[axis_name]['minimum'] = "0"
                 w_axes[axis_name]['maximum'] = "1"
                 w_axes[axis_name]['tickExponent'] = 1
                 w_axes[axis_name]['styles'] = {'majorUnit': {'count': 1}}
 
+        for ci in valuecols:
+            axis_name = 'axis' + str(ci.axis)
             if ci.col.datatype == 'bytes':
                 w_axes[axis_name]['formatter'] = 'formatBytes'
             elif ci.col.datatype == 'metric':
@@ -336,7 +350,7 @@ class TimeSeriesWidget(object):
             "chartTitle": widget.title.format(**job.actual_criteria),
             "type": "area" if stacked else "combo",
             "stacked": stacked,
-            "dataProvider": rows,
+            "dataProvider": wire_data(widget, w_data, len(df)),
             "seriesCollection": w_series,
             "axes": w_axes,
             "legend": {"position": "bottom",
@@ -352,7 +366,8 @@ class TimeSeriesWidget(object):
 class ChartWidget(object):
     @classmethod
     def create(cls, section, table, title, width=6, rows=10, height=300,
-               keycols=None, valuecols=None, chart_type='line'):
+               keycols=None, valuecols=None, chart_type='line',
+               wire_format='columns'):
         w = Widget(section=section, title=title, rows=rows, width=width,
                    height=height, module=__name__, uiwidget=cls.__name__)
         w.compute_row_col()
@@ -369,7 +384,8 @@ class ChartWidget(object):
         w.options = JsonDict(dict={'keycols': keycols,
                                    'columns': valuecols,
                                    'axes': None,
-                                   'chart_type': chart_type})
+                                   'chart_type': chart_type,
+                                   'wire_format': wire_format})
         w.save()
         w.tables.add(table)
 
@@ -446,8 +462,11 @@ class ChartWidget(object):
 
             w_axes[axis_name]['keys'].append(c.name)
 
-        # Array of actual data yui3 style.  Each row is a dict of key->value
-        rows = []
+        # Actual data by column, the category column first
+        w_data = {catname: []}
+        for c in colmap.values():
+            if not c.col.iskey:
+                w_data[c.col.name] = []
 
         # min/max values by axis 0/1
         minval = {}
@@ -456,7 +475,6 @@ class ChartWidget(object):
         stacked = False  # XXXCJ
 
         for rawrow in data:
-            row = {}
             rowmin = {}
             rowmax = {}
 
@@ -466,7 +484,7 @@ class ChartWidget(object):
                 if not c.col.iskey:
                     continue
                 keyvals.append(rawrow[c.dataindex])
-            row[catname] = ','.join(keyvals)
+            w_data[catname].append(','.join(keyvals))
 
             # collect the data values
             for c in colmap.values():
@@ -476,7 +494,7 @@ class ChartWidget(object):
 
                 # Set the value
                 val = rawrow[c.dataindex]
-                row[c.col.name] = val
+                w_data[c.col.name].append(val)
 
 
                 a = c.axis
@@ -494,7 +512,6 @@ class ChartWidget(object):
                                                                     rowmin[a])
                 maxval[a] = rowmax[a] if (a not in maxval) else max(maxval[a],
                                                                     rowmax[a])
-            rows.append(row)
 
         # Build up axes
         for c in colmap.values():
@@ -521,7 +538,7 @@ class ChartWidget(object):
             "chartTitle": widget.title.format(**job.actual_criteria),
             "type": widget.options.chart_type,
             "categoryKey": catname,
-            "dataProvider": rows,
+            "dataProvider": wire_data(widget, w_data, len(data)),
             "seriesCollection": series,
             "axes": w_axes,
             "legend": {"position": "bottom",
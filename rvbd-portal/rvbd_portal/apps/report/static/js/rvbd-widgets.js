@@ -42,30 +42,66 @@ function Widget (posturl, divid, options, criteria) {
     $('#' + divid).showLoading();
     $('#' + divid).setLoading(0);
     var self = this;
+
+    // Let the report create the jobs of all widgets at once if it can
+    if (typeof rvbd_job_batch !== 'undefined' && rvbd_job_batch &&
+        options.widgetid !== undefined) {
+        rvbd_job_batch.add(self, options.widgetid, criteria);
+        return;
+    }
+
     $.ajax({
         dataType: "json",
         type: "POST",
         url: self.posturl,
         data : { criteria: JSON.stringify(criteria) },
         success: function(data, textStatus) {
-            self.joburl = data.joburl,
-            setTimeout(function() { self.getData(criteria) }, 1000);
+            self.jobCreated(criteria, data);
         },
         error: function(jqXHR, textStatus, errorThrown) { 
-            $('#' + self.divid).hideLoading();
-            var message = $("<div/>").html(textStatus + " : " + errorThrown).text()
-            $('#' + self.divid).html("<p>Server error: <pre>" + message + "</pre></p>");
-            rvbd_status[self.posturl] = 'error';
+            self.showError(textStatus + " : " + errorThrown);
         }
     });
 }
 
+Widget.prototype.jobCreated = function(criteria, data) {
+    this.joburl = data.joburl,
+    this.jobid = data.jobid;
+    if (typeof rvbd_job_poller !== 'undefined' && rvbd_job_poller) {
+        this.poller = rvbd_job_poller;
+        this.poller.add(this, criteria);
+    } else {
+        this.getData(criteria);
+    }
+}
+
+Widget.prototype.showError = function(text) {
+    $('#' + this.divid).hideLoading();
+    var message = $("<div/>").html(text).text()
+    $('#' + this.divid).html("<p>Server error: <pre>" + message + "</pre></p>");
+    rvbd_status[this.posturl] = 'error';
+}
+
+// Seconds the server may hold a job status request waiting for a change
+Widget.prototype.pollWait = 30;
+
+// Minimum milliseconds between job status requests
+Widget.prototype.pollInterval = 1000;
+
 Widget.prototype.getData = function(criteria) {
     var self = this;
+    var params = { wait: self.pollWait };
+    if (self.progress !== undefined) {
+        params.progress = self.progress;
+    }
+    if (self.partial !== undefined) {
+        params.partial = self.partial;
+    }
+    self.pollStarted = new Date().getTime();
     $.ajax({
         dataType: "json",
         url: self.joburl, 
-        data: null,
+        data: params,
         success: function(data, textStatus) { 
             self.processResponse(criteria, data, textStatus); 
         },
@@ -93,11 +129,207 @@ Widget.prototype.processResponse = function(criteria, response, textStatus)
         $('#' + this.divid).html("<p>Server error: <pre>" + message + "</pre></p>");
         rvbd_status[self.posturl] = 'error';
     } else {
-        if (response.progress > 0) {
+        if (response.data) {
+            // Partial result of a job still running, show what there is
+            // so far and keep polling for the rest
+            $('#' + this.divid).hideLoading();
+            this.render(response.data);
+            self.partialShown = true;
+        } else if (response.progress > 0 && !self.partialShown) {
             $('#' + this.divid).setLoading(response.progress);
         }
-        setTimeout(function() { self.getData(criteria) }, 1000);
+        self.progress = response.progress;
+        self.partial = response.partial;
+
+        // The shared JobPoller, if any, takes care of polling again
+        if (self.poller) {
+            return;
+        }
+
+        // The server holds the request until something changes, so poll
+        // again right away unless it answered quicker than pollInterval
+        var elapsed = new Date().getTime() - self.pollStarted;
+        setTimeout(function() { self.getData(criteria) },
+                   Math.max(0, self.pollInterval - elapsed));
+    }
+}
+
+/**
+ * Create the jobs of all widgets on a report page with one request.
+ *
+ * Widgets register themselves with add() instead of posting their own
+ * job, submit() then posts all of them and hands each widget its job
+ * (or error) from the response.
+ */
+function JobBatch (posturl) {
+    this.posturl = posturl;
+    this.entries = [];
+}
+
+JobBatch.prototype.add = function(widget, widgetid, criteria) {
+    this.entries.push({ widget: widget, widgetid: widgetid, criteria: criteria });
+}
+
+JobBatch.prototype.submit = function() {
+    var self = this;
+    var entries = self.entries;
+    self.entries = [];
+    if (entries.length == 0) {
+        return;
+    }
+
+    var jobs = $.map(entries, function(e) {
+        return { widgetid: e.widgetid, criteria: e.criteria };
+    });
+
+    $.ajax({
+        dataType: "json",
+        type: "POST",
+        url: self.posturl,
+        data: { jobs: JSON.stringify(jobs) },
+        success: function(data, textStatus) {
+            $.each(entries, function(i, e) {
+                if (data[i].error) {
+                    e.widget.showError(data[i].error);
+                } else {
+                    e.widget.jobCreated(e.criteria, data[i]);
+                }
+            });
+        },
+        error: function(jqXHR, textStatus, errorThrown) {
+            $.each(entries, function(i, e) {
+                e.widget.showError(textStatus + " : " + errorThrown);
+            });
+        }
+    });
+}
+
+/**
+ * Poll the status of all widget jobs on a report page with one request.
+ *
+ * Widgets register themselves with add() once their job is created.
+ * Each poll asks the server for the status of every job still running
+ * and hands each job's response to its widget's processResponse().
+ *
+ * The server keeps sending the final state of a job until a later
+ * poll lists it in 'done', so a response that never arrives does not
+ * lose it.
+ */
+function JobPoller (statusurl) {
+    this.statusurl = statusurl;
+    this.jobs = {};
+    this.done = [];
+    this.request = null;
+    this.scheduled = false;
+    this.stopped = false;
+}
+
+JobPoller.prototype.pollWait = Widget.prototype.pollWait;
+JobPoller.prototype.pollInterval = Widget.prototype.pollInterval;
+
+JobPoller.prototype.add = function(widget, criteria) {
+    this.jobs[widget.jobid] = { widget: widget, criteria: criteria };
+
+    // An outstanding long poll picks the new job up on its next round,
+    // otherwise poll once all widgets added together are registered
+    if (!this.request) {
+        this.schedule(0);
+    }
+}
+
+JobPoller.prototype.stop = function() {
+    this.stopped = true;
+    if (this.request) {
+        this.request.abort();
+    }
+}
+
+JobPoller.prototype.schedule = function(delay) {
+    var self = this;
+    if (self.scheduled) {
+        return;
+    }
+    self.scheduled = true;
+    setTimeout(function() {
+        self.scheduled = false;
+        self.poll();
+    }, delay);
+}
+
+JobPoller.prototype.fail = function(id, text) {
+    var w = this.jobs[id].widget;
+    delete this.jobs[id];
+    $('#' + w.divid).hideLoading();
+    var message = $("<div/>").html(text).text()
+    $('#' + w.divid).html("<p>Server error: <pre>" + message + "</pre></p>");
+    rvbd_status[w.posturl] = 'error';
+}
+
+JobPoller.prototype.poll = function() {
+    var self = this;
+    var ids = [];
+    var progress = [];
+    var partial = [];
+    $.each(self.jobs, function(id, job) {
+        ids.push(id);
+        progress.push(job.widget.progress || 0);
+        partial.push(job.widget.partial || 0);
+    });
+    var done = self.done;
+    if (self.stopped || self.request || (ids.length == 0 && done.length == 0)) {
+        return;
     }
+
+    var started = new Date().getTime();
+    var request = $.ajax({
+        dataType: "json",
+        url: self.statusurl,
+        data: { ids: ids.join(','),
+                progress: progress.join(','),
+                partial: partial.join(','),
+                done: done.join(','),
+                wait: ids.length ? self.pollWait : 0 },
+        success: function(data, textStatus) {
+            // The server has forgotten the jobs acknowledged above
+            self.done = self.done.slice(done.length);
+
+            $.each(ids, function(i, id) {
+                var job = self.jobs[id];
+                if (job === undefined) {
+                    return;
+                }
+                var response = data[id];
+                if (response === undefined) {
+                    self.fail(id, "Job " + id + " is no longer available");
+                    return;
+                }
+                if (response.status == 3 || response.status == 4) {
+                    delete self.jobs[id];
+                    self.done.push(id);
+                }
+                job.widget.processResponse(job.criteria, response, textStatus);
+            });
+        },
+        error: function(jqXHR, textStatus, errorThrown) {
+            if (textStatus == 'abort') {
+                return;
+            }
+            $.each(ids, function(i, id) {
+                if (self.jobs[id] !== undefined) {
+                    self.fail(id, textStatus + " : " + errorThrown);
+                }
+            });
+        },
+        complete: function(jqXHR, textStatus) {
+            if (self.request !== request || textStatus == 'abort') {
+                return;
+            }
+            self.request = null;
+            var elapsed = new Date().getTime() - started;
+            self.schedule(Math.max(0, self.pollInterval - elapsed));
+        }
+    });
+    self.request = request;
 }
 
 Widget.prototype.render = function(data)
@@ -9,6 +9,33 @@
 
 var rvbd_yui3 = {};
 
+/**
+ * Expand data sent in the 'columns' wire format into the list of row
+ * objects yui3 expects.  Data in any other form is returned as is.
+ */
+rvbd_yui3.decodeRows = function(data) {
+    if (!data || data.wireFormat != 'columns') {
+        return data;
+    }
+
+    var keys = [];
+    var columns = [];
+    $.each(data.columns, function(key, column) {
+        keys.push(key);
+        columns.push(column);
+    });
+
+    var rows = new Array(data.length);
+    for (var i = 0; i < data.length; i++) {
+        var row = {};
+        for (var j = 0; j < keys.length; j++) {
+            row[keys[j]] = columns[j][i];
+        }
+        rows[i] = row;
+    }
+    return rows;
+}
+
 rvbd_yui3.TimeSeriesWidget = function (dataurl, divid, options, criteria) {
     Widget.apply(this, [dataurl, divid, options, criteria]);
 }
@@ -69,6 +96,7 @@ rvbd_yui3.TimeSeriesWidget.prototype.render = function(data)
             return msg;
         };
 
+    data.dataProvider = rvbd_yui3.decodeRows(data.dataProvider);
     data.render =  "#" + contentid
     YUI().use('charts-legend', function(Y) {
         var chart = new Y.Chart(data);
@@ -100,6 +128,7 @@ rvbd_yui3.TableWidget.prototype.render = function(data)
         width(div.width()-22).
         height(div.height()-42)
 
+    data.data = rvbd_yui3.decodeRows(data.data);
     data.render =  "#" + contentid
     data.scrollable = 'xy';
     data.height = $('#' + contentid).height() + "px";
@@ -178,6 +207,7 @@ rvbd_yui3.ChartWidget.prototype.render = function(data)
             return msg;
         };
 
+    data.dataProvider = rvbd_yui3.decodeRows(data.dataProvider);
     data.render =  "#" + contentid
     YUI().use('charts-legend', function(Y) {
         var chart = new Y.Chart(data);
@@ -1,2 +1,9 @@
 from rvbd_portal.apps.report.tests.test_criteria import *
 from rvbd_portal.apps.report.tests.test_synthetic import *
+from rvbd_portal.apps.report.tests.test_datastore import *
+from rvbd_portal.apps.report.tests.test_resample import *
+from rvbd_portal.apps.report.tests.test_timecache import *
+from rvbd_portal.apps.report.tests.test_handles import *
+from rvbd_portal.apps.report.tests.test_jobs import *
+from rvbd_portal.apps.report.tests.test_scheduler import *
+from rvbd_portal.apps.report.tests.test_workerpool import *
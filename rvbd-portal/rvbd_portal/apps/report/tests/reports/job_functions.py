@@ -0,0 +1,39 @@
+import logging
+
+from rvbd_portal.apps.datasource.modules.analysis import AnalysisException
+from rvbd_portal.apps.report.tests.reports.synthetic_functions import \
+    analysis_generate_data
+
+
+logger = logging.getLogger(__name__)
+
+# Number of times each table ran its analysis function, by table name
+calls = {}
+
+
+def _count(query):
+    calls[query.table.name] = calls.get(query.table.name, 0) + 1
+
+
+def analysis_counted(query, tables, criteria, params):
+    _count(query)
+    return analysis_generate_data(query, tables, criteria, params)
+
+
+def analysis_double(query, tables, criteria, params):
+    _count(query)
+    df = tables['src']
+    df['value'] = df['value'] * 2
+    return df
+
+
+def analysis_add(query, tables, criteria, params):
+    _count(query)
+    df = tables['a']
+    df['value'] = df['value'] + tables['b']['value']
+    return df
+
+
+def analysis_fail(query, tables, criteria, params):
+    _count(query)
+    raise AnalysisException("failed on purpose")
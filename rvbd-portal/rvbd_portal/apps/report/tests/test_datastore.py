@@ -0,0 +1,129 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import os
+import shutil
+import logging
+import tempfile
+
+import numpy
+import pandas
+from pandas.util.testing import assert_frame_equal
+
+from django.test import TestCase
+
+from rvbd_portal.apps.datasource import datastore
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnarStoreTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = datastore.ColumnarStore()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_frame(self):
+        times = (numpy.arange(1385912700, 1385913000, 60) *
+                 10**9).astype('datetime64[ns]')
+        times[2] = numpy.datetime64('NaT')
+        return pandas.DataFrame(
+            {'time': times,
+             'bytes': numpy.array([1, 2, 3, 4, 5], dtype=numpy.int64),
+             'avg': [1.5, numpy.nan, 2.5, numpy.nan, 0.0],
+             'up': [True, False, True, True, False],
+             'name': [u'caf\xe9', None, 'tcp', u'\u65e5\u672c', ''],
+             'mixed': [1, 'two', None, 4.0, numpy.nan]},
+            columns=['time', 'bytes', 'avg', 'up', 'name', 'mixed'])
+
+    def roundtrip(self, df, **kwargs):
+        path = os.path.join(self.dir, 'test.data')
+        self.store.save(df, path)
+        return self.store.load(path, **kwargs)
+
+    def test_roundtrip(self):
+        df = self.make_frame()
+        result = self.roundtrip(df)
+        assert_frame_equal(result, df)
+        self.assertTrue(result['name'][1] is None)
+        self.assertEqual(result['name'][3], u'\u65e5\u672c')
+        self.assertTrue(pandas.isnull(result['time'][2]))
+
+    def test_columns_and_rows(self):
+        df = self.make_frame()
+        result = self.roundtrip(df, columns=['name', 'missing', 'avg'],
+                                rows=slice(1, 4))
+        assert_frame_equal(result, df[['name', 'avg']].iloc[1:4])
+
+        result = self.roundtrip(df, rows=slice(None, None, -2))
+        assert_frame_equal(result, df.iloc[::-2])
+
+    def test_index(self):
+        df = self.make_frame().set_index('name')
+        assert_frame_equal(self.roundtrip(df), df)
+        assert_frame_equal(self.roundtrip(df, rows=slice(2, None)),
+                           df.iloc[2:])
+
+    def test_empty(self):
+        df = self.make_frame().iloc[:0]
+        result = self.roundtrip(df)
+        self.assertEqual(len(result), 0)
+        self.assertEqual(list(result.columns), list(df.columns))
+        for col in df.columns:
+            self.assertEqual(result[col].dtype, df[col].dtype)
+
+        df = self.make_frame()
+        self.assertEqual(len(self.roundtrip(df, rows=slice(3, 3))), 0)
+
+    def test_rows_past_end(self):
+        df = self.make_frame()
+        for store in (datastore.ColumnarStore(), datastore.PickleStore()):
+            path = os.path.join(self.dir, '%s.data' % store.name)
+            store.save(df, path)
+            assert_frame_equal(store.load(path, rows=slice(0, 100)), df)
+            assert_frame_equal(store.load(path, rows=slice(2, 100)),
+                               df.iloc[2:])
+            self.assertEqual(len(store.load(path, rows=slice(10, 20))), 0)
+
+    def test_load_detects_format(self):
+        df = self.make_frame()
+        for store in (datastore.ColumnarStore(), datastore.PickleStore()):
+            path = os.path.join(self.dir, '%s.data' % store.name)
+            store.save(df, path)
+            assert_frame_equal(datastore.load(path), df)
+
+
+class DataCacheTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'job.data')
+        self.df = pandas.DataFrame({'a': numpy.arange(5),
+                                    'b': numpy.arange(5) * 1.5})
+        datastore.save(self.df, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_rows_past_end(self):
+        # Widgets ask for their row limit regardless of the data size
+        cache = datastore.DataCache(10**6)
+        for i in range(2):
+            assert_frame_equal(cache.load('key', self.path,
+                                          rows=slice(0, 100)),
+                               self.df)
+        self.assertEqual(cache.hits, 1)
+        assert_frame_equal(cache.load('key', self.path, rows=slice(3, 100)),
+                           self.df.iloc[3:])
+        assert_frame_equal(cache.load('key', self.path,
+                                      rows=slice(None, None, -1)),
+                           self.df.iloc[::-1])
+        self.assertEqual(len(cache.load('key', self.path,
+                                        rows=slice(10, 20))), 0)
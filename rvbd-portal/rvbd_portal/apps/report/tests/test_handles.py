@@ -0,0 +1,91 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import logging
+import datetime
+from collections import OrderedDict
+
+import pytz
+
+from django.test import TestCase
+
+from rvbd_portal.apps.datasource.models import (Job, Criteria,
+                                                canonical_criteria)
+from rvbd_portal.apps.datasource.modules.analysis import AnalysisTable
+from rvbd_portal.apps.datasource.timecache import epoch_seconds
+from rvbd_portal.apps.report.tests.reports import synthetic_functions as funcs
+
+logger = logging.getLogger(__name__)
+
+
+class CanonicalCriteriaTest(TestCase):
+
+    # 12/1/2013 11:00 UTC
+    t = 1385895600
+
+    def setUp(self):
+        self.table = AnalysisTable.create(
+            'test-handles', tables={}, func=funcs.analysis_generate_data,
+            params={'source_resolution': 60})
+
+    def handle(self, **kwargs):
+        kwargs.setdefault('ignore_cache', False)
+        return Job._compute_handle(self.table, Criteria(**kwargs))
+
+    def test_key_order(self):
+        items = [('resolution', 60), ('duration', 900), ('device', '1'),
+                 ('filterexpr', 'host 10.0.0.1'),
+                 ('options', {'a': 1, 'b': [1, 2]})]
+        self.assertEqual(canonical_criteria(OrderedDict(items)),
+                         canonical_criteria(OrderedDict(reversed(items))))
+
+        nested = OrderedDict([('b', [1, 2]), ('a', 1)])
+        self.assertEqual(canonical_criteria({'options': nested}),
+                         canonical_criteria({'options': {'a': 1,
+                                                         'b': [1, 2]}}))
+
+    def test_times(self):
+        utc = datetime.datetime.fromtimestamp(self.t, pytz.utc)
+        eastern = utc.astimezone(pytz.timezone('US/Eastern'))
+        # Naive datetimes are local time, like datetime.now()
+        naive = datetime.datetime.fromtimestamp(self.t)
+        self.assertEqual(epoch_seconds(naive), self.t)
+
+        expected = canonical_criteria({'endtime': utc})
+        self.assertEqual(expected, 'endtime:%d' % self.t)
+        self.assertEqual(canonical_criteria({'endtime': eastern}), expected)
+        self.assertEqual(canonical_criteria({'endtime': naive}), expected)
+
+        self.assertEqual(self.handle(endtime=utc), self.handle(endtime=naive))
+        self.assertNotEqual(
+            self.handle(endtime=utc),
+            self.handle(endtime=utc + datetime.timedelta(minutes=1)))
+
+    def test_numbers(self):
+        expected = canonical_criteria({'resolution': 60})
+        for value in (60.0, datetime.timedelta(seconds=60)):
+            self.assertEqual(canonical_criteria({'resolution': value}),
+                             expected)
+        self.assertNotEqual(canonical_criteria({'resolution': 60.5}),
+                            expected)
+        self.assertNotEqual(canonical_criteria({'resolution': True}),
+                            canonical_criteria({'resolution': 1}))
+
+    def test_private_keys(self):
+        self.assertEqual(canonical_criteria({'a': 1, '_orig_a': 2}),
+                         canonical_criteria({'a': 1, '_orig_a': 3}))
+
+        # Criteria keep the original times under private keys
+        criteria = Criteria(duration=datetime.timedelta(minutes=15),
+                            ignore_cache=False)
+        criteria['_orig_duration'] = datetime.timedelta(minutes=5)
+        self.assertEqual(Job._compute_handle(self.table, criteria),
+                         self.handle(duration=datetime.timedelta(minutes=15)))
+
+    def test_uncacheable(self):
+        self.assertNotEqual(self.handle(resolution=60, ignore_cache=True),
+                            self.handle(resolution=60, ignore_cache=True))
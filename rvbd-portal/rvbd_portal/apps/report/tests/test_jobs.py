@@ -0,0 +1,109 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import os
+import logging
+import datetime
+
+import pytz
+
+from django.test import TestCase
+
+from rvbd_portal.apps.datasource.models import (Job, Column, Criteria,
+                                                HandleLock)
+from rvbd_portal.apps.datasource.modules.analysis import AnalysisTable
+from rvbd_portal.apps.report.tests.reports import job_functions as funcs
+
+logger = logging.getLogger(__name__)
+
+
+def create_table(name, func, tables=None):
+    table = AnalysisTable.create(name, tables=tables or {}, func=func,
+                                 params={'source_resolution': 60})
+    Column.create(table, 'time', 'Time', iskey=True, isnumeric=True,
+                  datatype='time')
+    Column.create(table, 'value', 'Value', isnumeric=True)
+    return table
+
+
+def make_criteria(**kwargs):
+    endtime = datetime.datetime(2013, 12, 1, 11, 0, tzinfo=pytz.utc)
+    return Criteria(starttime=endtime - datetime.timedelta(minutes=15),
+                    endtime=endtime, ignore_cache=False, **kwargs)
+
+
+class SharedJobsTest(TestCase):
+    """ Identical jobs share one run and one data file. """
+
+    def setUp(self):
+        funcs.calls.clear()
+        self.table = create_table('test-shared-jobs', funcs.analysis_counted)
+
+    def other_parent(self, job):
+        # A job for the same handle created by another server process
+        other = Job(table=job.table, criteria=job.criteria,
+                    actual_criteria=job.actual_criteria, status=Job.COMPLETE,
+                    handle=job.handle, ischild=False, progress=100)
+        other.save()
+        return other
+
+    def test_shared(self):
+        job1 = Job.create(self.table, make_criteria())
+        job2 = Job.create(self.table, make_criteria())
+        self.assertFalse(job1.ischild)
+        self.assertTrue(job2.ischild)
+        self.assertEqual(job2.parent_id, job1.id)
+
+        job1.start()
+        job2.start()
+        job1.refresh()
+        job2.refresh()
+        self.assertEqual(funcs.calls, {'test-shared-jobs': 1})
+        self.assertEqual(job1.status, Job.COMPLETE)
+        self.assertEqual(job2.status, Job.COMPLETE)
+        self.assertEqual(job1.datafile(), job2.datafile())
+        self.assertEqual(len(job1.data()), 15)
+        self.assertEqual(job2.values(), job1.values())
+
+        # Reuses the completed job
+        job3 = Job.create(self.table, make_criteria())
+        job3.start()
+        self.assertEqual(job3.parent_id, job1.id)
+        self.assertEqual(funcs.calls, {'test-shared-jobs': 1})
+
+        # Different criteria run again
+        job4 = Job.create(self.table,
+                          make_criteria(resolution=datetime.timedelta(0, 60)))
+        job4.start()
+        self.assertFalse(job4.ischild)
+        self.assertNotEqual(job4.handle, job1.handle)
+        self.assertEqual(funcs.calls, {'test-shared-jobs': 2})
+
+    def test_delete(self):
+        job1 = Job.create(self.table, make_criteria())
+        job2 = Job.create(self.table, make_criteria())
+        job1.start()
+        datafile = job1.datafile()
+        lockfile = HandleLock(job1.handle).path
+        self.assertTrue(os.path.exists(datafile))
+
+        # Deleting a child keeps the data of its parent
+        job2.delete()
+        self.assertTrue(os.path.exists(datafile))
+        self.assertEqual(len(job1.data()), 15)
+
+        # So does deleting a parent while another one uses the handle
+        other = self.other_parent(job1)
+        Job.objects.filter(id=job1.id).delete()
+        self.assertTrue(os.path.exists(datafile))
+        self.assertEqual(len(other.data()), 15)
+
+        # Deleting all parents of the handle at once removes the files
+        self.other_parent(other)
+        Job.objects.filter(handle=other.handle).delete()
+        self.assertFalse(os.path.exists(datafile))
+        self.assertFalse(os.path.exists(lockfile))
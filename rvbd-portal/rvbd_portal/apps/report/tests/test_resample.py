@@ -0,0 +1,87 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import logging
+
+import numpy
+import pandas
+from pandas.util.testing import assert_frame_equal
+
+from django.test import TestCase
+
+from rvbd_portal.apps.datasource.resample import (PandasResampler,
+                                                  EpochResampler)
+
+logger = logging.getLogger(__name__)
+
+
+class ResampleTest(TestCase):
+    """ The epoch resampler must give the same results as pandas. """
+
+    ops = ('sum', 'mean', 'min', 'max', 'count', 'first', 'last')
+
+    def make_frame(self, seconds):
+        seconds = numpy.asarray(seconds)
+        n = len(seconds)
+        avg = numpy.arange(n, dtype=float) * 1.5
+        avg[::4] = numpy.nan
+        return pandas.DataFrame(
+            {'time': (seconds * 10**9).astype('datetime64[ns]'),
+             'avg': avg,
+             'bytes': numpy.arange(n, dtype=numpy.int64) * 100})
+
+    def compare(self, df, resolution, ops, expected=None):
+        for op in ops:
+            how = {'avg': op, 'bytes': op}
+            want = PandasResampler().resample(
+                df if expected is None else expected, 'time', resolution, how)
+            got = EpochResampler().resample(df, 'time', resolution, how)
+            logger.debug("%s:\n%s\nvs\n%s" % (op, want, got))
+            # pandas turns integral means of integer columns back into
+            # integers, the epoch resampler keeps them float
+            assert_frame_equal(got[['time', 'avg', 'bytes']],
+                               want[['time', 'avg', 'bytes']],
+                               check_dtype=(op != 'mean'))
+
+    def test_no_gaps(self):
+        # Several rows in every one minute bucket, integer columns
+        # stay integer
+        seconds = numpy.arange(1385912700, 1385913600, 15)
+        self.compare(self.make_frame(seconds), 60, self.ops)
+        self.compare(self.make_frame(seconds), 120, self.ops)
+
+    def test_gaps(self):
+        seconds = numpy.concatenate((numpy.arange(1385912700, 1385912880, 20),
+                                     numpy.arange(1385913300, 1385913600, 20)))
+        self.compare(self.make_frame(seconds), 60,
+                     ('sum', 'mean', 'min', 'max'))
+
+    def test_unsorted(self):
+        seconds = numpy.arange(1385912700, 1385913600, 15)
+        df = self.make_frame(seconds)
+        shuffled = df.take(numpy.random.RandomState(0).permutation(len(df)))
+        self.compare(shuffled, 60, ('sum', 'mean', 'min', 'max'),
+                     expected=df)
+
+    def test_nat(self):
+        seconds = numpy.arange(1385912700, 1385913600, 15)
+        df = self.make_frame(seconds)
+        times = df['time'].values.copy()
+        times[[0, 7, 30]] = numpy.datetime64('NaT')
+        df['time'] = times
+        valid = df[pandas.notnull(df['time'])]
+        self.compare(df, 60, self.ops, expected=valid)
+
+    def test_empty(self):
+        df = self.make_frame(numpy.arange(1385912700, 1385913600, 15))
+        nat = df.copy()
+        nat['time'] = numpy.array([numpy.datetime64('NaT')] * len(df),
+                                  dtype='datetime64[ns]')
+        for frame in (df.iloc[:0], nat):
+            result = EpochResampler().resample(frame, 'time', 60,
+                                               {'avg': 'sum', 'bytes': 'sum'})
+            self.assertEqual(len(result), 0)
@@ -0,0 +1,101 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import logging
+
+from django.test import TestCase
+
+from rvbd_portal.apps.datasource import models
+from rvbd_portal.apps.datasource.models import Job
+from rvbd_portal.apps.datasource.modules import analysis
+from rvbd_portal.apps.datasource.scheduler import JobScheduler
+from rvbd_portal.apps.report.tests.reports import job_functions as funcs
+from rvbd_portal.apps.report.tests.test_jobs import (create_table,
+                                                     make_criteria)
+
+logger = logging.getLogger(__name__)
+
+
+class SyncPool(object):
+    """ Worker pool that runs each function as it is submitted. """
+
+    name = 'sync'
+
+    def submit(self, func, priority=None):
+        func()
+
+
+class SyncScheduler(JobScheduler):
+    """ JobScheduler run round by round from the test thread.
+
+    The test database is not shared with other threads, so there is
+    no watcher thread, run_pending() polls until nothing is left.
+    """
+
+    def when_done(self, deferred, func, fail):
+        with self._lock:
+            self._pending.append((deferred, func, fail))
+
+    def run_pending(self, rounds=10):
+        for i in range(rounds):
+            if not self._pending:
+                return
+            self._poll()
+        raise AssertionError("Jobs still pending after %d rounds: %s" %
+                             (rounds, [str(d) for d, _, _ in self._pending]))
+
+
+class JobSchedulerTest(TestCase):
+    """ Analysis tables with analysis dependencies run through the
+    scheduler rather than blocking on their dependent jobs. """
+
+    def setUp(self):
+        funcs.calls.clear()
+        self.scheduler = SyncScheduler(SyncPool())
+        self.saved = (models.scheduler, analysis.scheduler)
+        models.scheduler = analysis.scheduler = self.scheduler
+
+    def tearDown(self):
+        models.scheduler, analysis.scheduler = self.saved
+
+    def run_job(self, table):
+        job = Job.create(table, make_criteria())
+        job.start()
+        self.scheduler.run_pending()
+        job.refresh()
+        return job
+
+    def test_shared_dependency(self):
+        leaf = create_table('test-sched-leaf', funcs.analysis_counted)
+        a1 = create_table('test-sched-a1', funcs.analysis_double,
+                          tables={'src': leaf.id})
+        a2 = create_table('test-sched-a2', funcs.analysis_double,
+                          tables={'src': leaf.id})
+        top = create_table('test-sched-top', funcs.analysis_add,
+                           tables={'a': a1.id, 'b': a2.id})
+
+        job = self.run_job(top)
+        self.assertEqual(job.status, Job.COMPLETE, job.message)
+        self.assertEqual(funcs.calls, {'test-sched-leaf': 1,
+                                       'test-sched-a1': 1,
+                                       'test-sched-a2': 1,
+                                       'test-sched-top': 1})
+
+        df = job.data()
+        self.assertEqual(len(df), 15)
+        self.assertEqual(list(df['value']), [4] * 15)
+
+    def test_failed_dependency(self):
+        leaf = create_table('test-sched-fail', funcs.analysis_fail)
+        parent = create_table('test-sched-parent', funcs.analysis_double,
+                              tables={'src': leaf.id})
+
+        job = self.run_job(parent)
+        self.assertEqual(job.status, Job.ERROR)
+        self.assertIn('Dependent Job failed', job.message)
+        # The parent never got to run its own analysis function
+        self.assertEqual(funcs.calls, {'test-sched-fail': 1})
@@ -0,0 +1,149 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import shutil
+import logging
+import datetime
+import tempfile
+
+import pytz
+import numpy
+import pandas
+
+from django.test import TestCase
+
+from rvbd_portal.apps.datasource.models import Criteria
+from rvbd_portal.apps.datasource.timecache import (TimeSeriesCache,
+                                                   epoch_seconds)
+
+logger = logging.getLogger(__name__)
+
+
+class FakeColumn(object):
+    def __init__(self, name, datatype):
+        self.name = name
+        self.datatype = datatype
+
+
+class FakeTable(object):
+    id = 1
+    rows = -1
+
+    def column_signature(self):
+        return 'time,value'
+
+
+class FakeJob(object):
+    """ Just enough of a Job for TimeSeriesCache.run(). """
+
+    def __init__(self, criteria):
+        self.table = FakeTable()
+        self.criteria = criteria
+        self.partials = []
+        self.updates = {}
+
+    def __str__(self):
+        return "<FakeJob>"
+
+    def get_columns(self, synthetic=None):
+        return [FakeColumn('time', 'time'), FakeColumn('value', '')]
+
+    def publish_partial(self, df, replace=False):
+        self.partials.append(len(df))
+
+    def safe_update(self, **kwargs):
+        self.updates.update(kwargs)
+
+    def mark_progress(self, progress, remaining=None):
+        pass
+
+
+class TimeSeriesCacheTest(TestCase):
+
+    # 12/1/2013 10:45 UTC
+    t0 = 1385894700
+    resolution = 60
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = TimeSeriesCache(self.dir, delay=0, max_age=3600)
+        self.queried = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def query(self, job):
+        # One row per minute, the value is the epoch time of the row
+        t0 = int(epoch_seconds(job.criteria.starttime))
+        t1 = int(epoch_seconds(job.criteria.endtime))
+        self.queried.append((t0, t1))
+        seconds = numpy.arange(t0, t1, self.resolution)
+        return True, pandas.DataFrame(
+            {'time': (seconds * 10**9).astype('datetime64[ns]'),
+             'value': seconds.astype(float)},
+            columns=['time', 'value'])
+
+    def run_range(self, start, end):
+        """ Run a job from minute `start` to `end` after t0. """
+        def t(minute):
+            return datetime.datetime.fromtimestamp(self.t0 + minute * 60,
+                                                   pytz.utc)
+
+        criteria = Criteria(starttime=t(start), endtime=t(end),
+                            duration=t(end) - t(start),
+                            resolution=datetime.timedelta(
+                                seconds=self.resolution))
+        job = FakeJob(criteria)
+        self.queried = []
+        success, df = self.cache.run(job, self.query)
+        self.assertTrue(success)
+
+        # One row per minute from start to end, whatever was cached
+        seconds = self.t0 + numpy.arange(start, end) * 60
+        self.assertEqual(list(df['value']), list(seconds.astype(float)))
+        self.assertEqual(
+            list(df['time'].values.astype('datetime64[ns]')
+                 .view(numpy.int64) // 10**9),
+            list(seconds))
+        return job
+
+    def minutes(self, start, end):
+        return (self.t0 + start * 60, self.t0 + end * 60)
+
+    def test_reuse(self):
+        self.run_range(0, 30)
+        self.assertEqual(self.queried, [self.minutes(0, 30)])
+
+        # Only the new part is queried
+        self.run_range(15, 45)
+        self.assertEqual(self.queried, [self.minutes(30, 45)])
+
+        # All cached
+        self.run_range(5, 40)
+        self.assertEqual(self.queried, [])
+
+    def test_gap(self):
+        self.run_range(0, 10)
+        self.run_range(20, 30)
+
+        # Both segments are spliced around the missing middle
+        job = self.run_range(0, 30)
+        self.assertEqual(self.queried, [self.minutes(10, 20)])
+        self.assertEqual(job.partials, [20])
+        self.assertEqual(epoch_seconds(job.updates['actual_criteria']
+                                       .starttime), self.t0)
+
+        self.run_range(0, 30)
+        self.assertEqual(self.queried, [])
+
+    def test_slices(self):
+        self.cache.slice_buckets = 10
+        job = self.run_range(0, 25)
+        self.assertEqual(self.queried, [self.minutes(0, 10),
+                                        self.minutes(10, 20),
+                                        self.minutes(20, 25)])
+        self.assertEqual(job.partials, [10, 20])
@@ -0,0 +1,95 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import logging
+import threading
+
+from django.test import TestCase
+
+from rvbd_portal.apps.datasource.exceptions import WorkerPoolFull
+from rvbd_portal.apps.datasource.workerpool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for pool threads before failing a test
+TIMEOUT = 5
+
+
+class WorkerPoolTest(TestCase):
+    """ The pool functions below never touch the database, which is
+    not shared with the pool threads. """
+
+    def setUp(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def tearDown(self):
+        # Never leave a pool thread waiting
+        self.release.set()
+
+    def block(self, pool):
+        """ Occupy a pool thread until self.release is set. """
+        def func():
+            self.started.set()
+            self.release.wait(TIMEOUT)
+        pool.submit(func)
+        self.assertTrue(self.started.wait(TIMEOUT))
+
+    def test_priority(self):
+        pool = WorkerPool('test-priority', size=1)
+        self.block(pool)
+
+        order = []
+        done = threading.Event()
+        for name, priority in [('a', 10), ('b', 0), ('c', 10), ('d', 5)]:
+            pool.submit(order.append, args=(name,), priority=priority)
+        pool.submit(done.set, priority=20)
+
+        self.release.set()
+        self.assertTrue(done.wait(TIMEOUT))
+        # Lower values first, submission order within a priority
+        self.assertEqual(order, ['b', 'd', 'a', 'c'])
+
+    def test_max_queued(self):
+        pool = WorkerPool('test-full', size=1, max_queued=2)
+        self.block(pool)
+
+        done = threading.Event()
+        pool.submit(lambda: None)
+        pool.submit(done.set)
+        self.assertRaises(WorkerPoolFull, pool.submit, lambda: None)
+        self.assertEqual(pool.stats()['queued'], 2)
+
+        self.release.set()
+        self.assertTrue(done.wait(TIMEOUT))
+
+    def test_blocking(self):
+        pool = WorkerPool('test-blocking', size=1)
+        blocked = threading.Event()
+        ran = threading.Event()
+        result = {}
+
+        def waiter():
+            result['in_worker'] = pool.in_worker()
+            with pool.blocking():
+                blocked.set()
+                ran.wait(TIMEOUT)
+
+        def second():
+            result['stats'] = pool.stats()
+            ran.set()
+
+        pool.submit(waiter)
+        self.assertTrue(blocked.wait(TIMEOUT))
+        self.assertFalse(pool.in_worker())
+
+        # The only thread is waiting, so a second one runs this
+        pool.submit(second)
+        self.assertTrue(ran.wait(TIMEOUT))
+        self.assertTrue(result['in_worker'])
+        self.assertEqual(result['stats']['threads'], 2)
+        self.assertEqual(result['stats']['blocked'], 1)
@@ -45,6 +45,14 @@ urlpatterns = patterns(
         views.ReportWidgets.as_view(),
         name='report-widgets'),
 
+    url(r'^(?P<namespace>[0-9_a-zA-Z]+)/(?P<report_slug>[0-9_a-zA-Z]+)/jobs/$',
+        views.ReportJobsList.as_view(),
+        name='report-job-list'),
+
+    url(r'^(?P<namespace>[0-9_a-zA-Z]+)/(?P<report_slug>[0-9_a-zA-Z]+)/jobs/status/$',
+        views.ReportJobsStatus.as_view(),
+        name='report-job-status'),
+
     url(r'^(?P<namespace>[0-9_a-zA-Z]+)/(?P<report_slug>[0-9_a-zA-Z]+)/widget/(?P<widget_id>[0-9]+)/jobs/$',
         views.WidgetJobsList.as_view(),
         name='widget-job-list'),
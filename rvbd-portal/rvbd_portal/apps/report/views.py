@@ -9,6 +9,7 @@ import os
 import sys
 import cgi
 import json
+import time
 import datetime
 import importlib
 import traceback
@@ -31,10 +32,11 @@ from rest_framework.renderers import TemplateHTMLRenderer, JSONRenderer
 
 from rvbd.common.timeutils import round_time
 
-from rvbd_portal.apps.datasource.models import Job, Table
+from rvbd_portal.apps.datasource.models import Job, Table, Criteria, PartialJob
+from rvbd_portal.apps.datasource.notify import notifier
 from rvbd_portal.apps.datasource.serializers import TableSerializer
 from rvbd_portal.apps.datasource.forms import TableFieldForm
-from rvbd_portal.apps.devices.models import Device
+from rvbd_portal.apps.devices.devicemanager import DeviceManager
 from rvbd_portal.apps.report.models import Report, Section, Widget, WidgetJob
 from rvbd_portal.apps.report.serializers import ReportSerializer
 from rvbd_portal.apps.report.utils import create_debug_zipfile
@@ -124,13 +126,9 @@ class ReportView(views.APIView):
         logging.debug('Received request for report page: %s' % report_slug)
 
         # search across all enabled devices
-        for device in Device.objects.all():
-            if (device.enabled and ('host.or.ip' in device.host or
-                                    device.username == '<username>' or
-                                    device.password == '<password>' or
-                                    device.password == '')):
-                return HttpResponseRedirect('%s?invalid=true' %
-                                            reverse('device-list'))
+        if DeviceManager.has_invalid_devices():
+            return HttpResponseRedirect('%s?invalid=true' %
+                                        reverse('device-list'))
 
         profile = request.user.userprofile
         if not profile.profile_seen:
@@ -262,6 +260,18 @@ class ReportView(views.APIView):
             return HttpResponse(str(form.errors), status=400)
 
 
+def default_criteria(all_fields):
+    """ Return a dict of the initial value of each of `all_fields`. """
+    form = TableFieldForm(all_fields, use_widgets=False)
+
+    # create object from the tablefield keywords
+    # then populate it with the initial data that got generated by default
+    keys = form._tablefields.keys()
+    criteria = dict(zip(keys, [None]*len(keys)))
+    criteria.update(form.data)
+    return criteria
+
+
 class ReportCriteria(views.APIView):
     """ Handle requests for criteria fields.
 
@@ -289,15 +299,7 @@ class ReportCriteria(views.APIView):
         except:
             raise Http404
 
-        form = TableFieldForm(all_fields, use_widgets=False)
-
-        # create object from the tablefield keywords
-        # then populate it with the initial data that got generated by default
-        keys = form._tablefields.keys()
-        criteria = dict(zip(keys, [None]*len(keys)))
-        criteria.update(form.data)
-
-        return HttpResponse(json.dumps(criteria))
+        return HttpResponse(json.dumps(default_criteria(all_fields)))
 
     def post(self, request, namespace=None, report_slug=None):
         # handle REST calls
@@ -365,11 +367,7 @@ class ReportWidgets(views.APIView):
         for w in report.widgets().order_by('row', 'col'):
             # get default criteria values for widget
             # and set endtime to now, if applicable
-            criteria = ReportCriteria.as_view()(request,
-                                                w.section.report.namespace,
-                                                w.section.report.slug,
-                                                w.id)
-            widget_criteria = json.loads(criteria.content)
+            widget_criteria = default_criteria(w.collect_fields())
             if 'endtime' in widget_criteria:
                 widget_criteria['endtime'] = now.isoformat()
 
@@ -377,8 +375,8 @@ class ReportWidgets(views.APIView):
             widget_def = {
                 "widgettype": w.widgettype().split("."),
                 "posturl": reverse('widget-job-list',
-                                   args=(w.section.report.namespace,
-                                         w.section.report.slug,
+                                   args=(report.namespace,
+                                         report.slug,
                                          w.id)),
                 "options": w.uioptions,
                 "widgetid": w.id,
@@ -424,111 +422,411 @@ class WidgetJobsList(views.APIView):
 
         req_json = json.loads(request.POST['criteria'])
 
-        fields = widget.collect_fields()
-
-        form = TableFieldForm(fields, use_widgets=False,
-                              hidden_fields=report.hidden_fields,
-                              include_hidden=True,
-                              data=req_json, files=request.FILES)
+        form_criteria = criteria_from_request(request, report,
+                                              widget.collect_fields(),
+                                              req_json, request.FILES)
 
-        if not form.is_valid():
-            raise ValueError("Widget internal criteria form is invalid:\n%s" %
-                             (form.errors.as_text()))
+        try:
+            job = Job.create(table=widget.table(),
+                             criteria=form_criteria)
+            job.start()
+
+            wjob = WidgetJob(widget=widget, job=job)
+            wjob.save()
+
+            logger.debug("Created WidgetJob %s for report %s (handle %s)" %
+                         (str(wjob), report_slug, job.handle))
+
+            return Response({"joburl": reverse('report-job-detail',
+                                               args=[namespace,
+                                                     report_slug,
+                                                     widget_id,
+                                                     wjob.id]),
+                             "jobid": wjob.id})
+        except Exception as e:
+            logger.exception("Failed to start job, an exception occurred")
+            return HttpResponse(str(e), status=400)
+
+
+class ReportJobsList(views.APIView):
+    """ Create the jobs for several widgets of a report in one request.
+
+    The POST data holds `jobs`, a json list of {widgetid, criteria}
+    objects.  Criteria are validated once for each distinct set of
+    fields and criteria values, all jobs are then created together and
+    started.  Returns a list with the joburl and jobid of each entry in
+    `jobs`, or an error message for entries that are malformed, fail
+    validation or could not be started.
+    """
 
-        if form.is_valid():
-            logger.debug('Form passed validation: %s' % form)
-            formdata = form.cleaned_data
-            logger.debug('Form cleaned data: %s' % formdata)
+    parser_classes = (JSONParser,)
 
-            # parse time and localize to user profile timezone
-            profile = request.user.userprofile
-            timezone = pytz.timezone(profile.timezone)
-            form.apply_timezone(timezone)
+    def post(self, request, namespace, report_slug, format=None):
+        logger.debug("Received batch POST for report %s: %s" %
+                     (report_slug, request.POST))
 
-            form_criteria = form.criteria()
-            logger.debug('Form_criteria: %s' % form_criteria)
+        try:
+            report = Report.objects.get(namespace=namespace, slug=report_slug)
+        except:
+            raise Http404
 
+        try:
+            entries = json.loads(request.POST['jobs'])
+            if not isinstance(entries, list):
+                raise ValueError("jobs must be a list")
+        except (KeyError, ValueError) as e:
+            return HttpResponse("Invalid jobs: %s" % e, status=400)
+
+        results = [None] * len(entries)
+        widget_ids = {}
+        for i, entry in enumerate(entries):
             try:
-                job = Job.create(table=widget.table(),
-                                 criteria=form_criteria)
-                job.start()
+                widget_ids[i] = int(entry['widgetid'])
+                if not isinstance(entry['criteria'], dict):
+                    raise ValueError("criteria must be an object")
+            except (KeyError, TypeError, ValueError) as e:
+                results[i] = {"error": "Invalid entry %s: %s" % (i, e)}
+                widget_ids.pop(i, None)
+
+        widgets = dict((w.id, w) for w in Widget.objects.filter(
+            section__report=report, id__in=widget_ids.values()))
+
+        created = []
+        validated = {}
+        for i, entry in enumerate(entries):
+            if i not in widget_ids:
+                continue
+            widget = widgets.get(widget_ids[i])
+            if widget is None:
+                results[i] = {"error": "Unknown widget %s" % entry['widgetid']}
+                continue
+
+            # Widgets of the same section usually share both fields and
+            # criteria, so the form only needs to be checked once
+            fields = widget.collect_fields()
+            key = (tuple((k, f.id) for k, f in fields.iteritems()),
+                   json.dumps(entry['criteria'], sort_keys=True))
+            if key not in validated:
+                try:
+                    validated[key] = criteria_from_request(
+                        request, report, fields, entry['criteria'])
+                except Exception as e:
+                    logger.exception("Invalid criteria for widget %s" %
+                                     widget.id)
+                    validated[key] = e
+
+            criteria = validated[key]
+            if isinstance(criteria, Exception):
+                results[i] = {"error": str(criteria)}
+                continue
+
+            # Each job keeps (and updates) its own criteria
+            created.append((i, widget, Criteria(**criteria)))
+
+        try:
+            jobs = Job.create_batch([(widget.table(), criteria)
+                                     for _, widget, criteria in created])
 
+            wjobs = []
+            for (i, widget, _), job in zip(created, jobs):
                 wjob = WidgetJob(widget=widget, job=job)
                 wjob.save()
+                wjobs.append(wjob)
 
-                logger.debug("Created WidgetJob %s for report %s (handle %s)" %
-                             (str(wjob), report_slug, job.handle))
+                logger.debug("Created WidgetJob %s for report %s (handle %s)"
+                             % (str(wjob), report_slug, job.handle))
 
-                return Response({"joburl": reverse('report-job-detail',
-                                                   args=[namespace,
-                                                         report_slug,
-                                                         widget_id,
-                                                         wjob.id])})
+                results[i] = {"joburl": reverse('report-job-detail',
+                                                args=[namespace,
+                                                      report_slug,
+                                                      widget.id,
+                                                      wjob.id]),
+                              "jobid": wjob.id}
+
+        except Exception as e:
+            logger.exception("Failed to create jobs, an exception occurred")
+            return HttpResponse(str(e), status=400)
+
+        # Jobs started before one fails keep running, so report the
+        # failure for its entry only
+        for (i, _, _), job, wjob in zip(created, jobs, wjobs):
+            try:
+                job.start()
             except Exception as e:
-                logger.exception("Failed to start job, an exception occurred")
-                return HttpResponse(str(e), status=400)
+                logger.exception("Failed to start %s" % job)
+                job.mark_error("Failed to start job: %s" % e)
+                wjob.delete()
+                results[i] = {"error": "Failed to start job: %s" % e}
 
-        else:
-            logger.error("form is invalid, entering debugger")
-            from IPython import embed; embed()
+        return Response(results)
 
 
-class WidgetJobDetail(views.APIView):
+def criteria_from_request(request, report, fields, data, files=None):
+    """ Validate criteria `data` posted for `fields` of `report`.
 
-    def get(self, request, namespace, report_slug, widget_id, job_id, format=None):
-        wjob = WidgetJob.objects.get(id=job_id)
+    Times are localized to the timezone of the requesting user.
+    Returns a Criteria object, raises ValueError if the data is
+    not valid.
+    """
+    form = TableFieldForm(fields, use_widgets=False,
+                          hidden_fields=report.hidden_fields,
+                          include_hidden=True,
+                          data=data, files=files)
 
-        job = wjob.job
-        widget = wjob.widget
+    if not form.is_valid():
+        raise ValueError("Widget internal criteria form is invalid:\n%s" %
+                         (form.errors.as_text()))
 
-        if not job.done():
-            # job not yet done, return an empty data structure
-            logger.debug("%s: Not done yet, %d%% complete" % (str(wjob),
-                                                              job.progress))
-            resp = job.json()
-        elif job.status == Job.ERROR:
-            resp = job.json()
-            logger.debug("%s: Job in Error state, deleting Job" % str(wjob))
-            wjob.delete()
-        else:
+    logger.debug('Form passed validation: %s' % form)
+    logger.debug('Form cleaned data: %s' % form.cleaned_data)
+
+    # parse time and localize to user profile timezone
+    profile = request.user.userprofile
+    timezone = pytz.timezone(profile.timezone)
+    form.apply_timezone(timezone)
+
+    form_criteria = form.criteria()
+    logger.debug('Form_criteria: %s' % form_criteria)
+    return form_criteria
+
+
+def widget_job_response(request, wjob, partial=None, delete=True):
+    """ Build the status response for a WidgetJob.
+
+    The job status of `wjob.job` must be current.  Once the job is
+    complete the widget data is rendered into the response and, if
+    `delete` is True, the WidgetJob is deleted.  While it runs, the partial result is
+    rendered instead if the job has published any since the number
+    of partial results `partial` last seen by the caller.
+    """
+    job = wjob.job
+    widget = wjob.widget
+
+    if job.status not in (Job.COMPLETE, Job.ERROR):
+        # job not yet done, return an empty data structure
+        logger.debug("%s: Not done yet, %d%% complete" % (str(wjob),
+                                                          job.progress))
+        resp = job.json()
+        if job.partial > 0 and job.partial != partial:
             try:
-                i = importlib.import_module(widget.module)
-                widget_func = i.__dict__[widget.uiwidget].process
-                if widget.rows > 0:
-                    tabledata = job.values()[:widget.rows]
-                else:
-                    tabledata = job.values()
-
-                if tabledata is None or len(tabledata) == 0:
-                    resp = job.json()
-                    resp['status'] = Job.ERROR
-                    resp['message'] = "No data returned"
-                    logger.debug("%s marked Error: No data returned" %
-                                 str(wjob))
-                elif (hasattr(i, 'authorized') and
-                      not i.authorized(request.user.userprofile)[0]):
-                    _, msg = i.authorized(request.user.userprofile)
-                    resp = job.json()
-                    resp['data'] = None
-                    resp['status'] = Job.ERROR
-                    resp['message'] = msg
-                    logger.debug("%s Error: module unauthorized for user %s"
-                                 % (str(wjob), request.user))
-                else:
-                    data = widget_func(widget, job, tabledata)
-                    resp = job.json(data)
-                    logger.debug("%s complete" % str(wjob))
+                resp['data'] = partial_widget_data(request, widget, job)
             except:
-                logger.exception("Widget %s Job %s processing failed" %
-                                 (widget.id, job.id))
+                logger.exception("Widget %s Job %s partial processing failed"
+                                 % (widget.id, job.id))
+    elif job.status == Job.ERROR:
+        resp = job.json()
+        logger.debug("%s: Job in Error state" % str(wjob))
+        if delete:
+            wjob.delete()
+    else:
+        try:
+            i = importlib.import_module(widget.module)
+            widget_class = i.__dict__[widget.uiwidget]
+            tabledata = widget_table_data(widget, widget_class, job)
+
+            if tabledata is None or len(tabledata) == 0:
+                resp = job.json()
+                resp['status'] = Job.ERROR
+                resp['message'] = "No data returned"
+                logger.debug("%s marked Error: No data returned" %
+                             str(wjob))
+            elif (hasattr(i, 'authorized') and
+                  not i.authorized(request.user.userprofile)[0]):
+                _, msg = i.authorized(request.user.userprofile)
                 resp = job.json()
+                resp['data'] = None
                 resp['status'] = Job.ERROR
-                ei = sys.exc_info()
-                resp['message'] = str(traceback.format_exception_only(ei[0],
-                                                                      ei[1]))
+                resp['message'] = msg
+                logger.debug("%s Error: module unauthorized for user %s"
+                             % (str(wjob), request.user))
+            else:
+                data = widget_class.process(widget, job, tabledata)
+                resp = job.json(data)
+                logger.debug("%s complete" % str(wjob))
+        except:
+            logger.exception("Widget %s Job %s processing failed" %
+                             (widget.id, job.id))
+            resp = job.json()
+            resp['status'] = Job.ERROR
+            ei = sys.exc_info()
+            resp['message'] = str(traceback.format_exception_only(ei[0],
+                                                                  ei[1]))
 
+        if delete:
             wjob.delete()
 
-        resp['message'] = cgi.escape(resp['message'])
+    resp['message'] = cgi.escape(resp['message'])
+    return resp
+
+
+def parse_wait(value, max_wait):
+    """ Return the long poll timeout for the `wait` parameter `value`.
+
+    Raises ValueError unless `value` is a non-negative number.
+    """
+    timeout = float(value)
+    if not timeout >= 0:
+        raise ValueError("Invalid wait: %s" % value)
+    return min(timeout, max_wait)
+
+
+def partial_widget_data(request, widget, job):
+    """ Return the partial result of running `job` processed for `widget`.
+
+    Returns None if there is none yet or the user may not see it.
+    """
+    i = importlib.import_module(widget.module)
+    if (hasattr(i, 'authorized') and
+            not i.authorized(request.user.userprofile)[0]):
+        return None
+
+    job = PartialJob(job)
+    widget_class = i.__dict__[widget.uiwidget]
+    tabledata = widget_table_data(widget, widget_class, job)
+    if tabledata is None or len(tabledata) == 0:
+        return None
+
+    return widget_class.process(widget, job, tabledata)
+
+
+def widget_table_data(widget, widget_class, job):
+    """ Return the data of `job` in the form `widget_class.process()` takes.
+
+    Widget classes with a true `uses_dataframe` attribute get the
+    DataFrame from job.data(), others the rows as lists from
+    job.values().  Only the first `widget.rows` rows are included if
+    that is positive.
+    """
+    rows = slice(0, widget.rows) if widget.rows > 0 else None
+    if getattr(widget_class, 'uses_dataframe', False):
+        return job.data(rows=rows)
+    return job.values(rows=rows)
+
+
+class WidgetJobDetail(views.APIView):
+    """ Return the status of a widget job, and the widget data once complete.
+
+    Passing `wait=<seconds>` turns this into a long poll: the request is
+    held until the job completes, until its progress differs from the
+    `progress` parameter, or until the wait times out, whichever is
+    first.  Likewise for the number of partial results and `partial`,
+    new partial results are included as the data of a running job.
+    """
+
+    # Upper limit on how long a single request may be held
+    max_wait = 30
+
+    def get(self, request, namespace, report_slug, widget_id, job_id, format=None):
+        wjob = WidgetJob.objects.get(id=job_id)
+
+        job = wjob.job
+
+        try:
+            partial = request.GET.get('partial', None)
+            if partial is not None:
+                partial = int(partial)
+            progress = request.GET.get('progress', None)
+            if progress is not None:
+                progress = int(progress)
+            timeout = None
+            if 'wait' in request.GET:
+                timeout = parse_wait(request.GET['wait'], self.max_wait)
+        except ValueError as e:
+            return HttpResponse(str(e), status=400)
+
+        if timeout is not None:
+            job.wait(timeout=timeout, progress=progress, partial=partial)
+        else:
+            job.refresh()
+
+        resp = widget_job_response(request, wjob, partial)
+        return HttpResponse(json.dumps(resp))
+
+
+class ReportJobsStatus(views.APIView):
+    """ Return the status of several widget jobs of a report page at once.
+
+    `ids` is a comma separated list of WidgetJob ids.  The response is
+    a dict mapping each id still known to the same response as
+    WidgetJobDetail, so completed jobs include their widget data.
+    All job states are read with a single query.
+
+    Unlike WidgetJobDetail, completed WidgetJobs are kept and their
+    final state is sent again until a later request lists them in
+    `done`, so a response lost with an aborted request loses nothing.
+
+    Like WidgetJobDetail, `wait=<seconds>` holds the request until a
+    job completes or changes progress.  `progress` is a comma
+    separated list of the progress last seen for each of `ids`, and
+    `partial` of the number of partial results.
+    """
+
+    max_wait = 30
+
+    def get(self, request, namespace, report_slug, format=None):
+        try:
+            ids = self._ints(request, 'ids')
+            done = self._ints(request, 'done')
+            progress = dict(zip(ids, self._ints(request, 'progress')))
+            partial = dict(zip(ids, self._ints(request, 'partial')))
+
+            if 'wait' in request.GET:
+                timeout = parse_wait(request.GET['wait'], self.max_wait)
+                deadline = time.time() + timeout
+            else:
+                deadline = None
+        except ValueError as e:
+            return HttpResponse(str(e), status=400)
+
+        report_jobs = WidgetJob.objects.filter(
+            widget__section__report__namespace=namespace,
+            widget__section__report__slug=report_slug)
+
+        if done:
+            # The caller has the final state of these
+            report_jobs.filter(id__in=done).delete()
+
+        qs = report_jobs.filter(id__in=ids).select_related('job', 'widget')
+
+        versions = None
+        while True:
+            wjobs = list(qs.all())
+            if deadline is None or self._changed(wjobs, ids, progress, partial):
+                break
+
+            if versions is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                notifier.wait(versions, min(notifier.fallback_interval,
+                                            remaining))
+
+            # Record versions before the next query so no change is missed
+            versions = notifier.versions([w.job.notify_key() for w in wjobs])
+
+        resp = {}
+        for wjob in wjobs:
+            resp[wjob.id] = widget_job_response(request, wjob,
+                                                partial.get(wjob.id),
+                                                delete=False)
 
         return HttpResponse(json.dumps(resp))
+
+    def _ints(self, request, name):
+        """ Return the comma separated integers of parameter `name`. """
+        return [int(v) for v in request.GET.get(name, '').split(',') if v]
+
+    def _changed(self, wjobs, ids, progress, partial):
+        # Report unknown jobs right away
+        if len(wjobs) < len(set(ids)):
+            return True
+
+        for wjob in wjobs:
+            job = wjob.job
+            if job.status in (Job.COMPLETE, Job.ERROR):
+                return True
+            if job.progress != progress.get(wjob.id, job.progress):
+                return True
+            if job.partial != partial.get(wjob.id, job.partial):
+                return True
+        return False
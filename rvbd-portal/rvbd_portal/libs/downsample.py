@@ -0,0 +1,52 @@
+# Copyright (c) 2013 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the
+# MIT License set forth at:
+#   https://github.com/riverbed/flyscript-portal/blob/master/LICENSE ("License").
+# This software is distributed "AS IS" as set forth in the License.
+
+import numpy
+
+
+def minmax_indices(values, max_points):
+    """ Return the indices of the rows of `values` to keep when plotting.
+
+    `values` is a 2-d array with one column per series (or a 1-d array
+    for a single series).  The rows are split into equal buckets and
+    for every series the rows holding the minimum and maximum of each
+    bucket are kept, so peaks and troughs remain visible no matter
+    how much the data is reduced.  The first and last rows are always
+    kept.  NaNs are ignored.
+
+    The number of buckets is chosen to keep at most `max_points` rows,
+    but at least one bucket is used so a very large number of series
+    may exceed it.  Returns a sorted array of row indices.
+    """
+    values = numpy.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values.reshape(-1, 1)
+
+    n, k = values.shape
+    if not max_points or n <= max_points:
+        return numpy.arange(n)
+
+    nbuckets = max(1, (max_points - 2) // (2 * max(k, 1)))
+
+    # Since n > nbuckets the bucket edges are strictly increasing
+    edges = numpy.linspace(0, n, nbuckets + 1).astype(int)
+    starts = edges[:-1]
+    bucket = numpy.repeat(numpy.arange(nbuckets), numpy.diff(edges))
+
+    keep = [numpy.array([0, n - 1])]
+    for j in range(k):
+        column = values[:, j]
+        for reduce in (numpy.fmin, numpy.fmax):
+            extreme = reduce.reduceat(column, starts)
+
+            # First row in each bucket holding the extreme, buckets that
+            # are all NaN have no match and are skipped
+            rows = numpy.flatnonzero(column == extreme[bucket])
+            _, first = numpy.unique(bucket[rows], return_index=True)
+            keep.append(rows[first])
+
+    return numpy.unique(numpy.concatenate(keep))